@@ -1,9 +1,28 @@
 import streamlit as st
 import pandas as pd
+import plotly.graph_objects as go
+import os
+import time
 from datetime import datetime, timedelta
 from polygon import RESTClient
+import portfolio_store as store
+import broker_import
+import market_data
 
 st.set_page_config(page_title="LEAPs Lag Hunter", layout="wide")
+PREMIUM_TARGET_MONTHLY = 100000.0
+
+# Target allocations for a new portfolio
+TARGET_ALLOCATIONS = {
+    "SOXL": 0.30,
+    "SLV": 0.25,
+    "TQQQ": 0.16,
+    "URA": 0.10,
+    "IAU": 0.06,
+    "COPX": 0.06,
+    "UPRO": 0.06,
+    "UAMY": 0.01,
+}
 st.title("🚀 LEAPs Lag Hunter - Polygon.io")
 st.markdown("**Better Option Data • Top 5 Opportunities**")
 
@@ -15,6 +34,8 @@ if not POLYGON_API_KEY:
     st.stop()
 
 client = RESTClient(api_key=POLYGON_API_KEY)
+# Shared quote provider: Alpaca (if keyed) -> Polygon -> yfinance, with failover
+MARKET = market_data.provider_from_secrets(st.secrets, polygon_key=POLYGON_API_KEY)
 
 # Session State
 if "tickers" not in st.session_state:
@@ -29,8 +50,11 @@ budget = st.sidebar.number_input("Available Budget ($)", min_value=500, value=50
 def analyze_leap_lag(ticker, dummy_mode=False, dummy_date=None, dummy_time=None):
     try:
         # Get current stock price
-        ticker_details = client.get_snapshot(ticker)
-        current_price = float(ticker_details.day.ticker.last_trade.p if hasattr(ticker_details.day.ticker, 'last_trade') else ticker_details.day.c)
+        quote = MARKET.get_quote(ticker)
+        if quote is None:
+            st.warning(f"No current price for {ticker} from any data source")
+            return []
+        current_price = quote.last
 
         # For simplicity, use recent move (we'll improve this later)
         move_pct = 2.5  # Placeholder - we'll enhance with real 1h move later
@@ -149,74 +173,67 @@ if "username" not in st.session_state or not st.session_state.username:
     st.stop()
 
 username = st.session_state.username
-DATA_DIR = f"data/{username}/"
-LATEST_FILE = f"{DATA_DIR}{username}_latest.json"
-HISTORY_DIR = f"{DATA_DIR}{username}_history/"
+PATHS = store.migrate_layout(username)   # sharded paths; copies a flat data/<username>/ over on first use
+DATA_DIR = PATHS["dir"]
+LATEST_FILE = PATHS["latest"]
+HISTORY_DIR = PATHS["history"]
 os.makedirs(DATA_DIR, exist_ok=True)
 os.makedirs(HISTORY_DIR, exist_ok=True)
+STORE = store.shared_store(PATHS, st.secrets.get("STORAGE_BACKEND", "json"))   # "json" or "sqlite"; one per user per process
+store.start_background_compaction(PATHS)
+# Keeps every user's tickers (from the cross-user index) warm, so renders read prices from memory
+market_data.start_background_refresh(MARKET, store.tracked_tickers)
 
 # === LOAD / SAVE / VERSIONING ===
-def save_version(data, is_session_start=False):
-    timestamp = datetime.now().strftime("%Y-%m-%d_%H%M%S")
-    version_file = f"{HISTORY_DIR}{timestamp}.json"
-    with open(version_file, "w") as f:
-        json.dump(data, f, indent=2)
-    
-    with open(LATEST_FILE, "w") as f:
-        json.dump(data, f, indent=2)
-    
+def save_version(data, is_session_start=False, replaces=None):
+    """Full checkpoint — used for session starts and restores; edits go through record_event.
+    A restore passes `replaces`, the version it overwrites, so it cannot clobber a newer save."""
+    try:
+        timestamp = STORE.checkpoint(data, base_seq=replaces)
+    except store.ConflictError as e:
+        if is_session_start:
+            return   # another tab saved first; its state is already the latest
+        report_conflict(e)
     if is_session_start:
         st.session_state.last_session_start = timestamp
 
-def migrate_legacy_options(data):
-    """Migrate old single-option-per-ticker fields to the new multi-option open_options list"""
-    if "open_options" not in data:
-        data["open_options"] = []
-    migrated = False
-    etfs = data.get("etfs", {})
-    for ticker, etf in list(etfs.items()):
-        contracts = int(etf.get("contracts_sold", 0))
-        if contracts > 0 and etf.get("current_expiry"):
-            legacy_opt = {
-                "id": f"legacy_{ticker}_{datetime.now().strftime('%Y%m%d_%H%M%S')}",
-                "ticker": ticker,
-                "contracts": contracts,
-                "strike": float(etf.get("current_strike", 0.0)),
-                "expiry": etf.get("current_expiry", ""),
-                "sold_date": etf.get("sold_date", ""),
-                "premium_per": float(etf.get("premium_per", 0.0))
-            }
-            data["open_options"].append(legacy_opt)
-            # Clear legacy fields from etf
-            etf["contracts_sold"] = 0
-            etf["premium_per"] = 0.0
-            etf["sold_date"] = ""
-            etf["current_strike"] = 0.0
-            etf["current_expiry"] = ""
-            migrated = True
-    if migrated:
-        st.info("✅ Legacy single-option data migrated to support **multiple options per ticker**.")
-    return data
+def record_event(op, **fields):
+    """Stage one mutation; everything staged in this run is written once by commit_and_rerun"""
+    UOW.record(op, **fields)
+
+def report_conflict(e):
+    STORE.forget()
+    st.error(f"⚠️ Not saved — {e}. Reload to see the latest data, then redo the change.")
+    st.button("🔄 Reload latest data")
+    st.stop()
+
+def commit_changes():
+    """Saves are compare-and-swap: changes that commute with another tab's save are rebased onto it"""
+    try:
+        UOW.commit()
+    except store.ConflictError as e:
+        report_conflict(e)
+
+def commit_and_rerun():
+    commit_changes()
+    st.rerun()
 
 def load_latest():
-    if os.path.exists(LATEST_FILE):
+    if os.path.exists(LATEST_FILE) or os.path.exists(PATHS["db"]):
         try:
-            with open(LATEST_FILE, "r") as f:
-                data = json.load(f)
-                # Backward compatibility for etfs
-                for ticker in data.get("etfs", {}):
-                    etf = data["etfs"][ticker]
-                    etf.setdefault("premium_per", 0.0)
-                    etf.setdefault("sold_date", "")
-                    etf.setdefault("current_strike", 0.0)
-                    etf.setdefault("current_expiry", "")
-                    etf.setdefault("contracts_sold", 0)
-                data.setdefault("cash_balance", 0.0)
-                data.setdefault("open_options", [])
-                data = migrate_legacy_options(data)
+            # Parsed + schema-upgraded state is reused across reruns until the files change
+            data = STORE.cached_load()
+            if STORE.upgraded:
+                st.info(f"✅ Saved data upgraded to schema v{store.SCHEMA_VERSION} (multiple options per ticker supported).")
+            for action in STORE.recovered:
+                st.warning(f"🛠️ Recovery: {action}")
+            if data is not None:
                 return data
-        except:
-            pass
+        except store.StateCorruptError as e:
+            # Never fall through to an empty portfolio — the next save would overwrite the real one
+            st.error(f"❌ Saved data for **{username}** is damaged and could not be rebuilt from history: {e}")
+            st.info(f"Your files under `{DATA_DIR}` were left untouched so they can be repaired or replaced from a backup.")
+            st.stop()
     
     # Default structure
     default_etfs = {}
@@ -240,32 +257,19 @@ def load_latest():
         "capital_additions": [],
         "option_trades": [],
         "cash_balance": 0.0,
-        "open_options": []
+        "open_options": [],
+        "schema_version": store.SCHEMA_VERSION
     }
 
 def load_version(filename):
-    path = f"{HISTORY_DIR}{filename}"
-    if os.path.exists(path):
-        try:
-            with open(path, "r") as f:
-                data = json.load(f)
-                # Backward compatibility
-                for ticker in data.get("etfs", {}):
-                    etf = data["etfs"][ticker]
-                    etf.setdefault("premium_per", 0.0)
-                    etf.setdefault("sold_date", "")
-                    etf.setdefault("current_strike", 0.0)
-                    etf.setdefault("current_expiry", "")
-                    etf.setdefault("contracts_sold", 0)
-                data.setdefault("cash_balance", 0.0)
-                data.setdefault("open_options", [])
-                data = migrate_legacy_options(data)
-                return data
-        except:
-            return None
-    return None
+    try:
+        # Upgraded to the current schema on load; compacted versions come from the archive
+        return store.load_snapshot(HISTORY_DIR, filename)
+    except:
+        return None
 
 data = load_latest()
+UOW = store.UnitOfWork(STORE, data)
 etfs = data.get("etfs", {})
 history = data.get("history", [])
 initial_capital = float(data.get("initial_capital", 0.0))
@@ -274,85 +278,30 @@ option_trades = data.get("option_trades", [])
 cash_balance = float(data.get("cash_balance", 0.0))
 open_options = data.get("open_options", [])
 
-margin = 0.0
-if history:
-    last_margin = history[-1].get("margin_debt")
-    if last_margin is not None:
-        try:
-            margin = float(last_margin)
-        except:
-            margin = 0.0
+margin = STORE.last_margin(data)
 
 if "session_snapshotted" not in st.session_state:
     save_version(data, is_session_start=True)
     st.session_state.session_snapshotted = True
 
-# === ROBUST PRICE FETCH (FIXED) ===
-@st.cache_data(ttl=60)  # Reduced TTL for fresher prices
+# === PRICE FETCH ===
 def fetch_prices(tickers_list):
-    """Robust price fetch with multiple fallbacks and retries"""
+    """Last prices from the shared per-symbol quote cache; 0.0 where every source failed"""
     if not tickers_list:
         return {}
-    
-    prices = {}
-    tickers_list = list(dict.fromkeys(tickers_list))  # remove duplicates
-    
-    # Attempt 1: Bulk Tickers (fastest)
-    for attempt in range(3):
-        try:
-            tickers_obj = yf.Tickers(" ".join(tickers_list))
-            for t in tickers_list:
-                try:
-                    info = tickers_obj.tickers[t].info
-                    price = (info.get('currentPrice') or 
-                            info.get('regularMarketPrice') or 
-                            info.get('previousClose') or 0)
-                    prices[t] = round(float(price), 4)
-                except:
-                    prices[t] = 0.0
-            if all(p > 0 for p in prices.values()):
-                return prices
-            break
-        except Exception as e:
-            if attempt == 2:
-                st.warning(f"⚠️ yfinance bulk fetch failed (attempt {attempt+1}/3): {str(e)[:100]}")
-            time.sleep(0.8)  # small backoff
-    
-    # Fallback 1: Individual Ticker.info + fast_info
-    for t in tickers_list:
-        if t in prices and prices[t] > 0:
-            continue
-        for attempt in range(3):
-            try:
-                ticker = yf.Ticker(t)
-                # Try fast_info first (more reliable in recent yfinance)
-                try:
-                    fast_info = ticker.fast_info
-                    price = fast_info.get('lastPrice') or fast_info.get('regularMarketPrice') or 0
-                except:
-                    price = 0
-                if price <= 0:
-                    info = ticker.info
-                    price = (info.get('currentPrice') or 
-                            info.get('regularMarketPrice') or 
-                            info.get('previousClose') or 0)
-                if price <= 0:
-                    # Last resort: 1-day history
-                    hist = ticker.history(period="1d", interval="1m")
-                    if not hist.empty:
-                        price = hist['Close'].iloc[-1]
-                prices[t] = round(float(price), 4)
-                break
-            except Exception as e:
-                if attempt == 2:
-                    prices[t] = 0.0
-                time.sleep(0.6)
-    
+    quotes = MARKET.get_quotes(tickers_list)
+    prices = {t: round(quotes[t].last, 4) if t in quotes else 0.0 for t in dict.fromkeys(tickers_list)}
+
+    # Expired quotes and stragglers that missed the deadline show their last known price
+    stale = [t for t, q in quotes.items() if q.stale]
+    if stale:
+        st.info(f"⏳ Showing last known prices for: **{', '.join(stale)}** (refreshing in the background).")
+
     # Final check - warn user if many prices failed
     zero_prices = [t for t, p in prices.items() if p <= 0]
     if zero_prices:
         st.warning(f"⚠️ Could not fetch current prices for: **{', '.join(zero_prices)}**. Click **🔄 Refresh Prices** below.")
-    
+
     return prices
 
 # === PRICE FETCH CALL ===
@@ -368,11 +317,7 @@ monthly_premium_est = sum(h.get("premium", 0) for h in history[-4:]) if history
 
 # Monthly Average Premium
 current_year = datetime.now().year
-year_history = [h for h in history if pd.to_datetime(h.get("date", "")).year == current_year]
-monthly_premiums = {}
-for h in year_history:
-    month = pd.to_datetime(h.get("date", "")).strftime("%Y-%m")
-    monthly_premiums[month] = monthly_premiums.get(month, 0) + float(h.get("premium", 0))
+monthly_premiums = STORE.monthly_premiums(data, current_year)
 avg_monthly_premium = sum(monthly_premiums.values()) / len(monthly_premiums) if monthly_premiums else 0
 
 # === DASHBOARD ===
@@ -381,8 +326,8 @@ st.success(f"Welcome back, {username}!")
 # NEW: Manual price refresh button (always visible)
 col_refresh, _ = st.columns([1, 6])
 with col_refresh:
-    if st.button("🔄 Refresh Prices", type="primary", help="Force fresh price data from Yahoo Finance"):
-        st.cache_data.clear()
+    if st.button("🔄 Refresh Prices", type="primary", help="Force fresh price data for your tickers"):
+        MARKET.invalidate(list(etfs.keys()))
         st.success("✅ Prices refreshed!")
         time.sleep(0.3)
         st.rerun()
@@ -401,22 +346,16 @@ st.caption(f"**Cash**: ${cash_balance:,.2f} | Recent Premium Est: ${monthly_prem
 
 # === HISTORY & RESTORE SECTION ===
 with st.expander(f"🕒 Session History & Restore ({username})", expanded=False):
-    versions = sorted(glob.glob(f"{HISTORY_DIR}*.json"), reverse=True)
+    versions = store.read_manifest(HISTORY_DIR, limit=30)   # newest partitions only, no snapshot parsing
     if versions:
-        st.write(f"Found {len(versions)} saved versions (showing last 30)")
+        st.write(f"Showing the newest {len(versions)} saved versions")
         display_options = []
-        for f in versions[:30]:
-            basename = os.path.basename(f)
-            dt_str = basename.replace(".json", "").replace("_", " ")
-            try:
-                data_temp = load_version(basename)
-                last_entry = data_temp["history"][-1] if data_temp["history"] else {}
-                note = last_entry.get("note", "")
-                if note:
-                    dt_str += f" – {note[:40]}..."
-            except:
-                pass
-            display_options.append((basename, dt_str))
+        for entry in versions:
+            dt_str = entry["ts"].replace("_", " ")
+            note = entry.get("note", "")
+            if note:
+                dt_str += f" – {note[:40]}..."
+            display_options.append((entry["file"], dt_str))
         
         selected_display = st.selectbox(
             "Select version to preview / restore",
@@ -426,13 +365,37 @@ with st.expander(f"🕒 Session History & Restore ({username})", expanded=False)
         )
         
         selected_file = selected_display[0] if selected_display else None
-        
+
+        if selected_file and selected_file != versions[0]["file"]:
+            diff = STORE.diff_versions(selected_file, versions[0]["file"])
+            if diff:
+                st.markdown("**Changes from this version to the newest one**")
+                for change in diff["etfs"]:
+                    fields = ", ".join(f"{f}: {a} → {b}" for f, (a, b) in change["fields"].items())
+                    st.write(f"- {change['ticker']} {change['change']}" + (f" ({fields})" if fields else ""))
+                for opt in diff["options_added"]:
+                    st.write(f"- Opened {opt.get('contracts')}x {opt.get('ticker', '')} ${opt.get('strike', '')} exp {opt.get('expiry', '')}")
+                for opt in diff["options_removed"]:
+                    st.write(f"- Closed {opt.get('ticker', '')} ${opt.get('strike', '')} exp {opt.get('expiry', '')}")
+                for old, new in diff["options_changed"]:
+                    st.write(f"- Updated {new.get('ticker', '')} ${new.get('strike', '')} (contracts {old.get('contracts')} → {new.get('contracts')})")
+                for key, (a, b) in diff["scalars"].items():
+                    st.write(f"- {key.replace('_', ' ').title()}: {a} → {b}")
+                if diff["history_rewritten"]:
+                    st.write("- History was rewritten (restore or reset in between)")
+                elif diff["history_added"]:
+                    st.write(f"- {len(diff['history_added'])} history entries added")
+                if diff["ops"]:
+                    st.caption("Journal: " + ", ".join(f"{op} ×{n}" for op, n in diff["ops"].items()))
+                if not any((diff["etfs"], diff["options_added"], diff["options_removed"], diff["options_changed"],
+                            diff["scalars"], diff["history_added"], diff["history_rewritten"])):
+                    st.caption("No differences.")
+
         if st.button("Load & Replace Current State") and selected_file:
             old_data = load_version(selected_file)
             if old_data:
-                with open(LATEST_FILE, "w") as f:
-                    json.dump(old_data, f, indent=2)
-                st.cache_data.clear()   # NEW: clear price cache after restore
+                old_data["_seq"] = data.get("_seq", 0) + 1   # a restore is a new version of its own
+                save_version(old_data, replaces=data.get("_seq", 0))
                 st.success(f"Restored version from {selected_display[1]}")
                 st.rerun()
     else:
@@ -444,55 +407,90 @@ with st.expander(f"🕒 Session History & Restore ({username})", expanded=False)
     col_dl, col_ul = st.columns(2)
 
     with col_dl:
+        backup_history = st.checkbox("Include saved history snapshots (for moving the whole account)", value=False)
         if st.button("⬇️ Download Full Backup Now"):
-            backup = {
-                "etfs": etfs,
-                "history": history,
-                "initial_capital": initial_capital,
-                "capital_additions": capital_additions,
-                "option_trades": option_trades,
-                "cash_balance": cash_balance,
-                "open_options": open_options,
-                "timestamp": datetime.now().isoformat(),
-                "username": username
-            }
-            json_str = json.dumps(backup, indent=2)
-            st.download_button(
-                label="Download wealthgrowth_backup.json",
-                data=json_str,
-                file_name=f"wealthgrowth_{username}_{datetime.now().strftime('%Y%m%d_%H%M')}.json",
-                mime="application/json"
-            )
+            # Streamed to disk line by line; only the compressed file is handed to the browser
+            backup_path = store.export_backup(STORE, data, username, f"{DATA_DIR}{username}_backup.ndjson.gz",
+                                              include_history=backup_history)
+            with open(backup_path, "rb") as f:
+                st.download_button(
+                    label="Download wealthgrowth_backup.ndjson.gz",
+                    data=f,
+                    file_name=f"wealthgrowth_{username}_{datetime.now().strftime('%Y%m%d_%H%M')}.ndjson.gz",
+                    mime="application/gzip"
+                )
 
     with col_ul:
         st.write("Upload backup from old version")
-        uploaded = st.file_uploader("Choose backup JSON file", type=["json"])
+        uploaded = st.file_uploader("Choose backup file", type=["json", "gz"])
         if uploaded is not None:
-            try:
-                backup_data = json.load(uploaded)
-                backup_data.setdefault("cash_balance", 0.0)
-                backup_data.setdefault("open_options", [])
-                for ticker in backup_data.get("etfs", {}):
-                    etf = backup_data["etfs"][ticker]
-                    etf.setdefault("premium_per", 0.0)
-                    etf.setdefault("sold_date", "")
-                    etf.setdefault("current_strike", 0.0)
-                    etf.setdefault("current_expiry", "")
-                    etf.setdefault("contracts_sold", 0)
-                if st.button("Restore from this file (overwrites current data)", type="primary"):
-                    with open(LATEST_FILE, "w") as f:
-                        json.dump(backup_data, f, indent=2)
-                    st.cache_data.clear()   # NEW: clear price cache after restore
-                    st.success("Backup restored! Refreshing page...")
+            if st.button("Restore from this file (overwrites current data)", type="primary"):
+                try:
+                    # A brand-new account can also take over the backup's snapshots and journal
+                    backup_data, imported = store.import_backup(STORE, uploaded, merge_history=data.get("_seq", 0) == 0)
+                except (store.BackupError, ValueError, OSError) as e:
+                    st.error(f"Error reading file: {str(e)}")
+                else:
+                    backup_data["_seq"] = max(backup_data.get("_seq", 0), data.get("_seq", 0)) + 1
+                    save_version(backup_data, replaces=data.get("_seq", 0))
+                    st.success(f"Backup restored ({imported} history snapshots imported)! Refreshing page...")
                     st.rerun()
-            except Exception as e:
-                st.error(f"Error reading file: {str(e)}")
+
+# === TIME TRAVEL: COMPARE NOW VS. A PAST DATE ===
+with st.expander("⏳ Compare Now vs. a Past Date", expanded=False):
+    col_td, col_tt, col_tb = st.columns([2, 2, 1])
+    with col_td:
+        tt_date = st.date_input("Date", value=datetime.now().date() - timedelta(days=30), key="tt_date")
+    with col_tt:
+        tt_time = st.time_input("Time", value=datetime.strptime("16:00", "%H:%M").time(), key="tt_time")
+    with col_tb:
+        st.write("")
+        if st.button("Reconstruct", use_container_width=True):
+            st.session_state.tt_when = datetime.combine(tt_date, tt_time)
+
+    if "tt_when" in st.session_state:
+        tt_when = st.session_state.tt_when
+        # Reconstructed once per chosen time, not on every rerun
+        if st.session_state.get("tt_past", (None, None))[0] != tt_when:
+            st.session_state.tt_past = (tt_when, STORE.state_at(tt_when))
+        past = st.session_state.tt_past[1]
+        if past is None:
+            st.info(f"No saved state at or before {tt_when:%Y-%m-%d %H:%M}.")
+        else:
+            past_etfs = past.get("etfs", {})
+            past_contracts = {}
+            for opt in past.get("open_options", []):
+                past_contracts[opt["ticker"]] = past_contracts.get(opt["ticker"], 0) + opt["contracts"]
+            now_contracts = STORE.open_contracts_per_ticker(data)
+            tt_rows = []
+            for t in sorted(set(etfs) | set(past_etfs)):
+                then_sh = float(past_etfs.get(t, {}).get("shares", 0))
+                now_sh = float(etfs.get(t, {}).get("shares", 0))
+                tt_rows.append({
+                    "Ticker": t,
+                    f"Shares {tt_when:%Y-%m-%d}": f"{then_sh:.4f}",
+                    "Shares Now": f"{now_sh:.4f}",
+                    "Δ Shares": f"{now_sh - then_sh:+.4f}",
+                    f"Basis {tt_when:%Y-%m-%d}": f"${float(past_etfs.get(t, {}).get('cost_basis', 0)):.2f}",
+                    "Basis Now": f"${float(etfs.get(t, {}).get('cost_basis', 0)):.2f}",
+                    f"Open Calls {tt_when:%Y-%m-%d}": past_contracts.get(t, 0),
+                    "Open Calls Now": now_contracts.get(t, 0),
+                })
+            st.dataframe(pd.DataFrame(tt_rows), use_container_width=True, hide_index=True)
+
+            past_value = sum(float(d.get("shares", 0)) * prices.get(t, 0) for t, d in past_etfs.items())
+            past_cash = float(past.get("cash_balance", 0.0))
+            past_capital = float(past.get("initial_capital", 0.0)) + sum(a.get("amount", 0) for a in past.get("capital_additions", []))
+            c1, c2, c3 = st.columns(3)
+            c1.metric("Holdings at Today's Prices", f"${gross_value:,.2f}", delta=f"${gross_value - past_value:,.2f}")
+            c2.metric("Cash", f"${cash_balance:,.2f}", delta=f"${cash_balance - past_cash:,.2f}")
+            c3.metric("Total Capital Added", f"${total_capital_added:,.2f}", delta=f"${total_capital_added - past_capital:,.2f}")
+            st.caption(f"State reconstructed from the nearest checkpoint plus journal replay up to {tt_when:%Y-%m-%d %H:%M}.")
 
 # === IMPROVED RESET BUTTON ===
 if st.button(f"🔴 Reset ALL {username}'s Data", type="secondary"):
     if st.button("Confirm — this deletes everything permanently", type="primary"):
-        if os.path.exists(DATA_DIR):
-            shutil.rmtree(DATA_DIR)
+        store.reset_user(PATHS)   # leaves a tombstone so the flat data/<username>/ is not copied back
         st.session_state.clear()
         data = load_latest()
         etfs = data.get("etfs", {})
@@ -503,7 +501,6 @@ if st.button(f"🔴 Reset ALL {username}'s Data", type="secondary"):
         cash_balance = float(data.get("cash_balance", 0.0))
         open_options = data.get("open_options", [])
         margin = 0.0
-        st.cache_data.clear()
         st.success("All data has been completely reset. Refreshing page...")
         st.rerun()
 
@@ -524,24 +521,15 @@ if initial_capital <= 0:
         if submit_btn and initial_input > 0:
             initial_capital = float(initial_input)
             today = datetime.now().strftime("%Y-%m-%d")
-            history.append({
+            record_event("set_initial_capital", amount=initial_capital, history={
                 "date": today,
                 "portfolio_value": 0.0,
                 "margin_debt": 0.0,
                 "premium": 0,
                 "note": "Initial capital set"
             })
-            save_version({
-                "etfs": etfs,
-                "history": history,
-                "initial_capital": initial_capital,
-                "capital_additions": capital_additions,
-                "option_trades": option_trades,
-                "cash_balance": cash_balance,
-                "open_options": open_options
-            })
             st.success(f"Initial capital set to **${initial_capital:,.2f}**")
-            st.rerun()
+            commit_and_rerun()
 else:
     st.info(f"Initial capital: **${initial_capital:,.2f}**")
 
@@ -553,38 +541,29 @@ with st.expander("💰 Capital & Margin"):
         add_amount = st.number_input("Amount ($)", min_value=0.0, step=1000.0, key="add_cap")
         add_date = st.date_input("Date", value=datetime.now().date(), key="add_date_cap")
         if st.button("Add Capital") and add_amount > 0:
-            capital_additions.append({"date": add_date.strftime("%Y-%m-%d"), "amount": float(add_amount)})
-            cash_balance += float(add_amount)
             today = datetime.now().strftime("%Y-%m-%d")
-            history.append({"date": today, "portfolio_value": gross_value, "margin_debt": float(margin), "premium": 0})
-            save_version({"etfs": etfs, "history": history, "initial_capital": initial_capital,
-                          "capital_additions": capital_additions, "option_trades": option_trades,
-                          "cash_balance": cash_balance, "open_options": open_options})
+            record_event("add_capital", date=add_date.strftime("%Y-%m-%d"), amount=float(add_amount),
+                         history={"date": today, "portfolio_value": gross_value, "margin_debt": float(margin), "premium": 0})
             st.success(f"Added ${add_amount:,.2f}")
-            st.rerun()
+            commit_and_rerun()
 
     with col2:
         st.subheader("Margin Debt")
         margin_input = st.number_input("Current Margin ($)", min_value=0.0, value=float(margin), step=100.0, format="%.2f")
         if st.button("Update Margin") and margin_input != margin:
             today = datetime.now().strftime("%Y-%m-%d")
-            history.append({"date": today, "portfolio_value": gross_value, "margin_debt": float(margin_input), "premium": 0})
-            save_version({"etfs": etfs, "history": history, "initial_capital": initial_capital,
-                          "capital_additions": capital_additions, "option_trades": option_trades,
-                          "cash_balance": cash_balance, "open_options": open_options})
+            record_event("margin", history={"date": today, "portfolio_value": gross_value, "margin_debt": float(margin_input), "premium": 0})
             st.success("Margin updated")
-            st.rerun()
+            commit_and_rerun()
 
     with col3:
         st.subheader("💵 Cash Balance")
         cash_input = st.number_input("Current Cash ($)", min_value=0.0, value=float(cash_balance), step=100.0, format="%.2f")
         if st.button("Update Cash"):
             cash_balance = float(cash_input)
-            save_version({"etfs": etfs, "history": history, "initial_capital": initial_capital,
-                          "capital_additions": capital_additions, "option_trades": option_trades,
-                          "cash_balance": cash_balance, "open_options": open_options})
+            record_event("set_cash", amount=cash_balance)
             st.success(f"Cash updated to ${cash_balance:,.2f}")
-            st.rerun()
+            commit_and_rerun()
 
 # === MANAGE TICKERS & ADD NEW ===
 with st.expander("📈 Manage Tickers & Rebalance", expanded=True):
@@ -597,11 +576,12 @@ with st.expander("📈 Manage Tickers & Rebalance", expanded=True):
             if new_ticker and new_ticker not in etfs:
                 new_target = 0.05 if new_ticker == "IBIT" else 0.005
                 current_total = sum(d.get("target_pct", 0) for d in etfs.values())
+                new_targets = {}
                 if current_total > 0:
                     scale_factor = (1.0 - new_target) / current_total
                     for t in etfs:
-                        etfs[t]["target_pct"] *= scale_factor
-                etfs[new_ticker] = {
+                        new_targets[t] = etfs[t].get("target_pct", 0) * scale_factor
+                record_event("add_ticker", ticker=new_ticker, targets=new_targets, record={
                     "shares": 0.0,
                     "cost_basis": 0.0,
                     "target_pct": new_target,
@@ -611,18 +591,9 @@ with st.expander("📈 Manage Tickers & Rebalance", expanded=True):
                     "sold_date": "",
                     "current_strike": 0.0,
                     "current_expiry": ""
-                }
-                save_version({
-                    "etfs": etfs,
-                    "history": history,
-                    "initial_capital": initial_capital,
-                    "capital_additions": capital_additions,
-                    "option_trades": option_trades,
-                    "cash_balance": cash_balance,
-                    "open_options": open_options
                 })
                 st.success(f"Added **{new_ticker}** — targets rebalanced to 100%")
-                st.rerun()
+                commit_and_rerun()
             else:
                 st.warning("Ticker already exists or input invalid")
 
@@ -650,14 +621,9 @@ with st.expander("🛡️ Manage Options Positions (Multiple Strikes / Expiries
                 "sold_date": sold_date_new.strftime("%Y-%m-%d"),
                 "premium_per": float(premium_new)
             }
-            open_options.append(new_opt)
-            save_version({
-                "etfs": etfs, "history": history, "initial_capital": initial_capital,
-                "capital_additions": capital_additions, "option_trades": option_trades,
-                "cash_balance": cash_balance, "open_options": open_options
-            })
+            record_event("add_option", option=new_opt)
             st.success(f"✅ Added **{contracts_new} contracts** of {opt_ticker} @ ${strike_new} exp {expiry_new.strftime('%Y-%m-%d')}")
-            st.rerun()
+            commit_and_rerun()
         else:
             st.warning("Contracts and strike price are required.")
 
@@ -725,44 +691,29 @@ with st.expander("🛡️ Manage Options Positions (Multiple Strikes / Expiries
                 edit_expiry = st.date_input("Expiry Date", datetime.strptime(pos["expiry"], "%Y-%m-%d").date(), key=f"edit_e_{selected_label_idx}")
             
             if st.button("💾 Update Position", type="primary"):
-                open_options[selected_label_idx].update({
+                record_event("update_option", id=pos.get("id"), index=selected_label_idx, fields={
                     "contracts": int(edit_contracts),
                     "strike": float(edit_strike),
                     "premium_per": float(edit_premium),
                     "sold_date": edit_sold_date.strftime("%Y-%m-%d"),
                     "expiry": edit_expiry.strftime("%Y-%m-%d")
                 })
-                save_version({
-                    "etfs": etfs, "history": history, "initial_capital": initial_capital,
-                    "capital_additions": capital_additions, "option_trades": option_trades,
-                    "cash_balance": cash_balance, "open_options": open_options
-                })
                 st.success("Position updated successfully")
-                st.rerun()
+                commit_and_rerun()
             
             st.markdown("**🔴 Close (Sell Back) Position**")
             close_contracts = st.number_input("Contracts to close", min_value=1, max_value=pos["contracts"], value=pos["contracts"], key=f"close_c_{selected_label_idx}")
             if st.button("Close Position (Partial or Full)", type="secondary"):
-                if close_contracts >= pos["contracts"]:
-                    del open_options[selected_label_idx]
-                else:
-                    open_options[selected_label_idx]["contracts"] -= close_contracts
-                save_version({
-                    "etfs": etfs, "history": history, "initial_capital": initial_capital,
-                    "capital_additions": capital_additions, "option_trades": option_trades,
-                    "cash_balance": cash_balance, "open_options": open_options
-                })
+                record_event("close_option", id=pos.get("id"), index=selected_label_idx, contracts=int(close_contracts))
                 st.success(f"✅ Closed {close_contracts} contract(s)")
-                st.rerun()
+                commit_and_rerun()
     else:
         st.info("No open option positions yet. Use the **Add New Option Position** form above.")
 
 # === CURRENT HOLDINGS TABLE ===
 st.subheader("Current Holdings")
 
-open_contracts_per_ticker = {}
-for opt in open_options:
-    open_contracts_per_ticker[opt["ticker"]] = open_contracts_per_ticker.get(opt["ticker"], 0) + opt["contracts"]
+open_contracts_per_ticker = STORE.open_contracts_per_ticker(data)
 
 rows = []
 total_val = gross_value if gross_value > 0 else 1.0
@@ -813,11 +764,12 @@ st.dataframe(
     hide_index=True
 )
 
-# === REMAINING SECTIONS (unchanged except save_version calls) ===
+# === REMAINING SECTIONS (unchanged except record_event calls) ===
 # (Premium Reinvestment, Monthly Chart, Manual Updates, Growth Chart)
 
 st.subheader("💡 Premium Reinvestment Suggestion")
-if history and sum(h.get("premium", 0) for h in history) > 0:
+hist_cols = STORE.history_columns(data) if history else None   # None if the column files can't be rebuilt
+if hist_cols is not None and hist_cols["premium"].sum() > 0:
     total_value = gross_value + cash_balance
     current_alloc = {}
     for t in etfs:
@@ -844,13 +796,11 @@ else:
     st.info("Record some premium income to see personalized reinvestment suggestions.")
 
 st.subheader("📅 Monthly Premium Income vs $100K Goal")
-if history:
-    df_hist = pd.DataFrame(history)
-    df_hist["date"] = pd.to_datetime(df_hist["date"], errors="coerce")
-    df_hist = df_hist.dropna(subset=["date"])
-    df_hist["month"] = df_hist["date"].dt.strftime("%Y-%m")
-    monthly = df_hist.groupby("month")["premium"].sum().reset_index()
-    monthly = monthly.sort_values("month")
+hist_cols = STORE.history_columns(data) if history else None
+if hist_cols is not None:
+    # Vectorized over the memory-mapped history columns instead of a DataFrame of dicts
+    months, totals = store.monthly_totals(hist_cols, "premium")
+    monthly = pd.DataFrame({"month": months, "premium": totals})
     
     fig_bar = go.Figure()
     fig_bar.add_trace(go.Bar(
@@ -879,17 +829,10 @@ with st.expander("📊 Manual Updates"):
         pr = st.number_input("Avg Price", 0.01, step=0.01)
         if st.button("Submit Buy"):
             if sh > 0 and pr > 0:
-                old = etfs[tk]
-                new_s = float(old["shares"]) + float(sh)
-                new_b = (float(old["shares"]) * float(old["cost_basis"]) + float(sh) * float(pr)) / new_s if new_s > 0 else float(pr)
-                etfs[tk]["shares"] = new_s
-                etfs[tk]["cost_basis"] = new_b
-                history.append({"date": datetime.now().strftime("%Y-%m-%d"), "portfolio_value": gross_value, "margin_debt": float(margin), "premium": 0})
-                save_version({"etfs": etfs, "history": history, "initial_capital": initial_capital,
-                              "capital_additions": capital_additions, "option_trades": option_trades,
-                              "cash_balance": cash_balance, "open_options": open_options})
+                record_event("buy", ticker=tk, shares=float(sh), price=float(pr),
+                             history={"date": datetime.now().strftime("%Y-%m-%d"), "portfolio_value": gross_value, "margin_debt": float(margin), "premium": 0})
                 st.success("Purchase added")
-                st.rerun()
+                commit_and_rerun()
 
     with col_r:
         st.subheader("Sell / Reduce Shares")
@@ -902,33 +845,53 @@ with st.expander("📊 Manual Updates"):
                 if sh_sell > current_shares:
                     st.error(f"Cannot sell more ({sh_sell:.4f}) than owned ({current_shares:.4f})")
                 else:
-                    new_shares = current_shares - float(sh_sell)
-                    etfs[tk_sell]["shares"] = new_shares
-                    if new_shares <= 0:
-                        etfs[tk_sell]["cost_basis"] = 0.0
-                    history.append({"date": datetime.now().strftime("%Y-%m-%d"), "portfolio_value": gross_value, "margin_debt": float(margin), "premium": 0})
-                    save_version({"etfs": etfs, "history": history, "initial_capital": initial_capital,
-                                  "capital_additions": capital_additions, "option_trades": option_trades,
-                                  "cash_balance": cash_balance, "open_options": open_options})
+                    record_event("sell", ticker=tk_sell, shares=float(sh_sell),
+                                 history={"date": datetime.now().strftime("%Y-%m-%d"), "portfolio_value": gross_value, "margin_debt": float(margin), "premium": 0})
                     st.success(f"Sold {sh_sell:.4f} shares of {tk_sell}")
-                    st.rerun()
+                    commit_and_rerun()
 
         st.subheader("Record Premium")
         premium = st.number_input("Premium Received ($)", 0.0, step=10.0)
         if st.button("Record") and premium > 0:
             today = datetime.now().strftime("%Y-%m-%d")
-            history.append({"date": today, "premium": float(premium), "portfolio_value": gross_value, "margin_debt": float(margin)})
-            save_version({"etfs": etfs, "history": history, "initial_capital": initial_capital,
-                          "capital_additions": capital_additions, "option_trades": option_trades,
-                          "cash_balance": cash_balance, "open_options": open_options})
+            record_event("premium", history={"date": today, "premium": float(premium), "portfolio_value": gross_value, "margin_debt": float(margin)})
             st.success("Premium recorded")
-            st.rerun()
+            commit_and_rerun()
+
+with st.expander("📥 Bulk Import Broker Activity (CSV)"):
+    st.caption("Schwab, Fidelity, IBKR, Robinhood or E*TRADE activity exports. Rows already imported are skipped, "
+               "so the same file can be uploaded again safely.")
+    if "import_summary" in st.session_state:
+        summary = st.session_state.pop("import_summary")
+        st.success(f"Imported {summary['rows'] - summary['duplicates'] - len(summary['skipped'])} of {summary['rows']} rows: "
+                   f"{summary['buys']} buys, {summary['sells']} sells, {summary['opened']} options opened, "
+                   f"{summary['closed']} closed, {summary['premiums']} premium entries "
+                   f"({summary['duplicates']} already imported)")
+        if summary["skipped"]:
+            st.warning("Skipped:\n" + "\n".join(f"- {line}" for line in summary["skipped"][:50]))
+    activity_file = st.file_uploader("Broker activity CSV", type=["csv"], key="broker_csv")
+    if activity_file is not None and st.button("Import Activity", type="primary"):
+        try:
+            # Every row is staged on the unit of work and written in one commit
+            st.session_state.import_summary = broker_import.import_activity(
+                UOW, activity_file, portfolio_value=gross_value, margin_debt=float(margin))
+        except (ValueError, KeyError) as e:
+            UOW.pending = []
+            STORE.forget()
+            st.error(f"Could not read this file: {e}")
+            st.stop()   # `data` holds the half-staged rows; the next run reloads it
+        else:
+            commit_and_rerun()
 
 st.subheader("Growth Tracker")
-if history:
-    df = pd.DataFrame(history)
-    df["date"] = pd.to_datetime(df["date"])
-    df["net"] = df["portfolio_value"] - df.get("margin_debt", 0.0) - initial_capital
+hist_cols = STORE.history_columns(data) if history else None
+if hist_cols is not None:
+    df = pd.DataFrame({
+        "date": hist_cols["date"],
+        "portfolio_value": hist_cols["portfolio_value"],
+        "margin_debt": hist_cols["margin_debt"],
+    })
+    df["net"] = df["portfolio_value"] - df["margin_debt"] - initial_capital
 
     fig = go.Figure()
     fig.add_trace(go.Scatter(x=df["date"], y=df["portfolio_value"], name="Gross"))
@@ -938,3 +901,6 @@ if history:
     st.plotly_chart(fig, use_container_width=True)
 
 st.caption("✅ **yfinance price fetching is now much more reliable** | Multiple fallbacks + manual Refresh button | Cache cleared automatically after restores")
+
+# Flush anything staged this run that didn't trigger a rerun
+commit_changes()
@@ -1,5 +1,5 @@
 import streamlit as st
-import yfinance as yf
+import market_data
 import pandas as pd
 import plotly.graph_objects as go
 import json
@@ -39,17 +39,10 @@ def save_data(etfs, history):
 etfs, history = load_data()
 
 # === PRICE FETCH ===
-@st.cache_data(ttl=300)
 def fetch_prices():
-    try:
-        data = yf.Tickers("TQQQ SOXL UPRO")
-        prices = {}
-        for t in TARGET_ALLOC:
-            price = data.tickers[t].info.get('currentPrice') or data.tickers[t].info.get('regularMarketPrice')
-            prices[t] = round(price, 4) if price else 0
-        return prices
-    except:
-        return {t: 0 for t in TARGET_ALLOC}
+    provider = market_data.provider_from_secrets(st.secrets)
+    market_data.start_background_refresh(provider)   # keeps this page's tickers warm between reruns
+    return provider.prices(list(TARGET_ALLOC))
 
 prices = fetch_prices()
 
@@ -1,5 +1,6 @@
 import streamlit as st
 import yfinance as yf
+import market_data
 import pandas as pd
 import plotly.graph_objects as go
 import json  # ← THIS WAS MISSING – FIXES THE ERROR
@@ -78,17 +79,10 @@ if st.button(f"🔴 Reset {username}'s Data"):
         st.rerun()
 
 # === PRICE FETCH ===
-@st.cache_data(ttl=300)
 def fetch_prices(tickers_list):
-    try:
-        data = yf.Tickers(" ".join(tickers_list))
-        prices = {}
-        for t in tickers_list:
-            price = data.tickers[t].info.get('currentPrice') or data.tickers[t].info.get('regularMarketPrice')
-            prices[t] = round(price, 4) if price else 0
-        return prices
-    except:
-        return {t: 0 for t in tickers_list}
+    provider = market_data.provider_from_secrets(st.secrets)
+    market_data.start_background_refresh(provider)   # keeps this page's tickers warm between reruns
+    return provider.prices(tickers_list)
 
 current_tickers = list(etfs.keys())
 prices = fetch_prices(current_tickers)
@@ -1,12 +1,11 @@
 import streamlit as st
-import yfinance as yf
+import market_data
 import pandas as pd
 import plotly.graph_objects as go
 from datetime import datetime, timedelta
 from alpaca.trading.client import TradingClient
 from alpaca.trading.requests import MarketOrderRequest
 from alpaca.trading.enums import OrderSide, TimeInForce
-from alpaca.data.historical import StockHistoricalDataClient
 from alpaca.data.requests import StockLatestQuoteRequest
 from alpaca.data.timeframe import TimeFrame
 import math
@@ -41,38 +40,22 @@ option_trades = st.session_state.option_trades
 # === ALPACA PAPER TRADING ===
 if "ALPACA_API_KEY" in st.secrets and "ALPACA_SECRET_KEY" in st.secrets:
     trading_client = TradingClient(st.secrets["ALPACA_API_KEY"], st.secrets["ALPACA_SECRET_KEY"], paper=True)
-    data_client = StockHistoricalDataClient(st.secrets["ALPACA_API_KEY"], st.secrets["ALPACA_SECRET_KEY"])
     try:
         account = trading_client.get_account()
         st.sidebar.success(f"Alpaca Paper: ${float(account.cash):,.2f} cash")
     except Exception as e:
         st.sidebar.error(f"Alpaca error: {e}")
         trading_client = None
-        data_client = None
 else:
     st.sidebar.warning("Add ALPACA keys in Secrets for paper trading")
     trading_client = None
-    data_client = None
 
 # === PRICE FETCH ===
-@st.cache_data(ttl=300)
 def fetch_prices(tickers):
-    if trading_client:
-        try:
-            quotes = data_client.get_latest_quotes(tickers)
-            return {q.symbol: round(q.ask_price or q.bid_price, 4) for q in quotes}
-        except:
-            pass
-    # Fallback
-    try:
-        data = yf.Tickers(" ".join(tickers))
-        prices = {}
-        for t in tickers:
-            price = data.tickers[t].info.get('currentPrice') or data.tickers[t].info.get('regularMarketPrice')
-            prices[t] = round(price, 4) if price else 0
-        return prices
-    except:
-        return {t: 0 for t in tickers}
+    # Alpaca quotes first when keyed, yfinance when Alpaca is down or misses a symbol
+    provider = market_data.provider_from_secrets(st.secrets)
+    market_data.start_background_refresh(provider)   # keeps this page's tickers warm between reruns
+    return provider.prices(tickers)
 
 prices = fetch_prices(list(etfs.keys()))
 
@@ -1,5 +1,5 @@
 import streamlit as st
-import yfinance as yf
+import market_data
 import pandas as pd
 import plotly.graph_objects as go
 from datetime import datetime, timedelta
@@ -45,23 +45,11 @@ else:
     trading_client = None
 
 # === PRICE FETCH ===
-@st.cache_data(ttl=300)
 def fetch_prices(tickers):
-    if trading_client:
-        try:
-            quotes = trading_client.get_latest_quotes(tickers)
-            return {q.symbol: round(q.ask_price or q.bid_price, 4) for q in quotes}
-        except:
-            pass
-    try:
-        data = yf.Tickers(" ".join(tickers))
-        prices = {}
-        for t in tickers:
-            price = data.tickers[t].info.get('currentPrice') or data.tickers[t].info.get('regularMarketPrice')
-            prices[t] = round(price, 4) if price else 0
-        return prices
-    except:
-        return {t: 0 for t in tickers}
+    # Alpaca quotes first when keyed, yfinance when Alpaca is down or misses a symbol
+    provider = market_data.provider_from_secrets(st.secrets)
+    market_data.start_background_refresh(provider)   # keeps this page's tickers warm between reruns
+    return provider.prices(tickers)
 
 prices = fetch_prices(list(etfs.keys()))
 
@@ -1,5 +1,5 @@
 import streamlit as st
-import yfinance as yf
+import market_data
 import pandas as pd
 import plotly.graph_objects as go
 import json
@@ -170,14 +170,10 @@ else:
     st.info(f"Initial capital: **${initial_capital:,.2f}**")
 
 # === PRICE FETCH ===
-@st.cache_data(ttl=300)
 def fetch_prices(tickers_list):
-    try:
-        data = yf.Tickers(" ".join(tickers_list))
-        return {t: round(data.tickers[t].info.get('currentPrice') or data.tickers[t].info.get('regularMarketPrice', 0), 4)
-                for t in tickers_list}
-    except:
-        return {t: 0 for t in tickers_list}
+    provider = market_data.provider_from_secrets(st.secrets)
+    market_data.start_background_refresh(provider)   # keeps this page's tickers warm between reruns
+    return provider.prices(tickers_list)
 
 prices = fetch_prices(list(etfs.keys()))
 
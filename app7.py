@@ -1,12 +1,12 @@
 import streamlit as st
-import yfinance as yf
+import market_data
 import pandas as pd
 import plotly.graph_objects as go
 import json
 import os
 from datetime import datetime, timedelta
-import glob
 import shutil
+import portfolio_store as store
 
 # === CONFIG ===
 st.set_page_config(page_title="Wealth Growth Pro → $1M", layout="wide", initial_sidebar_state="expanded")
@@ -71,11 +71,13 @@ os.makedirs(HISTORY_DIR, exist_ok=True)
 def save_version(data, is_session_start=False):
     timestamp = datetime.now().strftime("%Y-%m-%d_%H%M%S")
     version_file = f"{HISTORY_DIR}{timestamp}.json"
+    payload = json.dumps(data, indent=2)
     with open(version_file, "w") as f:
-        json.dump(data, f, indent=2)
+        f.write(payload)
+    store.append_manifest(HISTORY_DIR, f"{timestamp}.json", data, payload)
     
     with open(LATEST_FILE, "w") as f:
-        json.dump(data, f, indent=2)
+        f.write(payload)
     
     if is_session_start:
         st.session_state.last_session_start = timestamp
@@ -135,22 +137,16 @@ if "session_snapshotted" not in st.session_state:
 
 # === HISTORY & RESTORE SECTION ===
 with st.expander(f"🕒 Session History & Restore ({username})", expanded=False):
-    versions = sorted(glob.glob(f"{HISTORY_DIR}*.json"), reverse=True)
+    versions = store.read_manifest(HISTORY_DIR, limit=30)   # newest partitions only; labels come from the manifest
     if versions:
-        st.write(f"Found {len(versions)} saved versions (showing last 30)")
+        st.write(f"Showing the newest {len(versions)} saved versions")
         display_options = []
-        for f in versions[:30]:
-            basename = os.path.basename(f)
-            dt_str = basename.replace(".json", "").replace("_", " ")
-            try:
-                data_temp = load_version(basename)
-                last_entry = data_temp["history"][-1] if data_temp["history"] else {}
-                note = last_entry.get("note", "")
-                if note:
-                    dt_str += f" – {note[:40]}..."
-            except:
-                pass
-            display_options.append((basename, dt_str))
+        for entry in versions:
+            dt_str = entry["ts"].replace("_", " ")
+            note = entry.get("note", "")
+            if note:
+                dt_str += f" – {note[:40]}..."
+            display_options.append((entry["file"], dt_str))
         
         selected_display = st.selectbox(
             "Select version to preview / restore",
@@ -259,14 +255,10 @@ else:
     st.info(f"Initial capital: **${initial_capital:,.2f}**")
 
 # === PRICE FETCH ===
-@st.cache_data(ttl=300)
 def fetch_prices(tickers_list):
-    try:
-        data = yf.Tickers(" ".join(tickers_list))
-        return {t: round(data.tickers[t].info.get('currentPrice') or data.tickers[t].info.get('regularMarketPrice', 0), 4)
-                for t in tickers_list}
-    except:
-        return {t: 0 for t in tickers_list}
+    provider = market_data.provider_from_secrets(st.secrets)
+    market_data.start_background_refresh(provider)   # keeps this page's tickers warm between reruns
+    return provider.prices(tickers_list)
 
 prices = fetch_prices(list(etfs.keys()))
 
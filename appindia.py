@@ -1,5 +1,6 @@
 import streamlit as st
 import yfinance as yf
+import market_data
 import pandas as pd
 import plotly.graph_objects as go
 import json
@@ -200,18 +201,11 @@ def estimate_premium_potential(ticker):
         return {"score": 10, "suggested_pct": 0.03, "reason": "Data not available"}
 
 # === PRICE FETCH ===
-@st.cache_data(ttl=300)
 def fetch_prices(tickers_list):
-    prices = {}
-    for t in tickers_list:
-        try:
-            symbol = t if t.endswith((".NS", ".BO")) else t + ".NS"
-            data = yf.Ticker(symbol)
-            price = data.info.get('currentPrice') or data.info.get('regularMarketPrice', 0)
-            prices[t] = round(price, 2) if price else 0
-        except:
-            prices[t] = 0
-    return prices
+    # NSE listings only resolve on yfinance; bare tickers get the .NS suffix
+    provider = market_data.shared_provider(suffix=".NS", order=("yfinance",))
+    market_data.start_background_refresh(provider)   # keeps this page's tickers warm between reruns
+    return provider.prices(tickers_list, digits=2)
 
 prices = fetch_prices(list(etfs.keys()))
 
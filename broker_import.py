@@ -0,0 +1,254 @@
+import csv
+import hashlib
+import io
+import re
+from datetime import datetime
+
+# === COLUMN MAPPING ===
+# Header aliases seen in Schwab, Fidelity, IBKR, Robinhood and E*TRADE activity
+# exports; the first alias present wins, so trade dates beat settlement dates.
+COLUMN_ALIASES = {
+    "date": ("date", "trade date", "run date", "activity date", "transaction date", "tradedate", "settlement date"),
+    "action": ("action", "trans code", "transaction type", "activity type", "type", "buy/sell"),
+    "symbol": ("symbol", "instrument", "ticker", "security"),
+    "description": ("description", "security description"),
+    "quantity": ("quantity", "qty", "shares", "units"),
+    "price": ("price", "trade price", "unit price", "tradeprice"),
+    "amount": ("amount", "net amount", "proceeds", "total", "netcash"),
+}
+DATE_FORMATS = ("%m/%d/%Y", "%Y-%m-%d", "%m/%d/%y", "%Y%m%d", "%d-%b-%Y")
+
+# Order matters: option open/close phrases must win over plain buy/sell
+ACTION_PATTERNS = (
+    ("sell_to_open", r"sell to open|sold opening|\bsto\b|sell open"),
+    ("buy_to_close", r"buy to close|bought closing|\bbtc\b|buy close"),
+    ("buy_to_open", r"buy to open|bought opening|\bbto\b"),
+    ("sell_to_close", r"sell to close|sold closing|\bstc\b"),
+    ("expired", r"expire|\boexp\b"),
+    ("assigned", r"assign|exercise|\boasgn\b"),
+    ("buy", r"\bbuy\b|bought|reinvest"),
+    ("sell", r"\bsell\b|sold"),
+)
+
+# OCC / IBKR ("SOXL  250117C00020000"), Fidelity ("-SOXL250117C20"),
+# Schwab ("SOXL 01/17/2025 20.00 C") and Robinhood descriptions ("SOXL 1/17/2025 Call $20.00")
+_OCC = re.compile(r"^-?([A-Z.]+)\s*(\d{6})([CP])(\d{8})$")
+_FIDELITY = re.compile(r"^-([A-Z.]+)(\d{6})([CP])([\d.]+)$")
+_SCHWAB = re.compile(r"^([A-Z.]+)\s+(\d{1,2}/\d{1,2}/\d{4})\s+([\d.]+)\s+([CP])$")
+_ROBINHOOD = re.compile(r"^([A-Z.]+)\s+(\d{1,2}/\d{1,2}/\d{4})\s+(Call|Put)\s+\$?([\d.]+)", re.I)
+
+
+def _header_map(row):
+    """Column index per field if `row` looks like the header line, else None"""
+    names = [re.sub(r"\(.*?\)", "", cell).strip().lower() for cell in row]
+    found = {}
+    for field, aliases in COLUMN_ALIASES.items():
+        for alias in aliases:
+            if alias in names:
+                found[field] = names.index(alias)
+                break
+    if "date" in found and "action" in found and ("symbol" in found or "description" in found):
+        return found
+    return None
+
+
+def _parse_date(text):
+    text = text.strip().split(" as of ")[0]
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(text, fmt).strftime("%Y-%m-%d")
+        except ValueError:
+            continue
+    return None
+
+
+def _parse_number(text):
+    text = (text or "").strip().replace("$", "").replace(",", "")
+    if not text or text == "--":
+        return 0.0
+    if text.startswith("(") and text.endswith(")"):
+        return -float(text[1:-1])
+    return float(text)
+
+
+def parse_option_symbol(symbol, description=""):
+    """(underlying, expiry 'YYYY-MM-DD', 'C'/'P', strike) or None for a non-option row"""
+    symbol = symbol.strip().upper()
+    for pattern in (_OCC, _FIDELITY):
+        m = pattern.match(symbol)
+        if m:
+            strike = float(m.group(4)) / (1000 if pattern is _OCC else 1)
+            return m.group(1), datetime.strptime(m.group(2), "%y%m%d").strftime("%Y-%m-%d"), m.group(3), strike
+    m = _SCHWAB.match(symbol)
+    if m:
+        return m.group(1), datetime.strptime(m.group(2), "%m/%d/%Y").strftime("%Y-%m-%d"), m.group(4), float(m.group(3))
+    m = _ROBINHOOD.match(description.strip())
+    if m:
+        return (m.group(1).upper(), datetime.strptime(m.group(2), "%m/%d/%Y").strftime("%Y-%m-%d"),
+                m.group(3)[0].upper(), float(m.group(4)))
+    return None
+
+
+def classify_action(text):
+    text = text.lower()
+    for kind, pattern in ACTION_PATTERNS:
+        if re.search(pattern, text):
+            return kind
+    return None
+
+
+# === STREAMING PARSE ===
+def iter_broker_rows(fileobj):
+    """Normalized activity rows from a broker CSV, read one line at a time.
+
+    Preamble lines before the header and footer/total rows without a valid
+    date are skipped. Each row carries a natural key (date, action, symbol,
+    quantity, price, amount plus an occurrence counter for identical fills).
+    """
+    text = io.TextIOWrapper(fileobj, encoding="utf-8-sig", newline="") if "b" in getattr(fileobj, "mode", "b") else fileobj
+    columns, seen = None, {}
+    for raw in csv.reader(text):
+        if not any(cell.strip() for cell in raw):
+            continue
+        if columns is None:
+            columns = _header_map(raw)
+            continue
+
+        def cell(field):
+            i = columns.get(field)
+            return raw[i].strip() if i is not None and i < len(raw) else ""
+
+        date = _parse_date(cell("date"))
+        if date is None:
+            continue
+        row = {
+            "date": date,
+            "action_text": cell("action") or cell("description"),
+            "symbol": cell("symbol"),
+            "description": cell("description"),
+            "quantity": abs(_parse_number(cell("quantity"))),
+            "price": abs(_parse_number(cell("price"))),
+            "amount": _parse_number(cell("amount")),
+        }
+        natural = "|".join(str(row[k]) for k in ("date", "action_text", "symbol", "quantity", "price", "amount"))
+        seen[natural] = seen.get(natural, 0) + 1
+        row["key"] = hashlib.sha1(f"{natural}|{seen[natural]}".encode()).hexdigest()[:16]
+        yield row
+    if columns is None:
+        raise ValueError("no activity header found (expected Date, Action and Symbol columns)")
+
+
+# === MAPPING TO EVENTS ===
+def _find_open_option(data, ticker, expiry, strike):
+    for opt in data.get("open_options", []):
+        if opt["ticker"] == ticker and opt["expiry"] == expiry and abs(float(opt["strike"]) - strike) < 1e-6:
+            return opt
+    return None
+
+
+def _history_row(history_values, row, **fields):
+    """Growth-history entry for an imported row; today's portfolio value only fits today's rows"""
+    values = dict(history_values)
+    if row["date"] < datetime.now().strftime("%Y-%m-%d"):
+        values.pop("portfolio_value", None)
+    return dict(values, date=row["date"], **fields)
+
+
+def _stage_row(uow, row, summary, history_values):
+    """Record the events for one row; returns (skip reason, retryable) or None when staged"""
+    data = uow.data
+    kind = classify_action(row["action_text"])
+    option = parse_option_symbol(row["symbol"], row["description"])
+    if kind is None:
+        return "not a trade", False
+
+    if option is None:
+        if kind not in ("buy", "sell"):
+            return "unsupported action", False
+        ticker = row["symbol"].upper()
+        if ticker not in data.get("etfs", {}):
+            return f"{ticker} is not tracked (add the ticker first)", False
+        if row["quantity"] <= 0:
+            return "no quantity", False
+        if kind == "buy":
+            uow.record("buy", ticker=ticker, shares=row["quantity"], price=row["price"], import_key=row["key"])
+            summary["buys"] += 1
+        elif row["quantity"] > float(data["etfs"][ticker].get("shares", 0)) + 1e-9:
+            return f"sells more {ticker} than is held", True
+        else:
+            uow.record("sell", ticker=ticker, shares=row["quantity"], import_key=row["key"])
+            summary["sells"] += 1
+        return None
+
+    ticker, expiry, right, strike = option
+    contracts = int(round(row["quantity"]))
+    if kind in ("buy_to_open", "sell_to_close"):
+        return "long options are not tracked", False
+    # Cash actually received (+) or paid (-) for the contracts
+    cash = row["amount"] or row["price"] * 100 * contracts * (1 if kind == "sell_to_open" else -1)
+    trade = {"date": row["date"], "ticker": ticker, "action": kind, "right": right, "contracts": contracts,
+             "strike": strike, "expiry": expiry, "price": row["price"], "amount": round(cash, 2)}
+
+    if kind == "sell_to_open":
+        uow.record("add_option", option={
+            "id": f"imp_{row['key']}",
+            "ticker": ticker,
+            "contracts": contracts,
+            "strike": strike,
+            "expiry": expiry,
+            "sold_date": row["date"],
+            "premium_per": row["price"],
+        }, history=_history_row(history_values, row, premium=round(cash, 2),
+                                note=f"Imported: sold {contracts} {ticker} {strike:g}{right} {expiry}"))
+        summary["opened"] += 1
+        summary["premiums"] += 1
+    else:
+        pos = _find_open_option(data, ticker, expiry, strike)
+        if pos is None:
+            return f"no open {ticker} {strike:g}{right} {expiry} position", True
+        history = None
+        if kind == "buy_to_close" and cash:
+            history = _history_row(history_values, row, premium=round(cash, 2),
+                                   note=f"Imported: bought back {contracts} {ticker} {strike:g}{right}")
+            summary["premiums"] += 1
+        uow.record("close_option", id=pos.get("id"), index=data["open_options"].index(pos),
+                   contracts=contracts or pos["contracts"], history=history)
+        summary["closed"] += 1
+    uow.record("option_trade", trade=trade, import_key=row["key"])
+    return None
+
+
+def import_activity(uow, fileobj, portfolio_value=0.0, margin_debt=0.0):
+    """Stage every new row of a broker export on `uow`; the caller commits once.
+
+    Share buys/sells update cost basis, sell-to-open opens a position and logs
+    its premium, buy-to-close / expiry / assignment close it. Every option row
+    is also kept in option_trades. Rows are staged oldest first whatever the
+    export's order, so history stays chronological; rows that still depend on
+    a later one (a close dated before its open) are retried at the end.
+    Backdated history rows carry the margin but no portfolio value.
+    Returns a summary of what was staged.
+    """
+    known = set(uow.data.get("import_keys", []))
+    summary = {"rows": 0, "buys": 0, "sells": 0, "opened": 0, "closed": 0, "premiums": 0, "duplicates": 0, "skipped": []}
+    history_values = {"portfolio_value": portfolio_value, "margin_debt": margin_debt}
+    deferred = []
+
+    # Stable sort: same-day rows keep the export's order
+    for row in sorted(iter_broker_rows(fileobj), key=lambda r: r["date"]):
+        summary["rows"] += 1
+        if row["key"] in known:
+            summary["duplicates"] += 1
+            continue
+        known.add(row["key"])
+        skipped = _stage_row(uow, row, summary, history_values)
+        if skipped and skipped[1]:
+            deferred.append(row)
+        elif skipped:
+            summary["skipped"].append(f"{row['date']} {row['action_text'][:30]} {row['symbol']}: {skipped[0]}")
+
+    for row in sorted(deferred, key=lambda r: r["date"]):
+        skipped = _stage_row(uow, row, summary, history_values)
+        if skipped:
+            summary["skipped"].append(f"{row['date']} {row['action_text'][:30]} {row['symbol']}: {skipped[0]}")
+    return summary
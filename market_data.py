@@ -0,0 +1,564 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeout
+from datetime import datetime
+from types import MappingProxyType
+from typing import NamedTuple
+from zoneinfo import ZoneInfo
+
+try:
+    import yfinance as yf
+    from yfinance.data import YfData
+except ImportError:
+    yf = None
+
+try:
+    from alpaca.data.historical import StockHistoricalDataClient
+    from alpaca.data.requests import StockLatestQuoteRequest
+except ImportError:
+    StockHistoricalDataClient = None
+
+try:
+    from polygon import RESTClient
+except ImportError:
+    RESTClient = None
+
+
+class Quote(NamedTuple):
+    """One price observation; `last` is 0.0 when the source had no price"""
+    symbol: str
+    last: float
+    bid: float = 0.0
+    ask: float = 0.0
+    timestamp: float = 0.0  # epoch seconds of the upstream quote (fetch time if unknown)
+    source: str = ""
+    stale: bool = False  # last known value, served because no fresh quote arrived in time
+
+
+class BackendError(Exception):
+    """A backend could not answer at all (auth, network, rate limit)"""
+
+
+def _num(value):
+    try:
+        return float(value or 0.0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _epoch(value, default):
+    """Epoch seconds from a datetime, or from s/ms/ns integers"""
+    if value is None:
+        return default
+    if hasattr(value, "timestamp"):
+        return value.timestamp()
+    value = float(value)
+    while value > 1e11:  # ms / us / ns
+        value /= 1000
+    return value or default
+
+
+# === CONCURRENCY ===
+# Pools are process-wide so the number of upstream calls in flight stays bounded
+# no matter how many sessions render at once. Each backend gets its own
+# BACKEND_WORKERS threads (see MarketDataProvider), so an upstream that hangs
+# without honouring REQUEST_TIMEOUT (yfinance's fast_info/.info, Alpaca) only
+# ties up its own workers, never the calls to healthy backends.
+FETCH_WORKERS = 8       # per-symbol lookups in flight
+REQUEST_TIMEOUT = 5     # seconds for one upstream HTTP call
+BACKEND_TIMEOUT = 4     # seconds one backend gets before the next one is tried
+FETCH_DEADLINE = 8      # seconds a page waits before rendering with stale quotes
+BACKEND_WORKERS = 2     # calls in flight per backend
+FETCH_RETRIES = 3
+YAHOO_QUOTE_URL = "https://query1.finance.yahoo.com/v7/finance/quote"
+YAHOO_QUOTE_BATCH = 50  # symbols per quote request
+_SYMBOL_POOL = ThreadPoolExecutor(FETCH_WORKERS, thread_name_prefix="quote")
+_REFRESH_POOL = ThreadPoolExecutor(2, thread_name_prefix="quote-refresh")
+
+# === QUOTE CACHE ===
+# Quotes are cached per symbol per provider, shared by every session of the
+# process. Past QUOTE_TTL a quote is still served (marked stale) while one
+# background refresh replaces it; past QUOTE_MAX_STALE the caller waits.
+QUOTE_TTL = 60
+QUOTE_MAX_STALE = 900
+MISS_TTL = 15  # seconds before a symbol no backend could price is asked for again
+WATCH_WINDOW = 1800  # seconds a symbol stays in the background refresh set after a page last read it
+
+
+# === BACKENDS ===
+# Each backend answers fetch(symbols, deadline_at) -> {symbol: Quote} for the
+# symbols it could price and raises BackendError when the whole call failed.
+# Symbols are already in vendor form (suffixes applied); deadline_at is the
+# epoch second by which the provider stops waiting.
+class YFinanceBackend:
+    name = "yfinance"
+
+    def __init__(self):
+        if yf is None:
+            raise BackendError("yfinance is not installed")
+
+    def _quote(self, symbol):
+        ticker = yf.Ticker(symbol)
+        now = time.time()
+        try:
+            fast = ticker.fast_info
+            last = _num(fast.get("lastPrice") or fast.get("regularMarketPrice"))
+        except Exception:
+            last = 0.0
+        bid = ask = 0.0
+        if last <= 0:
+            info = ticker.info
+            last = _num(info.get("currentPrice") or info.get("regularMarketPrice") or info.get("previousClose"))
+            bid, ask = _num(info.get("bid")), _num(info.get("ask"))
+        if last <= 0:
+            hist = ticker.history(period="1d", interval="1m", timeout=REQUEST_TIMEOUT)
+            if not hist.empty:
+                last = _num(hist["Close"].iloc[-1])
+                now = _epoch(hist.index[-1].to_pydatetime(), now)
+        return Quote(symbol, round(last, 4), bid, ask, now, self.name)
+
+    def _lookup(self, symbol, deadline_at):
+        """_quote() with retries and backoff, giving up at the deadline"""
+        for attempt in range(FETCH_RETRIES):
+            try:
+                return self._quote(symbol)
+            except Exception:
+                backoff = 0.3 * (attempt + 1)
+                if attempt == FETCH_RETRIES - 1 or time.time() + backoff >= deadline_at:
+                    raise
+                time.sleep(backoff)
+
+    def fetch_batch(self, symbols, deadline_at):
+        """Prices for the whole list from Yahoo's multi-symbol quote endpoint.
+
+        One HTTP request per YAHOO_QUOTE_BATCH symbols, sent through yfinance's
+        shared session so its cookie/crumb handling is reused. Each request is
+        capped by the time left before `deadline_at`.
+        """
+        quotes, now = {}, time.time()
+        wanted = set(symbols)
+        symbols = list(symbols)
+        for i in range(0, len(symbols), YAHOO_QUOTE_BATCH):
+            remaining = deadline_at - time.time()
+            if remaining <= 0:
+                break
+            result = YfData().get_raw_json(YAHOO_QUOTE_URL, timeout=min(REQUEST_TIMEOUT, remaining), params={
+                "symbols": ",".join(symbols[i:i + YAHOO_QUOTE_BATCH]), "formatted": "false"})
+            for item in (result.get("quoteResponse") or {}).get("result") or []:
+                symbol = item.get("symbol")
+                last = _num(item.get("regularMarketPrice") or item.get("postMarketPrice"))
+                if symbol in wanted and last > 0:
+                    quotes[symbol] = Quote(symbol, round(last, 4), _num(item.get("bid")), _num(item.get("ask")),
+                                           _epoch(item.get("regularMarketTime"), now), self.name)
+        return quotes
+
+    def fetch(self, symbols, deadline_at=None):
+        """Bulk quote request(s), then concurrent per-symbol lookups for what they missed"""
+        deadline_at = deadline_at or time.time() + FETCH_DEADLINE
+        try:
+            quotes = self.fetch_batch(symbols, deadline_at)
+            batch_failed = False
+        except Exception:
+            quotes, batch_failed = {}, True
+        missing = [s for s in symbols if s not in quotes]
+        futures = {_SYMBOL_POOL.submit(self._lookup, s, deadline_at): s for s in missing}
+        done, pending = wait(futures, timeout=max(0.0, deadline_at - time.time()))
+        for future in pending:
+            future.cancel()  # stragglers still queued never start
+        errors = 0
+        for future in done:
+            if future.exception() is not None:
+                errors += 1
+            elif future.result().last > 0:
+                quotes[futures[future]] = future.result()
+        if batch_failed and missing and errors == len(missing):
+            raise BackendError("every yfinance lookup failed")
+        return quotes
+
+
+class AlpacaBackend:
+    """Latest NBBO from Alpaca market data (US equities only)"""
+    name = "alpaca"
+
+    def __init__(self, api_key, secret_key):
+        if StockHistoricalDataClient is None:
+            raise BackendError("alpaca-py is not installed")
+        self.client = StockHistoricalDataClient(api_key, secret_key)
+
+    def fetch(self, symbols, deadline_at=None):
+        try:
+            latest = self.client.get_stock_latest_quote(StockLatestQuoteRequest(symbol_or_symbols=list(symbols)))
+        except Exception as e:
+            raise BackendError(str(e)) from e
+        quotes, now = {}, time.time()
+        for symbol, q in latest.items():
+            bid, ask = _num(q.bid_price), _num(q.ask_price)
+            last = (bid + ask) / 2 if bid > 0 and ask > 0 else ask or bid
+            if last > 0:
+                quotes[symbol] = Quote(symbol, round(last, 4), bid, ask, _epoch(q.timestamp, now), self.name)
+        return quotes
+
+
+class PolygonBackend:
+    """Polygon.io stock snapshots; one request for the whole symbol list"""
+    name = "polygon"
+
+    def __init__(self, api_key=None, client=None):
+        if client is None:
+            if RESTClient is None:
+                raise BackendError("polygon-api-client is not installed")
+            client = RESTClient(api_key=api_key, connect_timeout=REQUEST_TIMEOUT, read_timeout=REQUEST_TIMEOUT)
+        self.client = client
+
+    def fetch(self, symbols, deadline_at=None):
+        try:
+            snapshots = self.client.get_snapshot_all("stocks", tickers=list(symbols))
+        except Exception as e:
+            raise BackendError(str(e)) from e
+        quotes, now = {}, time.time()
+        for snap in snapshots or []:
+            trade = getattr(snap, "last_trade", None)
+            quote = getattr(snap, "last_quote", None)
+            day = getattr(snap, "day", None)
+            last = _num(getattr(trade, "price", None)) or _num(getattr(day, "close", None))
+            if last <= 0:
+                continue
+            quotes[snap.ticker] = Quote(
+                snap.ticker, round(last, 4),
+                _num(getattr(quote, "bid_price", None)), _num(getattr(quote, "ask_price", None)),
+                _epoch(getattr(trade, "sip_timestamp", None) or getattr(snap, "updated", None), now),
+                self.name,
+            )
+        return quotes
+
+
+# === PROVIDER ===
+class _Health:
+    """Failure streak and latency for one backend; trips for `cooldown` seconds"""
+
+    def __init__(self):
+        self.failures = 0
+        self.down_until = 0.0
+        self.latency = None  # smoothed seconds per call
+        self.last_error = ""
+
+    def ok(self, elapsed):
+        self.failures = 0
+        self.down_until = 0.0
+        self.latency = elapsed if self.latency is None else 0.7 * self.latency + 0.3 * elapsed
+
+    def failed(self, error, max_failures, cooldown):
+        self.failures += 1
+        self.last_error = str(error)[:200]
+        if self.failures >= max_failures:
+            self.down_until = time.time() + cooldown
+
+
+class MarketDataProvider:
+    """Quotes from backends in priority order, failing over past unhealthy ones.
+
+    A backend that errors `max_failures` times in a row is skipped for
+    `cooldown` seconds. Symbols one backend cannot price are asked of the next.
+    `suffix` is appended to bare symbols for the vendor (".NS" for NSE) and
+    stripped again, so callers always see their own tickers.
+
+    Quotes are cached per symbol (see QUOTE CACHE) and concurrent requests
+    for a symbol share one in-flight upstream fetch. The cache is an immutable
+    snapshot replaced wholesale on every write, so readers never take the lock.
+    """
+
+    def __init__(self, backends, suffix="", keep_suffixes=(".NS", ".BO"), max_failures=3, cooldown=60,
+                 ttl=QUOTE_TTL, max_stale=QUOTE_MAX_STALE):
+        self.backends = list(backends)
+        self.suffix = suffix
+        self.keep_suffixes = tuple(keep_suffixes)
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self._health = {b.name: _Health() for b in self.backends}
+        self._snapshot = MappingProxyType({})  # symbol -> (fetched_at, Quote); swapped, never mutated
+        self._misses = {}    # symbol -> time every backend last came back empty
+        self._inflight = {}  # symbol -> Future of the refresh fetching it
+        self._requested = {}  # symbol -> time a caller last asked for it
+        self._pools = {b.name: ThreadPoolExecutor(BACKEND_WORKERS, thread_name_prefix=f"quote-{b.name}")
+                       for b in self.backends}
+        self._busy = {b.name: 0 for b in self.backends}  # calls submitted and not yet returned
+        self._lock = threading.Lock()
+
+    def _vendor_symbol(self, symbol):
+        if not self.suffix or symbol.endswith(self.keep_suffixes):
+            return symbol
+        return symbol + self.suffix
+
+    def healthy_backends(self):
+        now = time.time()
+        with self._lock:
+            return [b for b in self.backends if self._health[b.name].down_until <= now]
+
+    def health(self):
+        """{backend: {failures, down_for, latency, last_error}} for status displays"""
+        now = time.time()
+        with self._lock:
+            return {name: {"failures": h.failures, "down_for": max(0.0, h.down_until - now),
+                           "latency": h.latency, "last_error": h.last_error}
+                    for name, h in self._health.items()}
+
+    def _call(self, backend, vendor, deadline_at):
+        """Run one backend; results are remembered even if they land after the deadline"""
+        started = time.time()
+        try:
+            found = backend.fetch(list(vendor), deadline_at)
+        except Exception as e:
+            with self._lock:
+                self._health[backend.name].failed(e, self.max_failures, self.cooldown)
+            return {}
+        quotes = {vendor[v]: q._replace(symbol=vendor[v]) for v, q in found.items() if v in vendor}
+        now = time.time()
+        with self._lock:
+            self._health[backend.name].ok(now - started)
+            if quotes:
+                fresh = dict(self._snapshot)
+                fresh.update((s, (now, q)) for s, q in quotes.items())
+                self._snapshot = MappingProxyType(fresh)
+        return quotes
+
+    def _release(self, name):
+        with self._lock:
+            self._busy[name] -= 1
+
+    def _refresh(self, symbols):
+        """Fetch `symbols` through the backends in priority order (runs on _REFRESH_POOL)"""
+        vendor = {self._vendor_symbol(s): s for s in symbols}
+        deadline_at = time.time() + FETCH_DEADLINE
+        quotes = {}
+        try:
+            for backend in self.healthy_backends():
+                missing = {v: s for v, s in vendor.items() if s not in quotes}
+                remaining = deadline_at - time.time()
+                if not missing or remaining <= 0:
+                    break
+                with self._lock:
+                    if self._busy[backend.name] >= BACKEND_WORKERS:
+                        continue   # every worker is still stuck in an abandoned call
+                    self._busy[backend.name] += 1
+                future = self._pools[backend.name].submit(self._call, backend, missing, deadline_at)
+                future.add_done_callback(lambda _, name=backend.name: self._release(name))
+                try:
+                    quotes.update(future.result(timeout=min(remaining, BACKEND_TIMEOUT)))
+                except FutureTimeout:
+                    # The call keeps running and fills the cache when it lands
+                    with self._lock:
+                        self._health[backend.name].failed("timed out", self.max_failures, self.cooldown)
+        finally:
+            now = time.time()
+            with self._lock:
+                for s in symbols:
+                    self._inflight.pop(s, None)
+                    if s not in quotes:
+                        self._misses[s] = now
+        return quotes
+
+    def _revalidate(self, symbols):
+        """Futures fetching `symbols`, starting one refresh for those not already in flight"""
+        with self._lock:
+            todo = [s for s in symbols if s not in self._inflight]
+            if todo:
+                future = _REFRESH_POOL.submit(self._refresh, todo)
+                for s in todo:
+                    self._inflight[s] = future
+            return {self._inflight[s] for s in symbols if s in self._inflight}
+
+    def snapshot(self):
+        """The current read-only {symbol: (fetched_at, Quote)} mapping"""
+        return self._snapshot
+
+    def cached(self, symbols):
+        """Whatever the cache holds for `symbols`, stale-marked past the TTL; never fetches"""
+        snap, now = self._snapshot, time.time()
+        quotes = {}
+        for s in symbols:
+            if s in snap:
+                at, quote = snap[s]
+                quotes[s] = quote._replace(stale=now - at > self.ttl)
+        return quotes
+
+    def get_quotes(self, symbols, deadline=FETCH_DEADLINE):
+        """{symbol: Quote}, from the cache where possible.
+
+        Fresh quotes are returned as is. Quotes past the TTL are returned with
+        stale=True while one background refresh runs. Symbols with nothing
+        usable cached are fetched, waiting at most `deadline` seconds; any that
+        miss it fall back to an older cached quote, or are left out.
+        """
+        symbols = [s for s in dict.fromkeys(symbols) if s]
+        snap, now = self._snapshot, time.time()
+        expired, missing = [], []
+        for s in symbols:
+            self._requested[s] = now
+            at = snap[s][0] if s in snap else None
+            if at is None or now - at > self.max_stale:
+                if now - self._misses.get(s, 0) > MISS_TTL:
+                    missing.append(s)
+            elif now - at > self.ttl:
+                expired.append(s)
+        if expired:
+            self._revalidate(expired)
+        if missing:
+            wait(self._revalidate(missing), timeout=deadline)
+        return self.cached(symbols)
+
+    def invalidate(self, symbols=None):
+        """Drop cached quotes for `symbols` (all when None) so the next read refetches"""
+        with self._lock:
+            if symbols is None:
+                self._snapshot = MappingProxyType({})
+                self._misses.clear()
+                return
+            kept = dict(self._snapshot)
+            for s in symbols:
+                kept.pop(s, None)
+                self._misses.pop(s, None)
+            self._snapshot = MappingProxyType(kept)
+
+    def refresh(self, symbols, deadline=FETCH_DEADLINE):
+        """Refetch `symbols` regardless of age; returns once they land or the deadline passes"""
+        symbols = [s for s in dict.fromkeys(symbols) if s]
+        if symbols:
+            wait(self._revalidate(symbols), timeout=deadline)
+
+    def requested_symbols(self, window=WATCH_WINDOW):
+        """Symbols some caller asked for within the last `window` seconds"""
+        now = time.time()
+        return sorted(s for s, at in self._requested.copy().items() if now - at <= window)
+
+    def get_quote(self, symbol):
+        return self.get_quotes([symbol]).get(symbol)
+
+    def prices(self, symbols, digits=4):
+        """{symbol: last} with 0.0 for anything no backend could price"""
+        quotes = self.get_quotes(symbols)
+        return {s: round(quotes[s].last, digits) if s in quotes else 0.0 for s in dict.fromkeys(symbols)}
+
+
+# === SHARED PROVIDERS ===
+# One provider per configuration per process, so every page and every user of
+# a Streamlit server shares backend health and cached quotes.
+_PROVIDERS = {}
+_PROVIDERS_GUARD = threading.Lock()
+
+
+def shared_provider(polygon_key=None, alpaca_key=None, alpaca_secret=None,
+                    suffix="", order=("alpaca", "polygon", "yfinance")):
+    """Process-wide provider for this set of credentials.
+
+    Every credential is part of the cache key, so a session with its own key
+    (e.g. typed into the sidebar) never gets a provider built from another's.
+    Backends whose credentials or package are missing are left out; yfinance
+    needs neither and is always last resort. NSE tickers (suffix ".NS") only
+    resolve on yfinance, so pass order=("yfinance",) there.
+    """
+    key = (polygon_key, alpaca_key, alpaca_secret, suffix, tuple(order))
+    with _PROVIDERS_GUARD:
+        if key in _PROVIDERS:
+            return _PROVIDERS[key]
+        factories = {
+            "alpaca": lambda: AlpacaBackend(alpaca_key, alpaca_secret) if alpaca_key and alpaca_secret else None,
+            "polygon": lambda: PolygonBackend(polygon_key) if polygon_key else None,
+            "yfinance": YFinanceBackend,
+        }
+        backends = []
+        for name in order:
+            try:
+                backend = factories[name]()
+            except BackendError:
+                backend = None
+            if backend is not None:
+                backends.append(backend)
+        provider = _PROVIDERS[key] = MarketDataProvider(backends, suffix=suffix)
+        return provider
+
+
+def _secret(secrets, name):
+    try:
+        return secrets.get(name)
+    except Exception:  # st.secrets raises when no secrets.toml exists
+        return None
+
+
+def provider_from_secrets(secrets, suffix="", order=("alpaca", "polygon", "yfinance"), polygon_key=None):
+    """shared_provider() configured from st.secrets (or any mapping); `polygon_key`
+    overrides POLYGON_API_KEY, e.g. with a key entered in the sidebar"""
+    return shared_provider(
+        polygon_key=polygon_key or _secret(secrets, "POLYGON_API_KEY"),
+        alpaca_key=_secret(secrets, "ALPACA_API_KEY"),
+        alpaca_secret=_secret(secrets, "ALPACA_SECRET_KEY"),
+        suffix=suffix,
+        order=order,
+    )
+
+
+# === BACKGROUND REFRESHER ===
+# A daemon thread per provider refreshes every tracked ticker on a schedule
+# that follows the US session (no holiday calendar: holidays run at the
+# extended/closed rates). Quotes stay fresh for two refresh periods, so pages
+# read them from the snapshot without fetching. The tracked set is whatever
+# pages read through the provider within WATCH_WINDOW, plus any ticker
+# sources registered with start_background_refresh().
+MARKET_TZ = ZoneInfo("America/New_York")
+REFRESH_INTERVALS = {"regular": 15, "extended": 60, "closed": 900}  # seconds
+_REFRESHERS = {}  # id(provider) -> ticker sources its thread polls
+_REFRESHERS_GUARD = threading.Lock()
+
+
+def market_session(now=None):
+    """'regular' (9:30-16:00 ET), 'extended' (4:00-9:30, 16:00-20:00) or 'closed'"""
+    now = (now or datetime.now(MARKET_TZ)).astimezone(MARKET_TZ)
+    if now.weekday() >= 5:
+        return "closed"
+    minutes = now.hour * 60 + now.minute
+    if 9 * 60 + 30 <= minutes < 16 * 60:
+        return "regular"
+    if 4 * 60 <= minutes < 20 * 60:
+        return "extended"
+    return "closed"
+
+
+def refresh_tracked(provider, sources):
+    """One refresher pass: refetch the union of every source's tickers"""
+    symbols = set()
+    for tickers_fn in list(sources):
+        try:
+            symbols.update(tickers_fn())
+        except Exception:
+            pass
+    provider.refresh(sorted(symbols))
+
+
+def start_background_refresh(provider, tickers_fn=None):
+    """Keep `provider` fresh from a daemon thread (one per provider per process).
+
+    Pages sharing a provider each call this; the thread refreshes what they
+    read recently plus the union of the `tickers_fn` sources they passed.
+    """
+    with _REFRESHERS_GUARD:
+        started = id(provider) in _REFRESHERS
+        sources = _REFRESHERS.setdefault(id(provider), [provider.requested_symbols])
+        if tickers_fn is not None and tickers_fn not in sources:
+            sources.append(tickers_fn)
+    if started:
+        return
+
+    def _loop():
+        while True:
+            interval = REFRESH_INTERVALS[market_session()]
+            provider.ttl = 2 * interval
+            provider.max_stale = max(QUOTE_MAX_STALE, 4 * interval)
+            try:
+                refresh_tracked(provider, sources)
+            except Exception:
+                pass
+            time.sleep(interval)
+
+    threading.Thread(target=_loop, name="quote-refresher", daemon=True).start()
@@ -0,0 +1,2210 @@
+import bisect
+import copy
+import glob
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import sqlite3
+import threading
+import time
+import zipfile
+import zlib
+from collections.abc import Sequence
+from datetime import datetime, timedelta
+from typing import TypedDict
+
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+try:
+    import fcntl
+except ImportError:   # Windows: the in-process lock still serializes one server
+    fcntl = None
+
+# Full checkpoint is written after this many journal entries
+CHECKPOINT_EVERY = 50
+
+
+def _json_default(obj):
+    if isinstance(obj, LazyHistory):
+        return list(obj)
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+# === JSON CODEC ===
+# orjson, then msgspec, then the stdlib: all write compact JSON any of them can
+# read. Bytes differ slightly between them (non-ASCII escaping, float
+# exponents), so checksums record the codec that produced them; content hashes
+# only lose cross-codec dedupe.
+JSON_CODECS = {
+    "stdlib": (lambda obj: json.dumps(obj, separators=(",", ":"), default=_json_default).encode(), json.loads),
+}
+if msgspec is not None:
+    JSON_CODECS["msgspec"] = (msgspec.json.Encoder(enc_hook=_json_default).encode, msgspec.json.Decoder().decode)
+if orjson is not None:
+    JSON_CODECS["orjson"] = (lambda obj: orjson.dumps(obj, default=_json_default), orjson.loads)
+JSON_DECODE_ERRORS = (ValueError,) + ((msgspec.DecodeError,) if msgspec is not None else ())
+JSON_CODEC = next(name for name in ("orjson", "msgspec", "stdlib") if name in JSON_CODECS)
+_dumpb, _loads = JSON_CODECS[JSON_CODEC]
+
+
+def use_json_codec(name):
+    """Switch the process-wide codec (benchmarks, or pinning stdlib for debugging)"""
+    global JSON_CODEC, _dumpb, _loads
+    JSON_CODEC = name
+    _dumpb, _loads = JSON_CODECS[name]
+
+
+def _dumps(obj):
+    """Compact JSON — journal lines and checkpoints never need to be pretty"""
+    return _dumpb(obj).decode()
+
+
+class HistoryRow(TypedDict, total=False):
+    date: str
+    premium: float
+    portfolio_value: float
+    margin_debt: float
+    note: str
+
+
+def decode_history_rows(payload):
+    """History page decoded straight into typed rows when msgspec is available.
+
+    Numbers stored as strings are coerced and unknown keys dropped, so this is
+    for read-only consumers (columns, benchmarks); state loading keeps plain dicts.
+    """
+    if msgspec is not None:
+        try:
+            return msgspec.json.decode(payload, type=list[HistoryRow], strict=False)
+        except msgspec.ValidationError:
+            pass
+    return _loads(payload)
+
+
+def atomic_write(path, payload):
+    """Temp file + fsync + rename, so readers never see a half-written file"""
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb" if isinstance(payload, bytes) else "w") as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+# === SNAPSHOT CODEC ===
+# Checkpoints, snapshot trees and objects are compact JSON, compressed with
+# zstd when available and gzip otherwise. Readers sniff the magic bytes, so
+# legacy pretty-printed .json files stay readable as-is.
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+COMPRESS_MIN_BYTES = 512  # tiny payloads (single etf records) aren't worth a frame
+
+
+def encode_snapshot(obj, codec="auto"):
+    raw = _dumpb(obj)
+    if codec == "json" or (codec == "auto" and len(raw) < COMPRESS_MIN_BYTES):
+        return raw
+    if codec == "zstd" or (codec == "auto" and zstandard is not None):
+        return zstandard.ZstdCompressor(level=3).compress(raw)
+    return gzip.compress(raw, compresslevel=6)
+
+
+def open_stream(fileobj):
+    """Wrap a binary file object so reads return decoded JSON bytes, whatever the codec"""
+    magic = fileobj.read(4)
+    fileobj.seek(0)
+    if magic[:2] == GZIP_MAGIC:
+        return gzip.GzipFile(fileobj=fileobj)
+    if magic == ZSTD_MAGIC:
+        if zstandard is None:
+            raise RuntimeError("zstd-compressed snapshot but the zstandard package is not installed")
+        return zstandard.ZstdDecompressor().stream_reader(fileobj, closefd=True)
+    return fileobj
+
+
+_ZSTD_ERRORS = (zstandard.ZstdError,) if zstandard is not None else ()
+
+
+def read_snapshot(path):
+    with open(path, "rb") as f, open_stream(f) as stream:
+        return _loads(stream.read())
+
+
+def decode_snapshot(payload):
+    if payload[:2] == GZIP_MAGIC:
+        payload = gzip.decompress(payload)
+    elif payload[:4] == ZSTD_MAGIC:
+        if zstandard is None:
+            raise RuntimeError("zstd-compressed snapshot but the zstandard package is not installed")
+        payload = zstandard.ZstdDecompressor().decompressobj().decompress(payload)
+    return _loads(payload)
+
+
+# === PATHS ===
+def user_shard(username):
+    """Two-hex-digit fan-out directory, so data/ never holds one entry per user"""
+    return hashlib.sha1(username.encode()).hexdigest()[:2]
+
+
+def user_paths(username, root="data"):
+    data_dir = f"{root}/{user_shard(username)}/{username}/"
+    return {
+        "user": username,
+        "dir": data_dir,
+        "index": f"{root}/_index.db",
+        # Not <username>_latest.json: the other tracker pages load that name with json.load
+        "latest": f"{data_dir}{username}_state.json",
+        "history": f"{data_dir}{username}_history/",
+        "journal": f"{data_dir}{username}_journal.ndjson",
+        "wal": f"{data_dir}{username}_checkpoint.wal",
+        "lock": f"{data_dir}{username}.lock",
+        "db": f"{data_dir}{username}.db",
+        "db_wal": f"{data_dir}{username}.db-wal",
+        "columns": f"{data_dir}{username}_columns/",
+        "migrated": f"{data_dir}{username}.migrated",
+    }
+
+
+_MIGRATED = set()
+_MIGRATE_LOCK = threading.Lock()
+
+
+def migrate_layout(username, root="data"):
+    """One-off import of the flat data/<username>/ directory into the sharded,
+    month-partitioned layout; cheap no-op once done in this process.
+
+    The flat directory belongs to the other tracker pages (app5-app7,
+    appindia.py), which keep reading and writing it, so entries are copied and
+    never moved: their <username>_latest.json seeds this store's state file and
+    the rest is taken over as-is. The shard keeps a <username>.migrated marker,
+    so nothing is copied twice, not even after reset_user() emptied the shard.
+    """
+    paths = user_paths(username, root)
+    legacy = f"{root}/{username}/"
+    with _MIGRATE_LOCK:
+        if paths["dir"] in _MIGRATED:
+            return paths
+        # Checkpoints written before the state file got its own name
+        shared_name = f"{paths['dir']}{username}_latest.json"
+        if os.path.exists(shared_name) and not os.path.exists(paths["latest"]):
+            os.replace(shared_name, paths["latest"])
+        fresh = not (os.path.exists(paths["migrated"]) or os.path.exists(paths["latest"])
+                     or os.path.exists(paths["db"]))
+        if fresh and os.path.isdir(legacy) and os.path.abspath(legacy) != os.path.abspath(paths["dir"]):
+            os.makedirs(paths["dir"], exist_ok=True)
+            for name in os.listdir(legacy):
+                # Only entries named after the user, so a legacy directory that is also
+                # a shard (a two-hex-digit username) keeps its other users' files
+                owned = name.startswith(username) and name[len(username):][:1] in ("_", ".")
+                if not owned or name.endswith((".lock", ".tmp")):
+                    continue
+                src = f"{legacy}{name}"
+                dst = paths["latest"] if src == f"{legacy}{username}_latest.json" else f"{paths['dir']}{name}"
+                if os.path.exists(dst):
+                    continue
+                if os.path.isdir(src):
+                    shutil.copytree(src, dst)
+                else:
+                    shutil.copy2(src, dst)
+        if os.path.isdir(paths["history"]):
+            migrate_history_layout(paths["history"])
+        if not os.path.exists(paths["migrated"]):
+            os.makedirs(paths["dir"], exist_ok=True)
+            atomic_write(paths["migrated"], _dumps({"migrated": datetime.now().isoformat(timespec="seconds")}))
+        _MIGRATED.add(paths["dir"])
+    return paths
+
+
+def reset_user(paths):
+    """Delete everything this store holds for a user.
+
+    The emptied shard keeps its .migrated marker as a tombstone, so the next
+    migrate_layout() (in this process or after a restart) does not copy the
+    flat data/<username>/ directory back in.
+    """
+    drop_from_index(paths)
+    close_stores(paths)
+    os.makedirs(paths["dir"], exist_ok=True)
+    with _MIGRATE_LOCK, user_lock(paths):
+        _STATE_CACHE.pop(paths["dir"], None)
+        for name in os.listdir(paths["dir"]) if os.path.isdir(paths["dir"]) else []:
+            target = f"{paths['dir']}{name}"
+            if target in (paths["lock"], paths["migrated"]):
+                continue
+            if os.path.isdir(target):
+                shutil.rmtree(target)
+            else:
+                os.remove(target)
+        atomic_write(paths["migrated"], _dumps({"reset": datetime.now().isoformat(timespec="seconds")}))
+
+
+# === EVENT JOURNAL ===
+def _find_option(data, event):
+    for i, opt in enumerate(data.get("open_options", [])):
+        if event.get("id") and opt.get("id") == event["id"]:
+            return i
+    idx = event.get("index")
+    if idx is not None and 0 <= idx < len(data.get("open_options", [])):
+        return idx
+    return None
+
+
+def apply_event(data, event):
+    """Apply one journal entry to an in-memory state dict"""
+    op = event["op"]
+    etfs = data.setdefault("etfs", {})
+
+    if op == "buy":
+        old = etfs[event["ticker"]]
+        shares = float(event["shares"])
+        new_s = float(old.get("shares", 0)) + shares
+        old_cost = float(old.get("shares", 0)) * float(old.get("cost_basis", 0))
+        old["cost_basis"] = (old_cost + shares * float(event["price"])) / new_s if new_s > 0 else float(event["price"])
+        old["shares"] = new_s
+    elif op == "sell":
+        old = etfs[event["ticker"]]
+        new_s = float(old.get("shares", 0)) - float(event["shares"])
+        old["shares"] = new_s
+        if new_s <= 0:
+            old["cost_basis"] = 0.0
+    elif op == "add_ticker":
+        etfs[event["ticker"]] = dict(event["record"])
+        for t, pct in event.get("targets", {}).items():
+            if t in etfs:
+                etfs[t]["target_pct"] = pct
+    elif op == "set_initial_capital":
+        data["initial_capital"] = float(event["amount"])
+    elif op == "add_capital":
+        data.setdefault("capital_additions", []).append({"date": event["date"], "amount": float(event["amount"])})
+        data["cash_balance"] = float(data.get("cash_balance", 0.0)) + float(event["amount"])
+    elif op == "set_cash":
+        data["cash_balance"] = float(event["amount"])
+    elif op == "add_option":
+        data.setdefault("open_options", []).append(dict(event["option"]))
+    elif op == "update_option":
+        idx = _find_option(data, event)
+        if idx is not None:
+            data["open_options"][idx].update(event["fields"])
+    elif op == "close_option":
+        idx = _find_option(data, event)
+        if idx is not None:
+            if int(event["contracts"]) >= int(data["open_options"][idx]["contracts"]):
+                del data["open_options"][idx]
+            else:
+                data["open_options"][idx]["contracts"] -= int(event["contracts"])
+    elif op == "option_trade":
+        data.setdefault("option_trades", []).append(dict(event["trade"]))
+    elif op not in ("margin", "premium"):
+        raise ValueError(f"Unknown journal op: {op}")
+
+    # Natural keys of imported broker rows, so re-importing a file is a no-op
+    if event.get("import_key"):
+        data.setdefault("import_keys", []).append(event["import_key"])
+
+    # Most mutations also log a row in the growth history
+    if event.get("history"):
+        data.setdefault("history", []).append(dict(event["history"]))
+    data["_seq"] = event["seq"]
+    return data
+
+
+def read_journal(path):
+    """Yield journal entries; a torn trailing line from a crash is ignored"""
+    if not os.path.exists(path):
+        return
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield _loads(line)
+            except JSON_DECODE_ERRORS:
+                return
+
+
+def repair_journal(path):
+    """Cut a torn trailing line so the next append starts on a clean line; True if trimmed"""
+    if not os.path.exists(path):
+        return False
+    good = 0
+    with open(path, "rb") as f:
+        for line in f:
+            try:
+                if line.strip():
+                    _loads(line)
+            except JSON_DECODE_ERRORS:
+                break
+            if not line.endswith(b"\n"):
+                break
+            good += len(line)
+    if good == os.path.getsize(path):
+        return False
+    with open(path, "r+b") as f:
+        f.truncate(good)
+        f.flush()
+        os.fsync(f.fileno())
+    return True
+
+
+def new_event(data, op, **fields):
+    event = {"seq": int(data.get("_seq", 0)) + 1, "ts": datetime.now().isoformat(timespec="seconds"), "op": op}
+    event.update(fields)
+    return event
+
+
+def append_events(paths, data, events):
+    """Append already-applied events to the journal in a single write"""
+    with open(paths["journal"], "a") as f:
+        f.write("".join(_dumps(e) + "\n" for e in events))
+        f.flush()
+        os.fsync(f.fileno())
+    if int(data.get("_seq", 0)) - int(data.get("_checkpoint_seq", 0)) >= CHECKPOINT_EVERY:
+        write_checkpoint(paths, data)
+
+
+def record_event(paths, data, op, **fields):
+    """Apply a mutation to `data` and append it to the journal — O(change) per write"""
+    event = new_event(data, op, **fields)
+    apply_event(data, event)
+    append_events(paths, data, [event])
+    return event
+
+
+# === SCHEMA MIGRATIONS ===
+# Each migration upgrades a state dict from version i to i + 1. A file is
+# upgraded once and written back; older snapshots upgrade lazily on load.
+SCHEMA_VERSION = 2
+
+
+def _migrate_v1(data):
+    """Fill in fields added since the first tracker release"""
+    for etf in data.get("etfs", {}).values():
+        etf.setdefault("premium_per", 0.0)
+        etf.setdefault("sold_date", "")
+        etf.setdefault("current_strike", 0.0)
+        etf.setdefault("current_expiry", "")
+        etf.setdefault("contracts_sold", 0)
+    data.setdefault("history", [])
+    data.setdefault("initial_capital", 0.0)
+    data.setdefault("capital_additions", [])
+    data.setdefault("option_trades", [])
+    data.setdefault("cash_balance", 0.0)
+    data.setdefault("open_options", [])
+
+
+def _migrate_v2(data):
+    """Move old single-option-per-ticker fields into the multi-option open_options list"""
+    for ticker, etf in data.get("etfs", {}).items():
+        contracts = int(etf.get("contracts_sold", 0))
+        if contracts > 0 and etf.get("current_expiry"):
+            data["open_options"].append({
+                "id": f"legacy_{ticker}_{datetime.now().strftime('%Y%m%d_%H%M%S')}",
+                "ticker": ticker,
+                "contracts": contracts,
+                "strike": float(etf.get("current_strike", 0.0)),
+                "expiry": etf.get("current_expiry", ""),
+                "sold_date": etf.get("sold_date", ""),
+                "premium_per": float(etf.get("premium_per", 0.0))
+            })
+            # Clear legacy fields from etf
+            etf["contracts_sold"] = 0
+            etf["premium_per"] = 0.0
+            etf["sold_date"] = ""
+            etf["current_strike"] = 0.0
+            etf["current_expiry"] = ""
+
+
+MIGRATIONS = [_migrate_v1, _migrate_v2]
+
+
+def upgrade_state(data):
+    """Run pending migrations in order; returns the list of versions applied"""
+    applied = []
+    for version in range(int(data.get("schema_version", 0)) + 1, SCHEMA_VERSION + 1):
+        MIGRATIONS[version - 1](data)
+        data["schema_version"] = version
+        applied.append(version)
+    return applied
+
+
+# === VERSION MANIFEST ===
+# Snapshots and journal segments live in monthly partitions, <history>/YYYY-MM/,
+# each with its own manifest; listing the newest N versions reads only the
+# newest partitions. A root-level manifest.ndjson is the pre-partition layout.
+MANIFEST_NAME = "manifest.ndjson"
+_PARTITION = re.compile(r"^\d{4}-\d{2}$")
+_HISTORY_NAME = re.compile(r"^\d{4}-\d{2}-\d{2}_\d{6}\.(json|ndjson)$")
+
+
+def history_path(history_dir, name):
+    """Where snapshot or journal segment `name` is written"""
+    return f"{history_dir}{name[:7]}/{name}"
+
+
+def locate_history_file(history_dir, name):
+    """Partitioned path, or the flat one for directories not migrated yet"""
+    path = history_path(history_dir, name)
+    if not os.path.exists(path) and os.path.exists(f"{history_dir}{name}"):
+        return f"{history_dir}{name}"
+    return path
+
+
+def history_partitions(history_dir, reverse=False):
+    try:
+        names = os.listdir(history_dir)
+    except FileNotFoundError:
+        return []
+    return sorted((n for n in names if _PARTITION.match(n)), reverse=reverse)
+
+
+def list_segments(history_dir, after=""):
+    """(name, path) of journal segments named after `after`, oldest first,
+    skipping partitions too old to hold any of them"""
+    found = [(n, f"{history_dir}{n}") for n in os.listdir(history_dir)
+             if n.endswith(".ndjson") and _HISTORY_NAME.match(n) and n > after]
+    for part in history_partitions(history_dir):
+        if part < after[:7]:
+            continue
+        found += [(n, f"{history_dir}{part}/{n}") for n in os.listdir(f"{history_dir}{part}")
+                  if n.endswith(".ndjson") and _HISTORY_NAME.match(n) and n > after]
+    return sorted(found)
+
+
+def migrate_history_layout(history_dir):
+    """Move flat snapshots/segments into monthly partitions and split the root manifest"""
+    with history_lock(history_dir):
+        for name in os.listdir(history_dir):
+            if _HISTORY_NAME.match(name):
+                os.makedirs(f"{history_dir}{name[:7]}", exist_ok=True)
+                if not os.path.exists(history_path(history_dir, name)):
+                    os.replace(f"{history_dir}{name}", history_path(history_dir, name))
+        root = f"{history_dir}{MANIFEST_NAME}"
+        if os.path.exists(root):
+            # Re-running after a crash here only duplicates lines, which readers dedupe
+            _append_manifest_entries(history_dir, list(read_journal(root)))
+            os.remove(root)
+
+
+def manifest_entry(filename, data, payload, size=None):
+    """Small summary of one snapshot so the restore UI never has to parse it"""
+    history = data.get("history", [])
+    last = history[-1] if history else {}
+    try:
+        margin = float(last.get("margin_debt") or 0.0)
+    except (TypeError, ValueError):
+        margin = 0.0
+    return {
+        "file": filename,
+        "ts": filename.replace(".json", ""),
+        "note": last.get("note", ""),
+        "bytes": len(payload) if size is None else size,
+        "hash": hashlib.sha256(payload.encode()).hexdigest(),
+        "seq": data.get("_seq", 0),
+        "metrics": {
+            "tickers": len(data.get("etfs", {})),
+            "history": len(history),
+            "open_options": len(data.get("open_options", [])),
+            "initial_capital": float(data.get("initial_capital", 0.0)),
+            "cash_balance": float(data.get("cash_balance", 0.0)),
+            "margin": margin,
+        },
+    }
+
+
+def _append_manifest_entries(history_dir, entries):
+    by_part = {}
+    for e in entries:
+        by_part.setdefault(e["file"][:7], []).append(e)
+    for part, part_entries in by_part.items():
+        os.makedirs(f"{history_dir}{part}", exist_ok=True)
+        with open(f"{history_dir}{part}/{MANIFEST_NAME}", "a") as f:
+            f.write("".join(_dumps(e) + "\n" for e in part_entries))
+
+
+def _write_manifest_partition(history_dir, part, entries):
+    atomic_write(f"{history_dir}{part}/{MANIFEST_NAME}",
+                 "".join(_dumps(e) + "\n" for e in sorted(entries, key=lambda e: e["file"])))
+
+
+def _has_manifest(history_dir):
+    return os.path.exists(f"{history_dir}{MANIFEST_NAME}") or any(
+        os.path.exists(f"{history_dir}{part}/{MANIFEST_NAME}") for part in history_partitions(history_dir))
+
+
+def append_manifest(history_dir, filename, data, payload, size=None):
+    """Register a freshly written snapshot; older directories are indexed first"""
+    if not _has_manifest(history_dir):
+        rebuild_manifest(history_dir)
+    _append_manifest_entries(history_dir, [manifest_entry(filename, data, payload, size)])
+
+
+def rebuild_manifest(history_dir):
+    """One-off scan for history directories written before the manifest existed"""
+    entries = []
+    paths = glob.glob(f"{history_dir}*.json") + glob.glob(f"{history_dir}[0-9]*-[0-9]*/*.json")
+    for path in sorted(paths, key=os.path.basename):
+        if not _HISTORY_NAME.match(os.path.basename(path)):
+            continue
+        try:
+            with open(path, "rb") as f, open_stream(f) as stream:
+                payload = stream.read().decode()
+            entries.append(manifest_entry(os.path.basename(path), expand_tree(history_dir, _loads(payload)), payload,
+                                          os.path.getsize(path)))
+        except (OSError, *JSON_DECODE_ERRORS):
+            continue
+    by_part = {}
+    for e in entries:
+        by_part.setdefault(e["file"][:7], []).append(e)
+    for part, part_entries in by_part.items():
+        os.makedirs(f"{history_dir}{part}", exist_ok=True)
+        _write_manifest_partition(history_dir, part, part_entries)
+    return entries
+
+
+def read_manifest(history_dir, limit=None):
+    """Manifest entries, newest first, one per snapshot file.
+
+    With `limit`, partitions are read newest first only until enough entries
+    are found, so the restore list costs O(limit) rather than O(all versions).
+    """
+    if not _has_manifest(history_dir):
+        rebuild_manifest(history_dir)
+    by_file = {}
+    for part in history_partitions(history_dir, reverse=True):
+        # A re-written snapshot (same second) keeps only its newest entry
+        for e in read_journal(f"{history_dir}{part}/{MANIFEST_NAME}"):
+            by_file[e["file"]] = e
+        if limit and len(by_file) >= limit:
+            break
+    else:
+        for e in read_journal(f"{history_dir}{MANIFEST_NAME}"):
+            by_file.setdefault(e["file"], e)
+    entries = sorted(by_file.values(), key=lambda e: e["file"], reverse=True)
+    return entries[:limit] if limit else entries
+
+
+def last_manifest_entry(history_dir):
+    """Newest manifest line without reading whole manifests"""
+    candidates = [f"{history_dir}{part}/{MANIFEST_NAME}" for part in history_partitions(history_dir, reverse=True)]
+    for path in candidates + [f"{history_dir}{MANIFEST_NAME}"]:
+        if not os.path.exists(path):
+            continue
+        with open(path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - 8192))
+            lines = f.read().splitlines()
+        for line in reversed(lines):
+            try:
+                return _loads(line)
+            except JSON_DECODE_ERRORS:
+                continue
+    return None
+
+
+# === CONTENT-ADDRESSED SNAPSHOTS ===
+# Snapshots in HISTORY_DIR are small trees of hashes; the sub-documents they
+# point to live once under objects/ no matter how many snapshots share them.
+HISTORY_PAGE = 256  # history entries per stored page
+_TREE_LISTS = ("open_options", "option_trades", "capital_additions")
+
+
+def put_object(history_dir, obj, digest=None):
+    """Store `obj` under its content hash (or a known `digest`, e.g. from a verified backup)"""
+    digest = digest or hashlib.sha256(_dumpb(obj)).hexdigest()
+    path = f"{history_dir}objects/{digest[:2]}/{digest[2:]}.json"
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        atomic_write(path, encode_snapshot(obj))
+    return digest
+
+
+def get_object(history_dir, digest):
+    return read_snapshot(f"{history_dir}objects/{digest[:2]}/{digest[2:]}.json")
+
+
+def get_history_page(history_dir, digest):
+    """History page via the typed decoder (see decode_history_rows)"""
+    with open(f"{history_dir}objects/{digest[:2]}/{digest[2:]}.json", "rb") as f, open_stream(f) as stream:
+        return decode_history_rows(stream.read())
+
+
+class LazyHistory(Sequence):
+    """`history` as full pages stored by hash plus a materialized tail.
+
+    Only the tail is read when state loads; older pages are fetched (and kept)
+    the first time something indexes or iterates into them.
+    """
+
+    def __init__(self, history_dir, page_hashes, tail):
+        self.history_dir = history_dir
+        self.page_hashes = list(page_hashes)  # full, immutable HISTORY_PAGE-sized pages
+        self.tail = list(tail)
+        self._pages = {}
+
+    def _page(self, n):
+        if n not in self._pages:
+            self._pages[n] = get_object(self.history_dir, self.page_hashes[n])
+        return self._pages[n]
+
+    def __len__(self):
+        return len(self.page_hashes) * HISTORY_PAGE + len(self.tail)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("history index out of range")
+        paged = len(self.page_hashes) * HISTORY_PAGE
+        if index >= paged:
+            return self.tail[index - paged]
+        return self._page(index // HISTORY_PAGE)[index % HISTORY_PAGE]
+
+    def __iter__(self):
+        for n in range(len(self.page_hashes)):
+            yield from self._page(n)
+        yield from self.tail
+
+    def __eq__(self, other):
+        return isinstance(other, (list, LazyHistory)) and len(self) == len(other) and list(self) == list(other)
+
+    def __deepcopy__(self, memo):
+        # Pages are immutable, so copies share them and only the tail is duplicated
+        clone = LazyHistory(self.history_dir, self.page_hashes, copy.deepcopy(self.tail, memo))
+        clone._pages = self._pages
+        return clone
+
+    def copy(self):
+        """Shallow copy like list.copy(): pages and rows shared, the tail list is not"""
+        clone = LazyHistory(self.history_dir, self.page_hashes, self.tail)
+        clone._pages = self._pages
+        return clone
+
+    def append(self, entry):
+        self.tail.append(entry)
+
+    def page_refs(self):
+        """Hashes of every page, storing tail pages as needed"""
+        return self.page_hashes + [put_object(self.history_dir, self.tail[i:i + HISTORY_PAGE])
+                                   for i in range(0, len(self.tail), HISTORY_PAGE)]
+
+
+def history_pages(history_dir, history):
+    if isinstance(history, LazyHistory) and history.history_dir == history_dir:
+        return history.page_refs()
+    return [put_object(history_dir, history[i:i + HISTORY_PAGE]) for i in range(0, len(history), HISTORY_PAGE)]
+
+
+def build_tree(history_dir, data):
+    """Store each sub-document once and return the tree that references them"""
+    history = data.get("history", [])
+    tree = {
+        "_tree": 1,
+        "etfs": {t: put_object(history_dir, rec) for t, rec in data.get("etfs", {}).items()},
+        "history": history_pages(history_dir, history),
+        "scalars": {k: v for k, v in data.items() if k not in ("etfs", "history") + _TREE_LISTS},
+    }
+    for key in _TREE_LISTS:
+        if key in data:
+            tree[key] = put_object(history_dir, data[key])
+    return tree
+
+
+def expand_tree(history_dir, tree, lazy=False):
+    """Rebuild full state from a tree; legacy full snapshots pass straight through.
+
+    With `lazy`, history becomes a LazyHistory and only its last page is read.
+    """
+    if not tree.get("_tree"):
+        return tree
+    data = dict(tree["scalars"])
+    data["etfs"] = {t: get_object(history_dir, h) for t, h in tree["etfs"].items()}
+    pages = tree["history"]
+    if lazy and pages:
+        # Every page but the last is full (see history_pages), so the last one is the tail
+        last = get_object(history_dir, pages[-1])
+        full = len(last) == HISTORY_PAGE
+        data["history"] = LazyHistory(history_dir, pages if full else pages[:-1], [] if full else last)
+    else:
+        data["history"] = [row for h in pages for row in get_object(history_dir, h)]
+    for key in _TREE_LISTS:
+        if key in tree:
+            data[key] = get_object(history_dir, tree[key])
+    return data
+
+
+def read_snapshot_tree(history_dir, filename):
+    """Raw snapshot document by file name, falling back to the compacted monthly archive"""
+    path = locate_history_file(history_dir, filename)
+    archive = f"{history_dir}archive/{filename[:7]}.zip"
+    if os.path.exists(path):
+        return read_snapshot(path)
+    if os.path.exists(archive):
+        with zipfile.ZipFile(archive) as zf:
+            if filename in zf.namelist():
+                return decode_snapshot(zf.read(filename))
+    return None
+
+
+def load_snapshot(history_dir, filename, lazy=False):
+    tree = read_snapshot_tree(history_dir, filename)
+    if tree is None:
+        return None
+    data = expand_tree(history_dir, tree, lazy)
+    upgrade_state(data)
+    return data
+
+
+_HISTORY_LOCKS = {}
+
+
+def history_lock(history_dir):
+    """In-process lock serializing snapshot writes against compaction"""
+    return _HISTORY_LOCKS.setdefault(history_dir, threading.RLock())
+
+
+class _UserLock:
+    """Re-entrant per-user lock: an RLock for threads plus flock on <user>.lock for processes"""
+
+    def __init__(self, path):
+        self.path = path
+        self.rlock = threading.RLock()
+        self.depth = 0
+        self.fd = None
+
+    def __enter__(self):
+        self.rlock.acquire()
+        if self.depth == 0:
+            self.fd = open(self.path, "a")
+            if fcntl:
+                fcntl.flock(self.fd, fcntl.LOCK_EX)
+        self.depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.depth -= 1
+        if self.depth == 0:
+            if fcntl:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+            self.fd.close()
+        self.rlock.release()
+
+
+_USER_LOCKS = {}
+_USER_LOCKS_GUARD = threading.Lock()
+
+
+def user_lock(paths):
+    """Held only around the compare-and-swap of one save, never across a whole page run"""
+    with _USER_LOCKS_GUARD:
+        return _USER_LOCKS.setdefault(paths["lock"], _UserLock(paths["lock"]))
+
+
+def write_snapshot(history_dir, data):
+    """Snapshot `data` into history and return its timestamp"""
+    timestamp = datetime.now().strftime("%Y-%m-%d_%H%M%S")
+    tree = build_tree(history_dir, data)
+    tree_payload = _dumps(tree)
+
+    with history_lock(history_dir):
+        # An unchanged state (e.g. a new browser session) re-uses the previous snapshot
+        last = last_manifest_entry(history_dir)
+        if last and last["hash"] == hashlib.sha256(tree_payload.encode()).hexdigest():
+            return last["ts"]
+        encoded = encode_snapshot(tree)
+        os.makedirs(f"{history_dir}{timestamp[:7]}", exist_ok=True)
+        atomic_write(history_path(history_dir, f"{timestamp}.json"), encoded)
+        append_manifest(history_dir, f"{timestamp}.json", data, tree_payload, len(encoded))
+    return timestamp
+
+
+# === RETENTION & COMPACTION ===
+# (max age, bucket format): inside a tier only the newest snapshot per bucket
+# stays in HISTORY_DIR; a None bucket keeps everything, a None age is "forever".
+RETENTION_POLICY = [
+    (timedelta(hours=24), None),
+    (timedelta(days=7), "%Y-%m-%d %H"),
+    (timedelta(days=365), "%Y-%m-%d"),
+    (None, "%Y-%m"),
+]
+COMPACT_INTERVAL = 3600  # seconds between background compaction passes
+
+
+def plan_retention(entries, now=None, policy=RETENTION_POLICY):
+    """Split manifest entries into (keep, prune) according to `policy`"""
+    now = now or datetime.now()
+    keep, prune, seen = [], [], set()
+    for entry in sorted(entries, key=lambda e: e["ts"], reverse=True):
+        try:
+            ts = datetime.strptime(entry["ts"], "%Y-%m-%d_%H%M%S")
+        except ValueError:
+            keep.append(entry)
+            continue
+        for tier, (max_age, bucket) in enumerate(policy):
+            if max_age is None or now - ts < max_age:
+                break
+        key = (tier, ts.strftime(bucket)) if bucket else None
+        if key is None or key not in seen:
+            seen.add(key)
+            keep.append(entry)
+        else:
+            prune.append(entry)
+    return keep, prune
+
+
+def compact_history(history_dir, now=None, policy=RETENTION_POLICY):
+    """Move pruned snapshots into monthly zip archives; returns how many were archived"""
+    with history_lock(history_dir):
+        entries = [e for e in read_manifest(history_dir) if not e.get("archived")]
+        keep, prune = plan_retention(entries, now, policy)
+        if not prune:
+            return 0
+        pruned = {e["file"] for e in prune}
+
+        # Journal segments of pruned checkpoints are merged forward into the
+        # next newer segment, so replay from any kept checkpoint stays complete
+        ordered = sorted(entries, key=lambda e: e["ts"])
+        for older, newer in zip(ordered, ordered[1:]):
+            if older["file"] not in pruned:
+                continue
+            src = locate_history_file(history_dir, f"{older['ts']}.ndjson")
+            if os.path.exists(src):
+                dst = locate_history_file(history_dir, f"{newer['ts']}.ndjson")
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                with open(src, "r") as f:
+                    merged = f.read()
+                if os.path.exists(dst):
+                    with open(dst, "r") as f:
+                        merged += f.read()
+                atomic_write(dst, merged)
+                os.remove(src)
+
+        os.makedirs(f"{history_dir}archive", exist_ok=True)
+        for entry in prune:
+            path = locate_history_file(history_dir, entry["file"])
+            if os.path.exists(path):
+                with zipfile.ZipFile(f"{history_dir}archive/{entry['file'][:7]}.zip", "a", zipfile.ZIP_DEFLATED) as zf:
+                    if entry["file"] not in zf.namelist():
+                        zf.write(path, entry["file"])
+                os.remove(path)
+            entry["archived"] = True
+
+        # Only the partitions that lost snapshots get their manifest rewritten
+        touched = {f[:7] for f in pruned}
+        by_part = {}
+        for entry in read_manifest(history_dir):
+            if entry["file"][:7] in touched:
+                if entry["file"] in pruned:
+                    entry["archived"] = True
+                by_part.setdefault(entry["file"][:7], []).append(entry)
+        for part, part_entries in by_part.items():
+            _write_manifest_partition(history_dir, part, part_entries)
+        return len(prune)
+
+
+def compact_user(paths, now=None, policy=RETENTION_POLICY):
+    """compact_history() under the user's lock, so a manifest line another
+    process appends meanwhile is never dropped by the partition rewrite"""
+    with user_lock(paths):
+        return compact_history(paths["history"], now, policy)
+
+
+_COMPACT_USERS = {}   # history dir -> paths, for every user seen by this process
+_COMPACTOR_GUARD = threading.Lock()
+_COMPACTOR = None
+
+
+def _compact_loop(interval):
+    while True:
+        with _COMPACTOR_GUARD:
+            users = list(_COMPACT_USERS.values())
+        for paths in users:
+            if not os.path.isdir(paths["history"]):
+                with _COMPACTOR_GUARD:
+                    _COMPACT_USERS.pop(paths["history"], None)   # reset or deleted account
+                continue
+            try:
+                compact_user(paths)
+            except Exception:
+                pass
+        time.sleep(interval)
+
+
+def start_background_compaction(paths, interval=COMPACT_INTERVAL):
+    """Add a user to the process-wide compactor: one daemon thread, however many users"""
+    global _COMPACTOR
+    with _COMPACTOR_GUARD:
+        _COMPACT_USERS[paths["history"]] = paths
+        if _COMPACTOR is None:
+            _COMPACTOR = threading.Thread(target=_compact_loop, args=(interval,), name="compactor", daemon=True)
+            _COMPACTOR.start()
+
+
+# === CHECKPOINTS ===
+class StateCorruptError(Exception):
+    """Saved state failed its checksum and could not be rebuilt from history"""
+
+
+def _state_checksum(latest):
+    """Checksum with the codec that wrote it; None when that codec isn't installed here"""
+    codec = JSON_CODECS.get(latest.get("_codec", "stdlib"))
+    if codec is None:
+        return None
+    return hashlib.sha256(codec[0]({k: v for k, v in latest.items() if k != "_checksum"})).hexdigest()
+
+
+def _rotate_journal(paths, timestamp):
+    """Move the live journal into the segment next to checkpoint `timestamp`.
+
+    Entries are merged by seq, so re-running after a crash never duplicates them.
+    """
+    if not os.path.exists(paths["journal"]):
+        return
+    segment = locate_history_file(paths["history"], f"{timestamp}.ndjson")
+    os.makedirs(os.path.dirname(segment), exist_ok=True)
+    if os.path.exists(segment):
+        events = {e["seq"]: e for e in read_journal(segment)}
+        events.update((e["seq"], e) for e in read_journal(paths["journal"]))
+        atomic_write(segment, "".join(_dumps(events[k]) + "\n" for k in sorted(events)))
+        os.remove(paths["journal"])
+    else:
+        os.replace(paths["journal"], segment)
+
+
+def recover_state(paths):
+    """Startup recovery pass; returns a list of what had to be done.
+
+    A checkpoint intent left in the WAL means the process died mid-checkpoint:
+    if latest already carries the new checksum the journal rotation is finished,
+    otherwise latest still holds the previous state and the intent is dropped.
+    """
+    actions = []
+    if os.path.exists(paths["wal"]):
+        with open(paths["wal"], "r") as f:
+            intent = _loads(f.read())
+        try:
+            done = read_snapshot(paths["latest"]).get("_checksum") == intent["checksum"]
+        except Exception:
+            done = False
+        if done:
+            _rotate_journal(paths, intent["ts"])
+            actions.append(f"completed interrupted checkpoint {intent['ts']}")
+        else:
+            actions.append(f"rolled back interrupted checkpoint {intent['ts']}")
+        os.remove(paths["wal"])
+    if repair_journal(paths["journal"]):
+        actions.append("trimmed a torn journal entry")
+    return actions
+
+
+def write_checkpoint(paths, data):
+    """Write state to latest, snapshot it into history and rotate the journal behind it.
+
+    The latest file inlines only the history tail; full pages are referenced
+    by hash from the snapshot object store. The intent (target checksum) is
+    logged and fsynced first so recover_state() can finish or undo the step.
+    """
+    data.setdefault("_seq", 0)
+    data["_checkpoint_seq"] = data["_seq"]
+    with history_lock(paths["history"]):
+        timestamp = write_snapshot(paths["history"], data)
+        history = data.get("history", [])
+        pages = history_pages(paths["history"], history)
+        full = len(history) // HISTORY_PAGE
+        latest = {k: v for k, v in data.items() if k != "history"}
+        latest["history_pages"] = pages[:full]
+        latest["history_tail"] = list(history[full * HISTORY_PAGE:])
+        latest["_codec"] = JSON_CODEC
+        latest["_checksum"] = _state_checksum(latest)
+
+        atomic_write(paths["wal"], _dumps({"ts": timestamp, "seq": data["_seq"], "checksum": latest["_checksum"]}))
+        atomic_write(paths["latest"], encode_snapshot(latest))
+        # Journal entries up to this checkpoint are kept next to it for replay/audit
+        _rotate_journal(paths, timestamp)
+        os.remove(paths["wal"])
+    return timestamp
+
+
+def load_state(paths):
+    """Last checkpoint plus journal tail, or None when the user has no data yet"""
+    if not os.path.exists(paths["latest"]):
+        return None
+    try:
+        data = read_snapshot(paths["latest"])
+    except Exception as e:
+        raise StateCorruptError(f"{paths['latest']} is unreadable: {e}") from e
+    checksum = data.pop("_checksum", None)
+    if checksum is not None and checksum != (_state_checksum(data) or checksum):
+        raise StateCorruptError(f"{paths['latest']} failed its checksum")
+    data.pop("_codec", None)
+    if "history_pages" in data:
+        data["history"] = LazyHistory(paths["history"], data.pop("history_pages"), data.pop("history_tail", []))
+    data.setdefault("_seq", 0)
+    data["_checkpoint_seq"] = data["_seq"]
+    for event in read_journal(paths["journal"]):
+        if event["seq"] > data["_seq"]:
+            apply_event(data, event)
+    return data
+
+
+# === STREAMING BACKUP ===
+# A backup is gzip-compressed NDJSON: a header line, one line per record tagged
+# with its section, then a trailer with per-section line counts and sha256
+# digests. Export and import both work line by line, so memory stays bounded
+# by one history page rather than by the size of the account.
+BACKUP_FORMAT = 1
+_BACKUP_LISTS = ("open_options", "option_trades", "capital_additions")
+
+
+class BackupError(Exception):
+    """Backup stream is truncated, corrupted or not a backup"""
+
+
+def _iter_history(history, typed=False):
+    """History rows without pinning every LazyHistory page in memory"""
+    if isinstance(history, LazyHistory):
+        for digest in history.page_hashes:
+            yield from (get_history_page if typed else get_object)(history.history_dir, digest)
+        yield from history.tail
+    else:
+        yield from history
+
+
+def _snapshot_records(history_dir):
+    """Snapshot trees (oldest first) preceded by the objects they reference, then journal segments"""
+    emitted = set()
+    for entry in reversed(read_manifest(history_dir)):
+        tree = read_snapshot_tree(history_dir, entry["file"])
+        if tree is None:
+            continue
+        if tree.get("_tree"):
+            refs = [*tree["etfs"].values(), *tree["history"], *(tree[k] for k in _TREE_LISTS if k in tree)]
+            for digest in refs:
+                if digest not in emitted:
+                    emitted.add(digest)
+                    yield {"section": "object", "hash": digest, "doc": get_object(history_dir, digest)}
+        yield {"section": "snapshot", "entry": entry, "doc": tree}
+    for name, path in list_segments(history_dir):
+        for event in read_journal(path):
+            yield {"section": "journal", "segment": name, "event": event}
+
+
+def iter_backup(store, data, username, include_history=False):
+    """The backup as a stream of NDJSON lines (bytes), checksum trailer last"""
+    digests, counts = {}, {}
+
+    def _line(record):
+        raw = (_dumps(record) + "\n").encode()
+        digests.setdefault(record["section"], hashlib.sha256()).update(raw)
+        counts[record["section"]] = counts.get(record["section"], 0) + 1
+        return raw
+
+    yield (_dumps({"_backup": BACKUP_FORMAT, "username": username, "seq": data.get("_seq", 0),
+                   "created": datetime.now().isoformat(timespec="seconds"),
+                   "history_included": include_history}) + "\n").encode()
+    yield _line({"section": "scalars", "value": {k: v for k, v in data.items()
+                                                 if k not in ("etfs", "history") + _BACKUP_LISTS and not k.startswith("_")}})
+    for ticker, rec in data.get("etfs", {}).items():
+        yield _line({"section": "etfs", "ticker": ticker, "value": rec})
+    for key in _BACKUP_LISTS:
+        for item in data.get(key, []):
+            yield _line({"section": key, "value": item})
+    for row in _iter_history(data.get("history", [])):
+        yield _line({"section": "history", "value": row})
+    if include_history:
+        for record in _snapshot_records(store.paths["history"]):
+            yield _line(record)
+    yield (_dumps({"section": "checksums", "counts": counts,
+                   "sha256": {k: h.hexdigest() for k, h in digests.items()}}) + "\n").encode()
+
+
+def export_backup(store, data, username, path, include_history=False):
+    """Stream a gzip backup to `path` (atomically) and return the path"""
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        with gzip.GzipFile(fileobj=f, mode="wb", compresslevel=6) as gz:
+            for line in iter_backup(store, data, username, include_history):
+                gz.write(line)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return path
+
+
+def import_backup(store, fileobj, merge_history=False):
+    """Read a backup stream into a state dict; returns (data, snapshots_imported).
+
+    History rows go straight into the object store page by page. Snapshots and
+    journal segments are staged and moved into place only when every section
+    checksum matches, and only with `merge_history` (an account without events
+    of its own, so the two journals cannot interleave). Legacy single-document
+    JSON backups are still accepted. Any unreadable input raises BackupError.
+    """
+    try:
+        return _import_backup(store, fileobj, merge_history)
+    except (EOFError, zlib.error, gzip.BadGzipFile, *_ZSTD_ERRORS) as e:
+        raise BackupError(f"backup is truncated (compressed stream ends early: {e})") from e
+    except JSON_DECODE_ERRORS as e:
+        raise BackupError(f"backup is truncated or corrupted (unreadable line: {e})") from e
+    except (KeyError, TypeError, AttributeError) as e:
+        raise BackupError(f"backup is corrupted (malformed record: {e!r})") from e
+
+
+def _import_backup(store, fileobj, merge_history):
+    history_dir = store.paths["history"]
+    stream = io.BufferedReader(open_stream(fileobj))
+    first = stream.readline()
+    try:
+        header = _loads(first)
+    except JSON_DECODE_ERRORS:
+        header = None
+    if not isinstance(header, dict) or "_backup" not in header:
+        data = _loads(first + stream.read())
+        upgrade_state(data)
+        return data, 0
+    if header["_backup"] > BACKUP_FORMAT:
+        raise BackupError("backup was written by a newer version of the app")
+
+    digests, counts, trailer = {}, {}, None
+    data = {"etfs": {}, **{key: [] for key in _BACKUP_LISTS}}
+    pages, page, snapshots = [], [], []
+    staging = f"{history_dir}.import/"
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+    segment, segment_file = None, None
+    try:
+        for raw in stream:
+            record = _loads(raw)
+            section = record.get("section")
+            if section == "checksums":
+                trailer = record
+                break
+            digests.setdefault(section, hashlib.sha256()).update(raw)
+            counts[section] = counts.get(section, 0) + 1
+            if section == "scalars":
+                data.update(record["value"])
+            elif section == "etfs":
+                data["etfs"][record["ticker"]] = record["value"]
+            elif section in _BACKUP_LISTS:
+                data[section].append(record["value"])
+            elif section == "history":
+                page.append(record["value"])
+                if len(page) == HISTORY_PAGE:
+                    pages.append(put_object(history_dir, page))
+                    page = []
+            elif not merge_history:
+                continue   # still checksummed, just not kept
+            elif section == "object":
+                # Verified by the section checksum; kept under its original hash so trees resolve
+                put_object(history_dir, record["doc"], record["hash"])
+            elif section == "snapshot":
+                atomic_write(f"{staging}{record['entry']['file']}", encode_snapshot(record["doc"]))
+                snapshots.append({k: v for k, v in record["entry"].items() if k != "archived"})
+            elif section == "journal":
+                if record["segment"] != segment:
+                    if segment_file:
+                        segment_file.close()
+                    segment = record["segment"]
+                    segment_file = open(f"{staging}{segment}", "a")
+                segment_file.write(_dumps(record["event"]) + "\n")
+        if segment_file:
+            segment_file.close()
+        if trailer is None:
+            raise BackupError("backup is truncated (no checksum trailer)")
+        if trailer["counts"] != counts or trailer["sha256"] != {k: h.hexdigest() for k, h in digests.items()}:
+            raise BackupError("backup failed its checksum")
+
+        imported = 0
+        with user_lock(store.paths), history_lock(history_dir):
+            known = {e["file"] for e in read_manifest(history_dir)}
+            for name in os.listdir(staging):
+                if not os.path.exists(locate_history_file(history_dir, name)):
+                    os.makedirs(f"{history_dir}{name[:7]}", exist_ok=True)
+                    os.replace(f"{staging}{name}", history_path(history_dir, name))
+            fresh = [e for e in snapshots if e["file"] not in known]
+            _append_manifest_entries(history_dir, fresh)
+            imported = len(fresh)
+    finally:
+        if segment_file and not segment_file.closed:
+            segment_file.close()
+        shutil.rmtree(staging, ignore_errors=True)
+
+    data["history"] = LazyHistory(history_dir, pages, page)
+    if merge_history:
+        data["_seq"] = int(header.get("seq", 0))   # imported journals keep their numbering
+    upgrade_state(data)
+    return data, imported
+
+
+# === CONCURRENT SESSIONS ===
+class ConflictError(Exception):
+    """Another session changed the same holdings or options since this state was loaded"""
+
+
+def _event_keys(event):
+    """(resource, mode) pairs an event touches; "add" marks commutative increments"""
+    op = event["op"]
+    if op in ("buy", "sell"):
+        return {(("etf", event["ticker"]), "set")}
+    if op == "add_ticker":
+        return {(("etf", t), "set") for t in [event["ticker"], *event.get("targets", {})]}
+    if op == "add_option":
+        return {(("option", event["option"].get("id")), "set"), ("options", "add")}
+    if op in ("update_option", "close_option"):
+        if event.get("id"):
+            return {(("option", event["id"]), "set"), ("options", "add")}
+        return {("options", "set")}   # positional edits depend on every other option
+    if op == "add_capital":
+        return {("cash", "add"), ("capital_additions", "add")}
+    if op == "set_cash":
+        return {("cash", "set")}
+    if op == "set_initial_capital":
+        return {("initial_capital", "set")}
+    if op == "option_trade":
+        return {("option_trades", "add")}
+    return set()   # premium / margin only log a history row
+
+
+def events_commute(ours, theirs):
+    """True when no event in `ours` touches a resource written by one in `theirs`"""
+    def _keys(event):
+        # Two imports racing over the same file must not both pass the dedupe check
+        return _event_keys(event) | ({("import_keys", "set")} if event.get("import_key") else set())
+
+    taken = {}
+    for event in theirs:
+        for resource, mode in _keys(event):
+            taken.setdefault(resource, set()).add(mode)
+    for event in ours:
+        for resource, mode in _keys(event):
+            if resource in taken and (mode != "add" or taken[resource] != {"add"}):
+                return False
+    return True
+
+
+# === VERSION DIFF ===
+_DIFF_ETF_FIELDS = ("shares", "cost_basis", "target_pct")
+
+
+def _diff_view(history_dir, filename):
+    """(tree, loader) for a snapshot; legacy full snapshots are hashed in memory"""
+    raw = read_snapshot_tree(history_dir, filename)
+    if raw is None:
+        return None, None
+    if raw.get("_tree"):
+        return raw, lambda digest: get_object(history_dir, digest)
+
+    objects = {}
+
+    def _put(obj):
+        digest = hashlib.sha256(_dumps(obj).encode()).hexdigest()
+        objects[digest] = obj
+        return digest
+
+    history = raw.get("history", [])
+    tree = {
+        "etfs": {t: _put(rec) for t, rec in raw.get("etfs", {}).items()},
+        "history": [_put(history[i:i + HISTORY_PAGE]) for i in range(0, len(history), HISTORY_PAGE)],
+        "scalars": {k: v for k, v in raw.items() if k not in ("etfs", "history") + _TREE_LISTS},
+    }
+    for key in _TREE_LISTS:
+        if key in raw:
+            tree[key] = _put(raw[key])
+    return tree, objects.__getitem__
+
+
+def diff_versions(store, file_a, file_b):
+    """Structural diff from snapshot `file_a` to `file_b`.
+
+    Sub-documents with equal hashes are skipped without being loaded; the
+    journal supplies a count of the operations recorded in between.
+    """
+    history_dir = store.paths["history"]
+    tree_a, load_a = _diff_view(history_dir, file_a)
+    tree_b, load_b = _diff_view(history_dir, file_b)
+    if tree_a is None or tree_b is None:
+        return None
+    diff = {"etfs": [], "options_added": [], "options_removed": [], "options_changed": [],
+            "history_added": [], "history_rewritten": False, "scalars": {}, "ops": {}}
+
+    etfs_a, etfs_b = tree_a["etfs"], tree_b["etfs"]
+    for t in sorted(set(etfs_a) | set(etfs_b)):
+        if etfs_a.get(t) == etfs_b.get(t):
+            continue
+        old = load_a(etfs_a[t]) if t in etfs_a else {}
+        new = load_b(etfs_b[t]) if t in etfs_b else {}
+        fields = {f: (old.get(f), new.get(f)) for f in _DIFF_ETF_FIELDS if old.get(f) != new.get(f)}
+        change = "added" if not old else "removed" if not new else "changed"
+        diff["etfs"].append({"ticker": t, "change": change, "fields": fields})
+
+    if tree_a.get("open_options") != tree_b.get("open_options"):
+        opts_a = {o.get("id"): o for o in (load_a(tree_a["open_options"]) if "open_options" in tree_a else [])}
+        opts_b = {o.get("id"): o for o in (load_b(tree_b["open_options"]) if "open_options" in tree_b else [])}
+        diff["options_added"] = [o for i, o in opts_b.items() if i not in opts_a]
+        diff["options_removed"] = [o for i, o in opts_a.items() if i not in opts_b]
+        diff["options_changed"] = [(opts_a[i], o) for i, o in opts_b.items() if i in opts_a and opts_a[i] != o]
+
+    # History is append-only: skip the shared prefix of identical pages
+    pages_a, pages_b = tree_a["history"], tree_b["history"]
+    common = 0
+    while common < min(len(pages_a), len(pages_b)) and pages_a[common] == pages_b[common]:
+        common += 1
+    rest_a = [row for h in pages_a[common:] for row in load_a(h)]
+    rest_b = [row for h in pages_b[common:] for row in load_b(h)]
+    if rest_b[:len(rest_a)] == rest_a:
+        diff["history_added"] = rest_b[len(rest_a):]
+    else:
+        diff["history_rewritten"] = True
+
+    scalars_a, scalars_b = tree_a["scalars"], tree_b["scalars"]
+    for key in ("initial_capital", "cash_balance"):
+        if scalars_a.get(key) != scalars_b.get(key):
+            diff["scalars"][key] = (scalars_a.get(key), scalars_b.get(key))
+
+    seq_a, seq_b = int(scalars_a.get("_seq", 0)), int(scalars_b.get("_seq", 0))
+    if seq_b > seq_a:
+        for event in store.iter_events(file_a.replace(".json", ""), seq_a):
+            if event["seq"] > seq_b:
+                break
+            diff["ops"][event["op"]] = diff["ops"].get(event["op"], 0) + 1
+    return diff
+
+
+# === TIME TRAVEL ===
+def _entries_before(history_dir, stamp):
+    """Manifest entries at or before `stamp`, newest first.
+
+    Partitions are bisected by month name and read one at a time, so finding
+    the nearest checkpoint reads one manifest partition, not all of them.
+    """
+    if not _has_manifest(history_dir):
+        rebuild_manifest(history_dir)
+    parts = history_partitions(history_dir)
+    for part in reversed(parts[:bisect.bisect_right(parts, stamp[:7])]):
+        entries = sorted({e["file"]: e for e in read_journal(f"{history_dir}{part}/{MANIFEST_NAME}")}.values(),
+                         key=lambda e: e["ts"])
+        yield from reversed(entries[:bisect.bisect_right([e["ts"] for e in entries], stamp)])
+    # Pre-partition layout (root manifest not split yet)
+    legacy = sorted({e["file"]: e for e in read_journal(f"{history_dir}{MANIFEST_NAME}")}.values(), key=lambda e: e["ts"])
+    yield from reversed(legacy[:bisect.bisect_right([e["ts"] for e in legacy], stamp)])
+
+
+def state_at(store, when):
+    """Portfolio state as of datetime `when`: nearest checkpoint at or before it
+    (binary search over the manifest partitions) plus journal replay up to `when`.
+    History is returned lazily; only its newest page is read."""
+    history_dir = store.paths["history"]
+    stamp = when.strftime("%Y-%m-%d_%H%M%S")
+    for entry in _entries_before(history_dir, stamp):
+        data = load_snapshot(history_dir, entry["file"], lazy=True)
+        if data is not None:
+            break
+    else:
+        return None
+
+    cutoff = when.isoformat(timespec="seconds")
+    for event in store.iter_events(entry["ts"], int(data.get("_seq", 0))):
+        if event["ts"] > cutoff:
+            break
+        apply_event(data, event)
+    return data
+
+
+# === COLUMNAR HISTORY ===
+# `history` mirrored as fixed-width column files (one per field) that are
+# appended per event and memory-mapped for the charts and aggregates.
+HISTORY_COLUMNS = {
+    "date": "datetime64[D]",
+    "premium": "float64",
+    "portfolio_value": "float64",
+    "margin_debt": "float64",
+    "note_id": "int32",
+}
+
+
+def _history_row(h, note_ids):
+    try:
+        date = np.datetime64(str(h.get("date", ""))[:10], "D")
+    except ValueError:
+        date = np.datetime64("NaT", "D")
+
+    def _num(key, default):
+        try:
+            return float(h[key]) if h.get(key) is not None else default
+        except (TypeError, ValueError):
+            return default
+
+    note = h.get("note")
+    if note and note not in note_ids:
+        note_ids[note] = len(note_ids)
+    return (date, _num("premium", 0.0), _num("portfolio_value", np.nan), _num("margin_debt", np.nan),
+            note_ids[note] if note else -1)
+
+
+def _read_notes(columns_dir):
+    try:
+        with open(f"{columns_dir}notes.json", "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return []
+
+
+def _note_ids(notes):
+    """note -> note_id; dict order is id order, so list(note_ids) is the notes file"""
+    return {note: i for i, note in enumerate(notes)}
+
+
+def append_history_columns(columns_dir, rows):
+    """Append history entries to the column files — O(rows) regardless of history length"""
+    os.makedirs(columns_dir, exist_ok=True)
+    note_ids = _note_ids(_read_notes(columns_dir))
+    n_notes = len(note_ids)
+    values = list(zip(*[_history_row(h, note_ids) for h in rows])) if rows else [[] for _ in HISTORY_COLUMNS]
+    for (name, dtype), col in zip(HISTORY_COLUMNS.items(), values):
+        with open(f"{columns_dir}{name}.bin", "ab") as f:
+            f.write(np.asarray(col, dtype=dtype).tobytes())
+    if len(note_ids) != n_notes:
+        atomic_write(f"{columns_dir}notes.json", _dumps(list(note_ids)))
+
+
+def write_history_columns(columns_dir, history):
+    """Full rebuild of the column files from the history list"""
+    shutil.rmtree(columns_dir, ignore_errors=True)
+    append_history_columns(columns_dir, list(_iter_history(history, typed=True)))
+
+
+def load_history_columns(columns_dir):
+    """Memory-mapped columns (zero-copy) plus the note strings, or None if missing/torn"""
+    cols = {}
+    for name, dtype in HISTORY_COLUMNS.items():
+        path = f"{columns_dir}{name}.bin"
+        if not os.path.exists(path):
+            return None
+        if os.path.getsize(path) == 0:
+            cols[name] = np.empty(0, dtype=dtype)
+        else:
+            cols[name] = np.memmap(path, dtype=dtype, mode="r")
+    if len({len(c) for c in cols.values()}) != 1:
+        return None
+    cols["notes"] = _read_notes(columns_dir)
+    return cols
+
+
+def history_columns(columns_dir, history):
+    """Columns for `history`, rebuilt when they don't match its length or newest row;
+    None if the rebuilt files still don't read back (e.g. another writer tore them)"""
+    cols = load_history_columns(columns_dir)
+    if cols is not None and len(cols["date"]) == len(history):
+        if not history:
+            return cols
+        last = _history_row(history[-1], _note_ids(cols["notes"]))
+        tail = tuple(cols[name][-1] for name in HISTORY_COLUMNS)
+        if all((a == b) or (a != a and b != b) for a, b in zip(last, tail)):
+            return cols
+    write_history_columns(columns_dir, history)
+    return load_history_columns(columns_dir)
+
+
+def monthly_totals(cols, field="premium", year=None):
+    """Vectorized per-month sums of one column -> (["YYYY-MM", ...], totals)"""
+    dates = cols["date"]
+    mask = ~np.isnat(dates)
+    if year is not None:
+        mask &= dates.astype("datetime64[Y]") == np.datetime64(str(year), "Y")
+    months, inverse = np.unique(dates[mask].astype("datetime64[M]"), return_inverse=True)
+    totals = np.bincount(inverse, weights=np.asarray(cols[field])[mask], minlength=len(months))
+    return months.astype(str).tolist(), totals
+
+
+# === CROSS-USER INDEX ===
+# One small SQLite file next to the user shards, refreshed on every save, so
+# operator queries and batch jobs never have to open N user states.
+_INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY, tickers TEXT, portfolio_value REAL,
+                                  margin_debt REAL, net_equity REAL, as_of TEXT, seq INTEGER, updated TEXT);
+CREATE TABLE IF NOT EXISTS user_options (username TEXT, ticker TEXT, expiry TEXT, strike REAL, contracts INTEGER);
+CREATE INDEX IF NOT EXISTS idx_uopt_user ON user_options(username);
+CREATE INDEX IF NOT EXISTS idx_uopt_expiry ON user_options(expiry);
+CREATE INDEX IF NOT EXISTS idx_uopt_ticker ON user_options(ticker);
+"""
+
+
+def _index_conn(path):
+    conn = sqlite3.connect(path, timeout=10)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(_INDEX_SCHEMA)
+    return conn
+
+
+def index_summary(data):
+    """The per-user row kept in the index: tickers, equity from the newest valued history row, open options"""
+    # Backdated rows (broker imports) carry no portfolio value and can sit at the tail
+    last = next((h for h in reversed(data.get("history", [])) if h.get("portfolio_value") is not None), {})
+
+    def _num(key):
+        try:
+            return float(last.get(key) or 0.0)
+        except (TypeError, ValueError):
+            return 0.0
+
+    options = data.get("open_options", [])
+    tickers = sorted(set(data.get("etfs", {})) | {o["ticker"] for o in options})
+    return {
+        "tickers": tickers,
+        "portfolio_value": _num("portfolio_value"),
+        "margin_debt": _num("margin_debt"),
+        "net_equity": _num("portfolio_value") - _num("margin_debt"),
+        "as_of": last.get("date", ""),
+        "seq": int(data.get("_seq", 0)),
+        "options": [(o["ticker"], o.get("expiry", ""), float(o.get("strike", 0.0)), int(o.get("contracts", 0)))
+                    for o in options],
+    }
+
+
+def update_user_index(paths, data):
+    """Upsert one user's row; the index is secondary, so a failure never fails the save"""
+    summary = index_summary(data)
+    try:
+        conn = _index_conn(paths["index"])
+        try:
+            with conn:
+                conn.execute("INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                             (paths["user"], _dumps(summary["tickers"]), summary["portfolio_value"],
+                              summary["margin_debt"], summary["net_equity"], summary["as_of"], summary["seq"],
+                              datetime.now().isoformat(timespec="seconds")))
+                conn.execute("DELETE FROM user_options WHERE username = ?", (paths["user"],))
+                conn.executemany("INSERT INTO user_options VALUES (?, ?, ?, ?, ?)",
+                                 [(paths["user"], *opt) for opt in summary["options"]])
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return False   # `python portfolio_store.py index rebuild` repairs it
+    return True
+
+
+def drop_from_index(paths):
+    conn = _index_conn(paths["index"])
+    try:
+        with conn:
+            conn.execute("DELETE FROM users WHERE username = ?", (paths["user"],))
+            conn.execute("DELETE FROM user_options WHERE username = ?", (paths["user"],))
+    finally:
+        conn.close()
+
+
+def _query_index(root, sql, params=()):
+    path = f"{root}/_index.db"
+    if not os.path.exists(path):
+        return []
+    conn = _index_conn(path)
+    try:
+        return conn.execute(sql, params).fetchall()
+    finally:
+        conn.close()
+
+
+def open_contracts_by_underlying(root="data"):
+    """{ticker: open contracts} summed over every user"""
+    return dict(_query_index(root, "SELECT ticker, SUM(contracts) FROM user_options GROUP BY ticker ORDER BY ticker"))
+
+
+def users_expiring(within_days=7, root="data", today=None):
+    """(username, ticker, expiry, strike, contracts) for options expiring in the next `within_days` days"""
+    today = today or datetime.now().date()
+    return _query_index(root, "SELECT username, ticker, expiry, strike, contracts FROM user_options "
+                              "WHERE expiry >= ? AND expiry <= ? ORDER BY expiry, username",
+                        (today.isoformat(), (today + timedelta(days=within_days)).isoformat()))
+
+
+def tracked_tickers(root="data"):
+    """Every ticker held or written against by any user — the price warm-up set"""
+    tickers = set()
+    for (doc,) in _query_index(root, "SELECT tickers FROM users"):
+        tickers.update(_loads(doc))
+    return sorted(tickers)
+
+
+def user_summaries(root="data"):
+    rows = _query_index(root, "SELECT username, portfolio_value, margin_debt, net_equity, as_of, updated "
+                              "FROM users ORDER BY net_equity DESC")
+    keys = ("username", "portfolio_value", "margin_debt", "net_equity", "as_of", "updated")
+    return [dict(zip(keys, row)) for row in rows]
+
+
+def rebuild_index(root="data"):
+    """Re-index every user from their saved state (batch job / repair); returns the user count"""
+    count = 0
+    for user_dir in sorted(glob.glob(f"{root}/*/*/")):
+        username = os.path.basename(user_dir.rstrip("/"))
+        paths = user_paths(username, root)
+        if os.path.abspath(paths["dir"]) != os.path.abspath(user_dir):
+            continue
+        backend = "sqlite" if os.path.exists(paths["db"]) else "json"
+        data = open_store(paths, backend).load() if os.path.exists(paths["latest"]) or backend == "sqlite" else None
+        if data is not None and update_user_index(paths, data):
+            count += 1
+    return count
+
+
+# === STORAGE BACKENDS ===
+# Process-wide cache of loaded (and schema-upgraded) state, keyed by the backing
+# files' (mtime_ns, size) so an unchanged account is never re-parsed on rerun.
+_STATE_CACHE = {}
+
+
+def _file_stamp(path):
+    try:
+        info = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (info.st_mtime_ns, info.st_size)
+
+
+def _session_copy(data):
+    """Copy of cached state that one session may mutate.
+
+    Only what apply_event changes in place is copied: the top-level dict, the
+    lists it appends to and the etf / open-option records it updates. History
+    rows, trades and capital additions are never modified, so they are shared.
+    """
+    clone = dict(data)
+    if "etfs" in data:
+        clone["etfs"] = {t: dict(rec) for t, rec in data["etfs"].items()}
+    if "open_options" in data:
+        clone["open_options"] = [dict(o) for o in data["open_options"]]
+    for key in ("history", "option_trades", "capital_additions", "import_keys"):
+        if key in data:
+            clone[key] = data[key].copy()
+    return clone
+
+
+class JsonStore:
+    """Latest-file + journal backend; aggregates are plain Python over the loaded state"""
+    stamp_keys = ("latest", "journal")
+
+    def __init__(self, paths):
+        self.paths = paths
+        self.upgraded = []
+        self.recovered = []
+        self.rebased = 0
+
+    def load(self):
+        data = self._load()
+        if data is not None:
+            self.upgraded = upgrade_state(data)
+            if self.upgraded:
+                # Written back so later loads skip the migrations, unless another session saved meanwhile
+                with user_lock(self.paths):
+                    if self.head_seq() == int(data.get("_seq", 0)):
+                        self._checkpoint(data)
+        return data
+
+    def _load(self):
+        with user_lock(self.paths), history_lock(self.paths["history"]):
+            self.recovered = recover_state(self.paths)
+            try:
+                return load_state(self.paths)
+            except StateCorruptError as e:
+                # Newest intact snapshot plus every journal entry recorded after it
+                data = state_at(self, datetime.now() + timedelta(days=1))
+                if data is None:
+                    raise
+                self.recovered.append(f"rebuilt state from history ({e})")
+                self._checkpoint(data)
+                return data
+
+    # -- process-level cache --
+    def stamp(self):
+        return tuple((self.paths[k], _file_stamp(self.paths[k])) for k in self.stamp_keys)
+
+    def cached_load(self):
+        """load(), skipped entirely while the files are unchanged"""
+        stamp = self.stamp()
+        hit = _STATE_CACHE.get(self.paths["dir"])
+        if hit and hit[0] == stamp:
+            self.upgraded, self.recovered = [], []   # those notices belong to the load that filled the cache
+            return _session_copy(hit[1])   # every session mutates its own copy
+        data = self.load()
+        if data is not None:
+            # A migration write-back changed the files we just stamped
+            _STATE_CACHE[self.paths["dir"]] = (self.stamp() if self.upgraded else stamp, data)
+            return _session_copy(data)
+        return data
+
+    def remember(self, data):
+        """Our own writes keep the cached state current instead of invalidating it"""
+        _STATE_CACHE[self.paths["dir"]] = (self.stamp(), _session_copy(data))
+
+    def forget(self):
+        _STATE_CACHE.pop(self.paths["dir"], None)
+
+    def close(self):
+        pass
+
+    # -- writes (compare-and-swap on the state version `_seq`) --
+    def checkpoint(self, data, base_seq=None):
+        """Full write of `data`; refused if the stored version moved past `base_seq`
+        (defaults to data's own version — a restore passes the version it replaces)"""
+        with user_lock(self.paths):
+            base = int(data.get("_seq", 0)) if base_seq is None else base_seq
+            head = self.head_seq()
+            if head != base:
+                raise ConflictError(f"saved data is at version {head}, this session expected {base}")
+            # A new browser session saves the version it just loaded: nothing to rewrite or re-hash
+            last = last_manifest_entry(self.paths["history"]) if base_seq is None else None
+            if last is not None and int(last.get("seq", -1)) == head:
+                return last["ts"]
+            timestamp = self._checkpoint(data)
+            self.remember(data)
+            update_user_index(self.paths, data)
+        return timestamp
+
+    def append(self, data, events):
+        """Append events built on version seq-1; rebased onto newer saves when they commute"""
+        with user_lock(self.paths):
+            base = events[0]["seq"] - 1
+            head = self.head_seq()
+            if head != base:
+                events = self._rebase(data, events, base, head)
+            self._append(data, events)
+            rows = [e["history"] for e in events if e.get("history")]
+            if rows and os.path.isdir(self.paths["columns"]):
+                append_history_columns(self.paths["columns"], rows)
+            self.remember(data)
+            update_user_index(self.paths, data)
+        return events
+
+    def _rebase(self, data, events, base, head):
+        theirs = list(self.events_since(base)) if head > base else []
+        if [e["seq"] for e in theirs] != list(range(base + 1, head + 1)):
+            # A restore or full save replaced the state — nothing to rebase onto
+            raise ConflictError(f"saved data was replaced (version {head}) since this session loaded version {base}")
+        if not events_commute(events, theirs):
+            ops = ", ".join(sorted({e["op"] for e in theirs}))
+            raise ConflictError(f"another session changed the same positions ({ops}) since this page was loaded")
+        fresh = self.load()
+        rebased = []
+        for event in events:
+            event = dict(event, seq=int(fresh.get("_seq", 0)) + 1)
+            apply_event(fresh, event)
+            rebased.append(event)
+        data.clear()
+        data.update(fresh)
+        self.rebased += len(rebased)
+        return rebased
+
+    def head_seq(self):
+        """Version of the stored state: last journal seq, else the checkpoint's"""
+        last = None
+        for event in read_journal(self.paths["journal"]):
+            last = event["seq"]
+        if last is not None:
+            return last
+        if not os.path.exists(self.paths["latest"]):
+            return 0
+        return int(read_snapshot(self.paths["latest"]).get("_seq", 0))
+
+    def events_since(self, seq):
+        """Every event after version `seq`, starting from the checkpoint that covers it"""
+        covering = [e for e in read_manifest(self.paths["history"]) if e.get("seq", 0) <= seq]
+        after_ts = max((e["ts"] for e in covering), default="")
+        return self.iter_events(after_ts, seq)
+
+    def history_columns(self, data):
+        return history_columns(self.paths["columns"], data.get("history", []))
+
+    def iter_events(self, after_ts, after_seq):
+        """Journal entries newer than checkpoint `after_ts`/`after_seq`, oldest first"""
+        for _, path in list_segments(self.paths["history"], f"{after_ts}.ndjson" if after_ts else ""):
+            for event in read_journal(path):
+                if event["seq"] > after_seq:
+                    yield event
+        for event in read_journal(self.paths["journal"]):
+            if event["seq"] > after_seq:
+                yield event
+
+    def state_at(self, when):
+        return state_at(self, when)
+
+    def diff_versions(self, file_a, file_b):
+        return diff_versions(self, file_a, file_b)
+
+    def record(self, data, op, **fields):
+        event = new_event(data, op, **fields)
+        apply_event(data, event)
+        return self.append(data, [event])[0]
+
+    def _checkpoint(self, data):
+        return write_checkpoint(self.paths, data)
+
+    def _append(self, data, events):
+        append_events(self.paths, data, events)
+
+    def last_margin(self, data):
+        history = data.get("history", [])
+        try:
+            return float(history[-1].get("margin_debt") or 0.0) if history else 0.0
+        except (TypeError, ValueError):
+            return 0.0
+
+    def monthly_premiums(self, data, year):
+        cols = self.history_columns(data)
+        if cols is None:
+            return {}
+        months, totals = monthly_totals(cols, "premium", year)
+        return dict(zip(months, totals.tolist()))
+
+    def open_contracts_per_ticker(self, data):
+        counts = {}
+        for opt in data.get("open_options", []):
+            counts[opt["ticker"]] = counts.get(opt["ticker"], 0) + opt["contracts"]
+        return counts
+
+
+_SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS etfs (ticker TEXT PRIMARY KEY, shares REAL, cost_basis REAL, target_pct REAL, doc TEXT);
+CREATE TABLE IF NOT EXISTS history (id INTEGER PRIMARY KEY, date TEXT, premium REAL, portfolio_value REAL, margin_debt REAL, doc TEXT);
+CREATE TABLE IF NOT EXISTS capital_additions (id INTEGER PRIMARY KEY, date TEXT, amount REAL);
+CREATE TABLE IF NOT EXISTS option_trades (id INTEGER PRIMARY KEY, ticker TEXT, doc TEXT);
+CREATE TABLE IF NOT EXISTS open_options (pos INTEGER PRIMARY KEY, id TEXT, ticker TEXT, expiry TEXT, contracts INTEGER, strike REAL, doc TEXT);
+CREATE TABLE IF NOT EXISTS journal (seq INTEGER PRIMARY KEY, ts TEXT, doc TEXT);
+CREATE INDEX IF NOT EXISTS idx_history_date ON history(date);
+CREATE INDEX IF NOT EXISTS idx_capital_date ON capital_additions(date);
+CREATE INDEX IF NOT EXISTS idx_trades_ticker ON option_trades(ticker);
+CREATE INDEX IF NOT EXISTS idx_options_ticker ON open_options(ticker);
+CREATE INDEX IF NOT EXISTS idx_options_expiry ON open_options(expiry);
+"""
+_SQLITE_TABLES = ("etfs", "history", "capital_additions", "option_trades", "open_options")
+
+
+class SqliteStore(JsonStore):
+    """SQLite (WAL) backend with one indexed table per state collection"""
+    stamp_keys = ("db", "db_wal")
+
+    def __init__(self, paths):
+        super().__init__(paths)
+        fresh = not os.path.exists(paths["db"])
+        self.conn = sqlite3.connect(paths["db"], check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(_SQLITE_SCHEMA)
+        # First open on an existing JSON account imports it, journal included
+        if fresh:
+            data = load_state(paths)
+            if data is not None:
+                with self.conn:
+                    self._write_all(data)
+                    self._import_journal()
+
+    # -- row writers --
+    def _put_meta(self, key, value):
+        self.conn.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, json.dumps(value)))
+
+    def _put_etf(self, ticker, rec):
+        self.conn.execute("INSERT OR REPLACE INTO etfs VALUES (?, ?, ?, ?, ?)",
+                          (ticker, rec.get("shares", 0.0), rec.get("cost_basis", 0.0), rec.get("target_pct", 0.0), _dumps(rec)))
+
+    def _add_history(self, h):
+        self.conn.execute("INSERT INTO history (date, premium, portfolio_value, margin_debt, doc) VALUES (?, ?, ?, ?, ?)",
+                          (h.get("date"), h.get("premium"), h.get("portfolio_value"), h.get("margin_debt"), _dumps(h)))
+
+    def _add_capital(self, a):
+        self.conn.execute("INSERT INTO capital_additions (date, amount) VALUES (?, ?)", (a.get("date"), a.get("amount")))
+
+    def _write_options(self, options):
+        self.conn.execute("DELETE FROM open_options")
+        self.conn.executemany("INSERT INTO open_options VALUES (?, ?, ?, ?, ?, ?, ?)",
+                              [(i, o.get("id"), o.get("ticker"), o.get("expiry"), o.get("contracts"), o.get("strike"), _dumps(o))
+                               for i, o in enumerate(options)])
+
+    def _write_all(self, data):
+        for table in _SQLITE_TABLES + ("meta",):
+            self.conn.execute(f"DELETE FROM {table}")
+        for key, value in data.items():
+            if key not in _SQLITE_TABLES:
+                self._put_meta(key, value)
+        for t, rec in data.get("etfs", {}).items():
+            self._put_etf(t, rec)
+        for h in data.get("history", []):
+            self._add_history(h)
+        for a in data.get("capital_additions", []):
+            self._add_capital(a)
+        self.conn.executemany("INSERT INTO option_trades (ticker, doc) VALUES (?, ?)",
+                              [(t.get("ticker"), _dumps(t)) for t in data.get("option_trades", [])])
+        self._write_options(data.get("open_options", []))
+
+    def _import_journal(self):
+        """Rotated segments and the live journal of the JSON layout, so replay (state_at, diffs) sees them"""
+        segments = list_segments(self.paths["history"]) if os.path.isdir(self.paths["history"]) else []
+        for path in [p for _, p in segments] + [self.paths["journal"]]:
+            self.conn.executemany("INSERT OR IGNORE INTO journal VALUES (?, ?, ?)",
+                                  [(e["seq"], e["ts"], _dumps(e)) for e in read_journal(path)])
+
+    # -- store interface --
+    def _load(self):
+        # The connection is shared by every session (see shared_store), so reads don't interleave with a save
+        with user_lock(self.paths):
+            if self.conn.execute("SELECT COUNT(*) FROM meta").fetchone()[0] == 0:
+                return None
+            data = {k: json.loads(v) for k, v in self.conn.execute("SELECT key, value FROM meta")}
+            data["etfs"] = {t: _loads(doc) for t, doc in self.conn.execute("SELECT ticker, doc FROM etfs")}
+            data["history"] = [_loads(doc) for (doc,) in self.conn.execute("SELECT doc FROM history ORDER BY id")]
+            data["capital_additions"] = [{"date": d, "amount": a} for d, a in
+                                         self.conn.execute("SELECT date, amount FROM capital_additions ORDER BY id")]
+            data["option_trades"] = [_loads(doc) for (doc,) in self.conn.execute("SELECT doc FROM option_trades ORDER BY id")]
+            data["open_options"] = [_loads(doc) for (doc,) in self.conn.execute("SELECT doc FROM open_options ORDER BY pos")]
+        data["_checkpoint_seq"] = data.get("_seq", 0)
+        return data
+
+    def _checkpoint(self, data):
+        data.setdefault("_seq", 0)
+        data["_checkpoint_seq"] = data["_seq"]
+        with self.conn:
+            self._write_all(data)
+        return write_snapshot(self.paths["history"], data)
+
+    def _append(self, data, events):
+        # Only the rows touched by the batch are written, in one transaction
+        dirty_tickers, options_dirty = set(), False
+        with self.conn:
+            for event in events:
+                op = event["op"]
+                self.conn.execute("INSERT INTO journal VALUES (?, ?, ?)", (event["seq"], event["ts"], _dumps(event)))
+                if op in ("buy", "sell"):
+                    dirty_tickers.add(event["ticker"])
+                elif op == "add_ticker":
+                    dirty_tickers.update(data["etfs"])
+                elif op in ("add_option", "update_option", "close_option"):
+                    options_dirty = True
+                elif op == "add_capital":
+                    self._add_capital({"date": event["date"], "amount": float(event["amount"])})
+                elif op == "option_trade":
+                    self.conn.execute("INSERT INTO option_trades (ticker, doc) VALUES (?, ?)",
+                                      (event["trade"].get("ticker"), _dumps(event["trade"])))
+                if event.get("history"):
+                    self._add_history(event["history"])
+            for t in dirty_tickers:
+                self._put_etf(t, data["etfs"][t])
+            if options_dirty:
+                self._write_options(data["open_options"])
+            for key in ("initial_capital", "cash_balance", "import_keys", "_seq"):
+                if key in data:
+                    self._put_meta(key, data[key])
+
+    def head_seq(self):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = '_seq'").fetchone()
+        journal = self.conn.execute("SELECT MAX(seq) FROM journal").fetchone()[0]
+        return max(int(json.loads(row[0])) if row else 0, journal or 0)
+
+    def iter_events(self, after_ts, after_seq):
+        for (doc,) in self.conn.execute("SELECT doc FROM journal WHERE seq > ? ORDER BY seq", (after_seq,)):
+            yield _loads(doc)
+
+    def last_margin(self, data):
+        row = self.conn.execute("SELECT margin_debt FROM history ORDER BY id DESC LIMIT 1").fetchone()
+        try:
+            return float(row[0] or 0.0) if row else 0.0
+        except (TypeError, ValueError):
+            return 0.0
+
+    def monthly_premiums(self, data, year):
+        rows = self.conn.execute(
+            "SELECT substr(date, 1, 7), SUM(premium) FROM history WHERE date >= ? AND date < ? GROUP BY 1",
+            (f"{year}-", f"{year + 1}-"))
+        return {month: float(total or 0) for month, total in rows}
+
+    def open_contracts_per_ticker(self, data):
+        return dict(self.conn.execute("SELECT ticker, SUM(contracts) FROM open_options GROUP BY ticker"))
+
+    def close(self):
+        self.conn.close()
+
+
+STORAGE_BACKENDS = {"json": JsonStore, "sqlite": SqliteStore}
+
+
+def open_store(paths, backend="json"):
+    return STORAGE_BACKENDS[backend](paths)
+
+
+# One store per user directory and backend per process, so a page rerun
+# doesn't reconnect (and re-run the schema) every time.
+_STORES = {}
+_STORES_GUARD = threading.Lock()
+
+
+def shared_store(paths, backend="json"):
+    key = (paths["dir"], backend)
+    with _STORES_GUARD:
+        if key not in _STORES:
+            _STORES[key] = open_store(paths, backend)
+        return _STORES[key]
+
+
+def close_stores(paths):
+    """Close and forget the shared stores of one user (e.g. before their files are deleted)"""
+    with _STORES_GUARD:
+        for key in [k for k in _STORES if k[0] == paths["dir"]]:
+            _STORES.pop(key).close()
+
+
+# === UNIT OF WORK ===
+class UnitOfWork:
+    """Collects the mutations of one script run and commits them in a single durable write"""
+
+    def __init__(self, store, data):
+        self.store = store
+        self.data = data
+        self.pending = []
+
+    def record(self, op, **fields):
+        event = new_event(self.data, op, **fields)
+        apply_event(self.data, event)
+        self.pending.append(event)
+        return event
+
+    def commit(self):
+        """Raises ConflictError when another session's save cannot be rebased over"""
+        # Anything already covered by a checkpoint taken meanwhile is skipped
+        events = [e for e in self.pending if e["seq"] > int(self.data.get("_checkpoint_seq", 0))]
+        self.pending = []
+        if events:
+            self.store.append(self.data, events)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            # `data` already holds the discarded events, so the cached copy is stale
+            self.pending = []
+            self.store.forget()
+
+
+# === BENCHMARK ===
+def synthetic_state(rows, tickers=20, options=50):
+    """Deterministic portfolio state with `rows` history entries"""
+    start = datetime(2000, 1, 3)
+    return {
+        "schema_version": SCHEMA_VERSION,
+        "etfs": {f"T{i:02d}": {"shares": 100.0 + i, "cost_basis": 25.5 + i, "target_pct": 1.0 / tickers}
+                 for i in range(tickers)},
+        "history": [{"date": (start + timedelta(days=i)).strftime("%Y-%m-%d"), "premium": round(i % 500 * 1.37, 2),
+                     "portfolio_value": 100000.0 + i * 3.25, "margin_debt": float(i % 7 * 1000),
+                     **({"note": f"Rebalance {i}"} if i % 50 == 0 else {})} for i in range(rows)],
+        "open_options": [{"id": f"opt_{i}", "ticker": f"T{i % tickers:02d}", "contracts": 1 + i % 5,
+                          "strike": 30.0 + i, "expiry": "2027-01-15", "sold_date": "2026-10-01", "premium_per": 0.45}
+                         for i in range(options)],
+        "option_trades": [],
+        "capital_additions": [],
+        "initial_capital": 100000.0,
+        "cash_balance": 2500.0,
+    }
+
+
+def benchmark_codecs(sizes=(10_000, 100_000, 1_000_000), repeat=3):
+    """Encode / decode / typed-decode timings in ms for every installed codec"""
+    results = []
+    for rows in sizes:
+        state = synthetic_state(rows)
+        runs = repeat if rows <= 100_000 else 1
+        for name, (encode, decode) in JSON_CODECS.items():
+            def _best(fn):
+                best = float("inf")
+                for _ in range(runs):
+                    t0 = time.perf_counter()
+                    out = fn()
+                    best = min(best, time.perf_counter() - t0)
+                return best * 1000, out
+
+            enc_ms, payload = _best(lambda: encode(state))
+            dec_ms, _ = _best(lambda: decode(payload))
+            history = encode(state["history"])
+            typed_ms = _best(lambda: msgspec.json.decode(history, type=list[HistoryRow]))[0] if name == "msgspec" else None
+            results.append({"rows": rows, "codec": name, "mb": len(payload) / 1e6,
+                            "encode_ms": enc_ms, "decode_ms": dec_ms, "typed_ms": typed_ms})
+        del state
+    return results
+
+
+# === CLI ===
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Wealth Growth Pro storage maintenance")
+    sub = parser.add_subparsers(dest="command", required=True)
+    compact = sub.add_parser("compact", help="apply the retention policy to every user's history")
+    compact.add_argument("root", nargs="?", default="data")
+    backup = sub.add_parser("backup", help="stream one user's backup to a .ndjson.gz file (account migrations)")
+    backup.add_argument("username")
+    backup.add_argument("--root", default="data")
+    backup.add_argument("--backend", default="json", choices=sorted(STORAGE_BACKENDS))
+    backup.add_argument("--with-history", action="store_true", help="include snapshots and journal segments")
+    backup.add_argument("-o", "--output")
+    index = sub.add_parser("index", help="query or rebuild the cross-user index")
+    index.add_argument("query", choices=["rebuild", "contracts", "expiring", "tickers", "users"])
+    index.add_argument("--root", default="data")
+    index.add_argument("--days", type=int, default=7)
+    bench = sub.add_parser("bench", help="time the installed JSON codecs on synthetic states")
+    bench.add_argument("rows", nargs="*", type=int, default=[10_000, 100_000, 1_000_000])
+    args = parser.parse_args()
+
+    if args.command == "compact":
+        # Sharded directories only: flat data/<username>/ belongs to the other tracker pages
+        for history_dir in sorted(glob.glob(f"{args.root}/*/*/*_history/")):
+            compact_paths = user_paths(os.path.basename(os.path.dirname(history_dir.rstrip("/"))), args.root)
+            if os.path.abspath(compact_paths["history"]) == os.path.abspath(history_dir):
+                print(f"{history_dir}: archived {compact_user(compact_paths)} snapshot(s)")
+    elif args.command == "backup":
+        backup_store = open_store(user_paths(args.username, args.root), args.backend)
+        state = backup_store.load()
+        if state is None:
+            parser.error(f"no saved data for {args.username}")
+        out = args.output or f"wealthgrowth_{args.username}_{datetime.now().strftime('%Y%m%d_%H%M')}.ndjson.gz"
+        print(export_backup(backup_store, state, args.username, out, args.with_history))
+    elif args.command == "index":
+        if args.query == "rebuild":
+            print(f"indexed {rebuild_index(args.root)} user(s)")
+        elif args.query == "contracts":
+            for ticker, contracts in open_contracts_by_underlying(args.root).items():
+                print(f"{ticker:<8} {contracts:>6}")
+        elif args.query == "expiring":
+            for row in users_expiring(args.days, args.root):
+                print("{:<20} {:<8} {} {:>8.2f} {:>4}".format(*row))
+        elif args.query == "tickers":
+            print(" ".join(tracked_tickers(args.root)))
+        else:
+            for u in user_summaries(args.root):
+                print(f"{u['username']:<20} {u['net_equity']:>14,.2f}  as of {u['as_of'] or '-'}")
+    elif args.command == "bench":
+        print(f"active codec: {JSON_CODEC}")
+        print(f"{'rows':>9} {'codec':<8} {'MB':>7} {'encode ms':>10} {'decode ms':>10} {'typed ms':>9}")
+        for r in benchmark_codecs(args.rows):
+            typed = f"{r['typed_ms']:9.1f}" if r["typed_ms"] is not None else f"{'-':>9}"
+            print(f"{r['rows']:>9} {r['codec']:<8} {r['mb']:7.2f} {r['encode_ms']:10.1f} {r['decode_ms']:10.1f} {typed}")
@@ -0,0 +1,43 @@
+import os
+import sys
+from datetime import datetime, timedelta
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import portfolio_store as store  # noqa: E402
+
+
+class Clock(datetime):
+    """datetime whose now() is set by the test, so snapshot names and event times are predictable"""
+    current = datetime(2025, 1, 6, 9, 30)
+
+    @classmethod
+    def now(cls, tz=None):
+        return cls.current
+
+    @classmethod
+    def advance(cls, **delta):
+        cls.current += timedelta(**delta)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    monkeypatch.setattr(Clock, "current", datetime(2025, 1, 6, 9, 30))
+    monkeypatch.setattr(store, "datetime", Clock)
+    return Clock
+
+
+@pytest.fixture
+def paths(tmp_path):
+    p = store.user_paths("alice", str(tmp_path))
+    os.makedirs(p["history"])
+    return p
+
+
+@pytest.fixture
+def state():
+    data = store.synthetic_state(10, tickers=3, options=2)
+    data["_seq"] = 0
+    return data
@@ -0,0 +1,102 @@
+import io
+
+import pytest
+
+import broker_import
+import portfolio_store as store
+
+HEADER = "Date,Action,Symbol,Description,Quantity,Price,Amount"
+
+
+def _csv(*rows):
+    return io.BytesIO(("\n".join((HEADER,) + rows) + "\n").encode())
+
+
+def _import(paths, data, *rows, **values):
+    s = store.open_store(paths)
+    s.checkpoint(data)
+    with store.UnitOfWork(s, data) as uow:
+        summary = broker_import.import_activity(uow, _csv(*rows), **values)
+    return s, summary
+
+
+# === PARSING ===
+@pytest.mark.parametrize("symbol, description", [
+    ("SOXL  250117C00020000", ""),                       # OCC / IBKR
+    ("-SOXL250117C20", ""),                              # Fidelity
+    ("SOXL 01/17/2025 20.00 C", ""),                     # Schwab
+    ("", "SOXL 1/17/2025 Call $20.00"),                  # Robinhood
+])
+def test_parse_option_symbol_formats(symbol, description):
+    assert broker_import.parse_option_symbol(symbol, description) == ("SOXL", "2025-01-17", "C", 20.0)
+
+
+def test_parse_option_symbol_put_strike_and_plain_ticker():
+    assert broker_import.parse_option_symbol("TQQQ  250620P00045500") == ("TQQQ", "2025-06-20", "P", 45.5)
+    assert broker_import.parse_option_symbol("SOXL", "DIREXION DAILY SEMICONDUCTOR BULL 3X") is None
+
+
+@pytest.mark.parametrize("text, kind", [
+    ("Sell to Open", "sell_to_open"),
+    ("YOU SOLD OPENING TRANSACTION", "sell_to_open"),
+    ("Buy to Close", "buy_to_close"),
+    ("YOU BOUGHT CLOSING TRANSACTION", "buy_to_close"),
+    ("STO", "sell_to_open"),
+    ("Expired", "expired"),
+    ("Assigned", "assigned"),
+    ("YOU BOUGHT", "buy"),
+    ("Reinvestment", "buy"),
+    ("Sell", "sell"),
+    ("Dividend", None),
+])
+def test_classify_action_prefers_option_phrases_over_buy_sell(text, kind):
+    assert broker_import.classify_action(text) == kind
+
+
+# === STAGING ===
+OPEN = "01/03/2025,Sell to Open,SOXL 01/17/2025 20.00 C,,1,1.50,150.00"
+CLOSE = "01/10/2025,Buy to Close,SOXL 01/17/2025 20.00 C,,1,0.40,-40.00"
+
+
+def test_reimport_skips_rows_by_natural_key(paths, state, clock):
+    rows = (OPEN, "01/06/2025,Buy,T00,,5,10.00,-50.00", "01/06/2025,Buy,T00,,5,10.00,-50.00")
+    s, first = _import(paths, state, *rows)
+    assert (first["opened"], first["buys"], first["duplicates"]) == (1, 2, 0)   # identical fills both count
+    shares = state["etfs"]["T00"]["shares"]
+
+    again = store.open_store(paths).load()
+    with store.UnitOfWork(s, again) as uow:
+        second = broker_import.import_activity(uow, _csv(*rows))
+    assert (second["opened"], second["buys"], second["duplicates"]) == (0, 0, 3)
+    assert again["etfs"]["T00"]["shares"] == shares
+    assert len(again["open_options"]) == len(state["open_options"])
+
+
+def test_close_listed_before_its_open_is_retried_after_it(paths, state, clock):
+    # Same-day close exported above its open: staged in file order it finds no position
+    close = CLOSE.replace("01/10/2025", "01/03/2025")
+    sell = "01/03/2025,Sell,T00,,150,10.00,1500.00"   # more than held until the buy below
+    _, summary = _import(paths, state, close, sell, OPEN, "01/03/2025,Buy,T00,,100,10.00,-1000.00")
+    assert summary["skipped"] == []
+    assert (summary["opened"], summary["closed"], summary["buys"], summary["sells"]) == (1, 1, 1, 1)
+    assert not [o for o in state["open_options"] if o["ticker"] == "SOXL"]
+    assert state["etfs"]["T00"]["shares"] == 100.0 + 100 - 150
+
+
+def test_unmatched_close_is_reported_as_skipped(paths, state, clock):
+    _, summary = _import(paths, state, CLOSE)
+    assert summary["closed"] == 0
+    assert summary["skipped"] == ["2025-01-10 Buy to Close SOXL 01/17/2025 20.00 C: no open SOXL 20C 2025-01-17 position"]
+
+
+# === HISTORY ===
+def test_backdated_import_keeps_index_equity_from_the_last_valued_row(paths, state, clock):
+    valued = state["history"][-1]
+    _, summary = _import(paths, state, OPEN, portfolio_value=250000.0, margin_debt=1000.0)
+    assert summary["opened"] == 1
+    assert state["history"][-1]["date"] == "2025-01-03" and "portfolio_value" not in state["history"][-1]
+
+    row = store.index_summary(state)
+    assert row["portfolio_value"] == valued["portfolio_value"]
+    assert row["net_equity"] == valued["portfolio_value"] - valued["margin_debt"]
+    assert row["as_of"] == valued["date"]
@@ -0,0 +1,191 @@
+import threading
+import time
+import types
+
+import pytest
+
+import market_data
+from market_data import BackendError, MarketDataProvider, Quote
+
+
+class FakeBackend:
+    """Prices from a dict; raises `error` if set, and blocks on `gate` if given"""
+
+    def __init__(self, name, prices=None, error=None, gate=None):
+        self.name = name
+        self.prices = dict(prices or {})
+        self.error = error
+        self.gate = gate
+        self.calls = []
+
+    def fetch(self, symbols, deadline_at=None):
+        self.calls.append(sorted(symbols))
+        if self.gate is not None:
+            self.gate.wait(5)
+        if self.error:
+            raise BackendError(self.error)
+        return {s: Quote(s, self.prices[s], source=self.name) for s in symbols if s in self.prices}
+
+
+@pytest.fixture
+def now(monkeypatch):
+    """Settable market_data clock; thread waits and timeouts still use real time"""
+    clock = types.SimpleNamespace(current=1_000_000.0)
+    monkeypatch.setattr(market_data, "time", types.SimpleNamespace(time=lambda: clock.current, sleep=time.sleep))
+    return clock
+
+
+@pytest.fixture
+def gate():
+    event = threading.Event()
+    yield event
+    event.set()   # never leave a shared refresh worker blocked
+
+
+# === FAILOVER ===
+def test_symbols_one_backend_misses_are_asked_of_the_next(now):
+    first = FakeBackend("first", {"AAA": 1.0})
+    second = FakeBackend("second", {"AAA": 9.0, "BBB": 2.0})
+    provider = MarketDataProvider([first, second])
+    assert provider.prices(["AAA", "BBB"]) == {"AAA": 1.0, "BBB": 2.0}
+    assert second.calls == [["BBB"]]
+
+
+def test_failing_backend_is_skipped_until_its_cooldown_ends(now):
+    flaky = FakeBackend("flaky", {"AAA": 1.0}, error="HTTP 429")
+    spare = FakeBackend("spare", {"AAA": 2.0})
+    provider = MarketDataProvider([flaky, spare], max_failures=2, cooldown=60)
+    for _ in range(3):
+        provider.refresh(["AAA"])
+    assert len(flaky.calls) == 2 and len(spare.calls) == 3
+    assert provider.health()["flaky"]["down_for"] == 60 and provider.health()["flaky"]["last_error"] == "HTTP 429"
+
+    flaky.error = None
+    now.current += 61
+    provider.refresh(["AAA"])
+    assert len(flaky.calls) == 3 and len(spare.calls) == 3
+    assert provider.get_quote("AAA").source == "flaky" and provider.health()["flaky"]["failures"] == 0
+
+
+def test_suffix_is_added_for_the_vendor_and_stripped_for_callers(now):
+    backend = FakeBackend("yfinance", {"RELIANCE.NS": 2900.0, "TCS.BO": 4100.0})
+    provider = MarketDataProvider([backend], suffix=".NS")
+    assert provider.prices(["RELIANCE", "TCS.BO"]) == {"RELIANCE": 2900.0, "TCS.BO": 4100.0}
+    assert backend.calls == [["RELIANCE.NS", "TCS.BO"]]
+    assert provider.get_quote("RELIANCE").symbol == "RELIANCE"
+
+
+# === CACHE ===
+def test_expired_quote_is_served_stale_while_one_refresh_runs(now, gate):
+    backend = FakeBackend("b", {"AAA": 1.0})
+    provider = MarketDataProvider([backend], ttl=60)
+    assert provider.get_quote("AAA") == Quote("AAA", 1.0, source="b")
+
+    now.current += 61
+    backend.prices["AAA"] = 2.0
+    backend.gate = gate
+    started = time.monotonic()
+    for _ in range(3):
+        assert provider.get_quote("AAA") == Quote("AAA", 1.0, source="b", stale=True)
+    assert time.monotonic() - started < 1
+    gate.set()
+    for future in list(provider._inflight.values()):
+        future.result(timeout=5)
+    assert len(backend.calls) == 2   # the three stale reads shared one refresh
+    assert provider.get_quote("AAA") == Quote("AAA", 2.0, source="b")
+
+
+def test_unpriceable_symbol_is_not_refetched_within_miss_ttl(now):
+    backend = FakeBackend("b")
+    provider = MarketDataProvider([backend])
+    assert provider.prices(["ZZZ"]) == {"ZZZ": 0.0}
+    now.current += market_data.MISS_TTL - 1
+    assert provider.prices(["ZZZ"]) == {"ZZZ": 0.0}
+    assert len(backend.calls) == 1
+    now.current += 2
+    provider.prices(["ZZZ"])
+    assert len(backend.calls) == 2
+
+
+def test_invalidate_drops_quotes_and_misses(now):
+    backend = FakeBackend("b", {"AAA": 1.0, "BBB": 2.0})
+    provider = MarketDataProvider([backend])
+    provider.prices(["AAA", "BBB", "ZZZ"])
+    provider.invalidate(["AAA", "ZZZ"])
+    assert set(provider.snapshot()) == {"BBB"}
+    provider.prices(["AAA", "BBB", "ZZZ"])
+    assert backend.calls[-1] == ["AAA", "ZZZ"]
+    provider.invalidate()
+    assert dict(provider.snapshot()) == {}
+
+
+def test_snapshot_is_read_only(now):
+    provider = MarketDataProvider([FakeBackend("b", {"AAA": 1.0})])
+    provider.prices(["AAA"])
+    with pytest.raises(TypeError):
+        provider.snapshot()["AAA"] = None
+
+
+# === DEADLINES ===
+def test_hung_backend_times_out_and_its_late_answer_is_cached(now, gate, monkeypatch):
+    monkeypatch.setattr(market_data, "BACKEND_TIMEOUT", 0.2)
+    slow = FakeBackend("slow", {"AAA": 1.0}, gate=gate)
+    spare = FakeBackend("spare", {"AAA": 2.0})
+    provider = MarketDataProvider([slow, spare])
+    assert provider.get_quote("AAA").source == "spare"
+    assert provider.health()["slow"]["failures"] == 1
+
+    gate.set()   # the straggler lands after the page moved on
+    deadline = time.monotonic() + 5
+    while provider._busy["slow"] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert provider.get_quote("AAA").source == "slow"
+
+
+def test_backend_with_every_worker_stuck_is_not_called_again(now, gate, monkeypatch):
+    monkeypatch.setattr(market_data, "BACKEND_TIMEOUT", 0.1)
+    slow = FakeBackend("slow", gate=gate)
+    spare = FakeBackend("spare", {"AAA": 1.0, "BBB": 2.0, "CCC": 3.0})
+    provider = MarketDataProvider([slow, spare], max_failures=10)
+    for symbol in ("AAA", "BBB", "CCC"):
+        provider.refresh([symbol])
+    assert len(slow.calls) == market_data.BACKEND_WORKERS
+    assert provider.prices(["AAA", "BBB", "CCC"]) == {"AAA": 1.0, "BBB": 2.0, "CCC": 3.0}
+
+
+def test_get_quotes_returns_at_the_deadline(now, gate):
+    provider = MarketDataProvider([FakeBackend("slow", {"AAA": 1.0}, gate=gate)])
+    started = time.monotonic()
+    assert provider.get_quotes(["AAA"], deadline=0.2) == {}
+    assert time.monotonic() - started < 1
+
+
+# === SHARED PROVIDERS ===
+def test_shared_provider_is_keyed_by_every_credential(monkeypatch):
+    monkeypatch.setattr(market_data, "_PROVIDERS", {})
+    a = market_data.shared_provider(alpaca_key="k", alpaca_secret="one", order=("yfinance",))
+    assert market_data.shared_provider(alpaca_key="k", alpaca_secret="one", order=("yfinance",)) is a
+    assert market_data.shared_provider(alpaca_key="k", alpaca_secret="two", order=("yfinance",)) is not a
+
+
+# === BACKGROUND REFRESH ===
+def test_refresher_covers_recent_reads_and_registered_sources(now, monkeypatch):
+    backend = FakeBackend("b", {"AAA": 1.0, "BBB": 2.0, "OLD": 3.0})
+    provider = MarketDataProvider([backend])
+    provider.prices(["OLD"])
+    now.current += market_data.WATCH_WINDOW + 1
+    provider.prices(["AAA"])
+    assert provider.requested_symbols() == ["AAA"]
+
+    def held():
+        return ["BBB", "AAA"]
+    # As if another page had already started this provider's thread
+    monkeypatch.setattr(market_data, "_REFRESHERS", {id(provider): [provider.requested_symbols]})
+    for _ in range(2):
+        market_data.start_background_refresh(provider, held)
+    sources = market_data._REFRESHERS[id(provider)]
+    assert sources == [provider.requested_symbols, held]
+
+    backend.calls.clear()
+    market_data.refresh_tracked(provider, sources)
+    assert backend.calls == [["AAA", "BBB"]]
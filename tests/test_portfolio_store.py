@@ -0,0 +1,348 @@
+import copy
+import gzip
+import io
+import os
+import zipfile
+from datetime import datetime
+
+import pytest
+
+import portfolio_store as store
+
+
+def _checkpointed(paths, data):
+    s = store.open_store(paths)
+    s.checkpoint(data)
+    return s
+
+
+def _shares(data, ticker="T00"):
+    return data["etfs"][ticker]["shares"]
+
+
+# === MIGRATION ===
+def test_reset_leaves_a_tombstone_so_the_flat_directory_is_not_copied_back(tmp_path, monkeypatch):
+    root = str(tmp_path)
+    os.makedirs(f"{root}/alice")
+    with open(f"{root}/alice/alice_latest.json", "w") as f:
+        f.write(store._dumps(store.synthetic_state(5, tickers=2, options=0)))
+    paths = store.migrate_layout("alice", root)
+    assert os.path.exists(paths["latest"]) and os.path.exists(paths["migrated"])
+
+    store.reset_user(paths)
+    assert sorted(os.listdir(paths["dir"])) == ["alice.lock", "alice.migrated"]
+    monkeypatch.setattr(store, "_MIGRATED", set())   # a process restart
+    store.migrate_layout("alice", root)
+    assert not os.path.exists(paths["latest"])
+    assert os.path.exists(f"{root}/alice/alice_latest.json")   # the other pages' copy is left alone
+
+
+# === RECOVERY ===
+def test_torn_journal_entry_is_trimmed_and_appends_continue(paths, state, clock):
+    s = _checkpointed(paths, state)
+    s.record(state, "buy", ticker="T00", shares=5, price=10)
+    s.record(state, "buy", ticker="T00", shares=5, price=10)
+    with open(paths["journal"], "a") as f:
+        f.write('{"seq": 3, "op": "buy", "tick')   # crash mid-append
+
+    fresh = store.open_store(paths)
+    data = fresh.load()
+    assert "trimmed a torn journal entry" in fresh.recovered
+    assert _shares(data) == _shares(state)
+    with open(paths["journal"], "rb") as f:
+        assert f.read().endswith(b"\n")
+
+    fresh.record(data, "sell", ticker="T00", shares=1)
+    assert [e["seq"] for e in store.read_journal(paths["journal"])] == [1, 2, 3]
+    assert _shares(store.open_store(paths).load()) == _shares(state) - 1
+
+
+def test_torn_latest_is_rebuilt_from_snapshot_and_journal(paths, state, clock):
+    s = _checkpointed(paths, state)
+    clock.advance(minutes=5)
+    s.record(state, "buy", ticker="T00", shares=7, price=10)
+    s.record(state, "set_cash", amount=123.0)
+    with open(paths["latest"], "rb") as f:
+        payload = f.read()
+    with open(paths["latest"], "wb") as f:
+        f.write(payload[:len(payload) // 2])
+
+    fresh = store.open_store(paths)
+    data = fresh.load()
+    assert any(a.startswith("rebuilt state from history") for a in fresh.recovered)
+    assert _shares(data) == _shares(state)
+    assert data["cash_balance"] == 123.0
+    # The rebuilt state was checkpointed, so the next load is clean
+    again = store.open_store(paths)
+    assert _shares(again.load()) == _shares(state) and again.recovered == []
+
+
+def test_interrupted_checkpoint_is_completed_on_startup(paths, state, clock, monkeypatch):
+    s = _checkpointed(paths, state)
+    s.record(state, "buy", ticker="T00", shares=3, price=10)
+    clock.advance(minutes=1)
+
+    def _crash(*args):
+        raise OSError("killed")
+    with monkeypatch.context() as m, pytest.raises(OSError):
+        m.setattr(store, "_rotate_journal", _crash)   # dies after latest is written
+        store.write_checkpoint(paths, state)
+    assert os.path.exists(paths["wal"])
+
+    fresh = store.open_store(paths)
+    data = fresh.load()
+    assert fresh.recovered == [f"completed interrupted checkpoint {clock.current:%Y-%m-%d_%H%M%S}"]
+    assert not os.path.exists(paths["wal"]) and not os.path.exists(paths["journal"])
+    assert _shares(data) == _shares(state)
+
+
+def test_interrupted_checkpoint_rolls_back_when_latest_was_not_written(paths, state, clock):
+    s = _checkpointed(paths, state)
+    s.record(state, "buy", ticker="T00", shares=3, price=10)
+    store.atomic_write(paths["wal"], store._dumps({"ts": "2025-01-06_093100", "seq": 1, "checksum": "not-written"}))
+
+    fresh = store.open_store(paths)
+    data = fresh.load()
+    assert fresh.recovered == ["rolled back interrupted checkpoint 2025-01-06_093100"]
+    assert _shares(data) == _shares(state)
+    assert [e["seq"] for e in store.read_journal(paths["journal"])] == [1]
+
+
+# === CHECKPOINTS ===
+@pytest.mark.parametrize("backend", ["json", "sqlite"])
+def test_session_start_checkpoint_of_the_saved_version_writes_nothing(paths, state, clock, backend):
+    s = store.open_store(paths, backend)
+    first = s.checkpoint(state)
+    clock.advance(minutes=5)
+    data = store.open_store(paths, backend).load()
+    assert store.open_store(paths, backend).checkpoint(data) == first
+    assert len(store.read_manifest(paths["history"])) == 1
+
+    s.record(data, "buy", ticker="T00", shares=1, price=10)
+    assert s.checkpoint(data) != first
+    assert len(store.read_manifest(paths["history"])) == 2
+
+
+# === COMPACTION ===
+def test_state_at_after_compaction_reads_archived_checkpoints(paths, state, clock):
+    s = _checkpointed(paths, state)
+    expected = {}
+    for day in range(4):
+        clock.advance(hours=2)
+        s.record(state, "buy", ticker="T00", shares=10, price=20)
+        expected[clock.current] = _shares(state)
+        clock.advance(hours=22)
+        s.checkpoint(state)
+    assert len(store.read_manifest(paths["history"])) == 5
+
+    archived = store.compact_user(paths, now=clock.current, policy=[(None, "%Y-%m")])
+    assert archived == 4
+    assert len(os.listdir(f"{paths['history']}2025-01")) == 3   # manifest, newest snapshot, its segment
+    with zipfile.ZipFile(f"{paths['history']}archive/2025-01.zip") as zf:
+        assert len(zf.namelist()) == 4
+
+    for when, shares in expected.items():
+        assert _shares(s.state_at(when)) == shares
+    assert _shares(s.state_at(datetime(2025, 1, 6, 10, 0))) == _shares(store.synthetic_state(10, tickers=3))
+    assert s.state_at(datetime(2025, 1, 1)) is None
+
+
+def test_state_at_reads_one_manifest_partition_and_the_last_history_page(paths, clock, monkeypatch):
+    data = store.synthetic_state(2 * store.HISTORY_PAGE + 10, tickers=3)
+    data["_seq"] = 0
+    s = _checkpointed(paths, data)
+    for month in range(3):
+        clock.advance(days=31)
+        s.record(data, "buy", ticker="T00", shares=1, price=10)
+        s.checkpoint(data)
+
+    read = []
+    real = store.read_journal
+    monkeypatch.setattr(store, "read_journal", lambda path: read.append(path) or real(path))
+    past = s.state_at(datetime(2025, 2, 20))
+    assert [p for p in read if p.endswith(store.MANIFEST_NAME)] == [f"{paths['history']}2025-02/{store.MANIFEST_NAME}"]
+    assert isinstance(past["history"], store.LazyHistory) and past["history"]._pages == {}
+    assert len(past["history"]) == len(data["history"])
+    assert _shares(past) == _shares(data) - 2
+
+
+# === BACKUP ===
+def _backup_bytes(s, data, tmp_path):
+    path = store.export_backup(s, data, "alice", str(tmp_path / "backup.ndjson.gz"), include_history=True)
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def test_backup_round_trip_with_history(paths, tmp_path, clock):
+    data = store.synthetic_state(600, tickers=3, options=2)
+    data["_seq"] = 0
+    s = _checkpointed(paths, data)
+    clock.advance(hours=1)
+    s.record(data, "premium", history={"date": "2025-01-06", "premium": 75.0})
+    s.checkpoint(data)
+    raw = _backup_bytes(s, data, tmp_path)
+
+    target = store.user_paths("bob", str(tmp_path))
+    os.makedirs(target["history"])
+    t = store.open_store(target)
+    restored, imported = store.import_backup(t, io.BytesIO(raw), merge_history=True)
+    assert imported == 2
+    assert restored["etfs"] == data["etfs"] and restored["open_options"] == data["open_options"]
+    assert list(restored["history"]) == list(data["history"])
+    assert restored["_seq"] == data["_seq"]
+
+    t.checkpoint(restored, base_seq=0)
+    assert _shares(t.load()) == _shares(data)
+    assert [e["file"] for e in store.read_manifest(target["history"])][-2:] == \
+           [e["file"] for e in store.read_manifest(paths["history"])]
+
+
+@pytest.mark.parametrize("damage", ["cut_stream", "cut_line", "missing_field", "bad_checksum"])
+def test_damaged_backup_raises_backup_error(paths, state, tmp_path, damage, clock):
+    s = _checkpointed(paths, state)
+    raw = _backup_bytes(s, state, tmp_path)
+    lines = gzip.decompress(raw).split(b"\n")
+    if damage == "cut_stream":
+        raw = raw[:len(raw) * 2 // 3]
+    elif damage == "cut_line":
+        raw = gzip.compress(b"\n".join(lines[:3]) + b"\n" + lines[3][:len(lines[3]) // 2])
+    elif damage == "missing_field":
+        raw = gzip.compress(lines[0] + b'\n{"section": "etfs", "value": {}}\n')
+    else:
+        raw = gzip.compress(b"\n".join(lines[:2] + [lines[2].replace(b"T00", b"T99")] + lines[3:]))
+
+    with pytest.raises(store.BackupError):
+        store.import_backup(s, io.BytesIO(raw), merge_history=True)
+    assert not os.path.exists(f"{paths['history']}.import/")
+
+
+# === SQLITE BACKEND ===
+SESSION = [
+    ("buy", {"ticker": "T00", "shares": 5, "price": 10}),
+    ("sell", {"ticker": "T01", "shares": 1}),
+    ("add_capital", {"date": "2025-01-06", "amount": 100.0}),
+    ("add_option", {"option": {"id": "new", "ticker": "T02", "contracts": 3, "strike": 9.0, "expiry": "2025-02-21"},
+                    "history": {"date": "2025-01-06", "premium": 75.0, "margin_debt": 500.0}}),
+    ("close_option", {"id": "opt_0", "contracts": 1}),
+    ("option_trade", {"trade": {"ticker": "T02", "action": "sell_to_open", "contracts": 3}}),
+    ("premium", {"history": {"date": "2025-02-03", "premium": 20.0, "portfolio_value": 99000.0, "margin_debt": 700.0}}),
+    ("set_cash", {"amount": 42.0}),
+]
+
+
+def _run_session(s, data):
+    with store.UnitOfWork(s, data) as uow:
+        for op, fields in SESSION:
+            uow.record(op, **fields)
+
+
+def _comparable(data):
+    return {k: list(v) if k == "history" else v for k, v in data.items() if k != "_checkpoint_seq"}
+
+
+@pytest.mark.parametrize("checkpoint", [False, True])
+def test_sqlite_matches_json_store(tmp_path, state, clock, checkpoint):
+    loaded = {}
+    for backend in ("json", "sqlite"):
+        paths = store.user_paths(backend, str(tmp_path))
+        os.makedirs(paths["history"])
+        s = store.open_store(paths, backend)
+        data = copy.deepcopy(state)
+        s.checkpoint(data)
+        _run_session(s, data)
+        if checkpoint:
+            s.checkpoint(data)
+        fresh = store.open_store(paths, backend)
+        loaded[backend] = (fresh, fresh.load())
+
+    (js, jd), (qs, qd) = loaded["json"], loaded["sqlite"]
+    assert _comparable(qd) == _comparable(jd)
+    assert qs.head_seq() == js.head_seq() == len(SESSION)
+    assert qs.last_margin(qd) == js.last_margin(jd) == 700.0
+    assert qs.monthly_premiums(qd, 2025) == js.monthly_premiums(jd, 2025) == {"2025-01": 75.0, "2025-02": 20.0}
+    assert qs.open_contracts_per_ticker(qd) == js.open_contracts_per_ticker(jd)
+    assert js.open_contracts_per_ticker(jd)["T02"] == 3
+
+
+def test_sqlite_imports_a_json_account_and_its_journal_on_first_open(paths, state, clock):
+    s = _checkpointed(paths, state)
+    clock.advance(hours=1)
+    _run_session(s, state)
+    expected = store.open_store(paths).load()
+
+    q = store.open_store(paths, "sqlite")
+    assert _comparable(q.load()) == _comparable(expected)
+    assert [e["op"] for e in q.iter_events("", 0)] == [op for op, _ in SESSION]
+    assert _shares(q.state_at(clock.current)) == _shares(expected)
+    assert _shares(q.state_at(datetime(2025, 1, 6, 10, 0))) == _shares(store.synthetic_state(10, tickers=3))
+
+    # Later opens read the database, not the JSON files
+    s.record(state, "buy", ticker="T00", shares=1, price=10)
+    assert _shares(store.open_store(paths, "sqlite").load()) == _shares(expected)
+
+
+def test_shared_store_is_reused_until_the_user_is_reset(paths, state, clock, monkeypatch):
+    monkeypatch.setattr(store, "_STORES", {})
+    s = store.shared_store(paths, "sqlite")
+    assert store.shared_store(paths, "sqlite") is s
+    s.checkpoint(state)
+
+    store.reset_user(paths)
+    fresh = store.shared_store(paths, "sqlite")
+    assert fresh is not s and fresh.load() is None
+
+
+# === CONCURRENT SESSIONS ===
+def _two_sessions(paths, state):
+    _checkpointed(paths, state)
+    return [(store.open_store(paths), store.open_store(paths).load()) for _ in range(2)]
+
+
+def test_commuting_save_is_rebased_onto_the_other_session(paths, state, clock):
+    (s1, d1), (s2, d2) = _two_sessions(paths, state)
+    with store.UnitOfWork(s1, d1) as uow:
+        uow.record("buy", ticker="T00", shares=5, price=10)
+    with store.UnitOfWork(s2, d2) as uow:
+        uow.record("buy", ticker="T01", shares=2, price=10)
+        uow.record("add_option", option={"id": "new", "ticker": "T01", "contracts": 1, "strike": 9.0, "expiry": "2025-02-21"})
+
+    assert s2.rebased == 2
+    assert [e["seq"] for e in store.read_journal(paths["journal"])] == [1, 2, 3]
+    saved = store.open_store(paths).load()
+    assert _shares(saved, "T00") == _shares(state, "T00") + 5
+    assert _shares(saved, "T01") == _shares(state, "T01") + 2
+    assert d2["_seq"] == 3 and _shares(d2, "T00") == _shares(saved, "T00")   # session now sees both
+
+
+def test_capital_additions_commute(paths, state, clock):
+    (s1, d1), (s2, d2) = _two_sessions(paths, state)
+    s1.record(d1, "add_capital", date="2025-01-06", amount=100.0)
+    s2.record(d2, "add_capital", date="2025-01-06", amount=50.0)
+    saved = store.open_store(paths).load()
+    assert saved["cash_balance"] == state["cash_balance"] + 150.0
+    assert len(saved["capital_additions"]) == 2
+
+
+@pytest.mark.parametrize("theirs, ours", [
+    (("buy", {"ticker": "T00", "shares": 5, "price": 10}), ("sell", {"ticker": "T00", "shares": 1})),
+    (("set_cash", {"amount": 10.0}), ("add_capital", {"date": "2025-01-06", "amount": 5.0})),
+    (("close_option", {"id": "opt_0", "contracts": 1}), ("update_option", {"id": "opt_0", "fields": {"strike": 1.0}})),
+    (("add_option", {"option": {"id": "x", "ticker": "T00", "contracts": 1}}), ("close_option", {"index": 0, "contracts": 1})),
+])
+def test_conflicting_save_is_refused(paths, state, clock, theirs, ours):
+    (s1, d1), (s2, d2) = _two_sessions(paths, state)
+    s1.record(d1, theirs[0], **theirs[1])
+    uow = store.UnitOfWork(s2, d2)
+    uow.record(ours[0], **ours[1])
+    with pytest.raises(store.ConflictError):
+        uow.commit()
+    assert [e["op"] for e in store.read_journal(paths["journal"])] == [theirs[0]]
+
+
+def test_restore_over_a_newer_save_is_refused(paths, state, clock):
+    (s1, d1), (s2, d2) = _two_sessions(paths, state)
+    s1.record(d1, "set_cash", amount=1.0)
+    restored = dict(d2, _seq=d2["_seq"] + 1)
+    with pytest.raises(store.ConflictError):
+        s2.checkpoint(restored, base_seq=d2["_seq"])
+    assert store.open_store(paths).load()["cash_balance"] == 1.0